@@ -0,0 +1,1297 @@
+import copy
+import gc
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+from random import Random
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+PROJECT_FOLDER  = path.dirname(path.dirname(path.abspath(__file__)))
+GAME_FILE       = path.join(PROJECT_FOLDER, "[Game Project 7] Adventurers of Elrualia.py")
+MAP_FOLDER      = path.join(PROJECT_FOLDER, "Data", "Map")
+GRAPHICS_FOLDER = path.join(PROJECT_FOLDER, "Data", "Graphics")
+MAPS            = sorted(name for name in os.listdir(MAP_FOLDER) if name.startswith("Map_") and name.endswith(".tmx"))
+
+# Scenario Settings
+SCENARIO_ENTITIES   = ((10, 10, 5), (100, 50, 20), (500, 200, 50))     # Mobs, items and effects kept alive
+SCENARIO_FRAMES     = 300
+SCENARIO_PATH       = (("K_RIGHT", 90), ("K_DOWN", 60), ("K_LEFT", 90), ("K_UP", 60))   # Key held and frames
+SCENARIO_SLASH      = 20                # Frames between sword slashes
+RESULTS_FILE        = "scenarios.json"  # --output=FILE
+BASELINE_FILE       = None              # --compare=FILE, results of an earlier run
+REGRESSION          = 0.10              # Slower p95 than the baseline by this fraction, and by REGRESSION_MS
+REGRESSION_MS       = 0.05
+
+spec = importlib.util.spec_from_file_location("elrualia", GAME_FILE)
+game = importlib.util.module_from_spec(spec)
+sys.modules["elrualia"] = game
+spec.loader.exec_module(game)
+pygame = game.pygame
+
+
+
+"""
+    Helpful Functions
+"""
+class BenchWorld():
+    def __init__(self):
+        """
+        World    : Holds the groups the game sprites register into, without a window or game loop
+        """
+        self.all_sprites    = pygame.sprite.LayeredUpdates()
+        self.mobs           = pygame.sprite.Group()
+        self.sword          = pygame.sprite.Group()
+        self.walls          = pygame.sprite.Group()
+        self.items          = pygame.sprite.Group()
+        self.effects        = pygame.sprite.Group()
+        self.mob_grid       = game.SpatialGrid(game.MOB_RADIUS)
+        self.mob_batch      = None
+        self.activity       = None
+        self.flow           = None
+        self.dt             = 1 / game.FPS
+
+    def load_images(self):
+        self.mob_img        = game.load_tile_table(path.join(GRAPHICS_FOLDER, game.MOB_IMG), 32, 32)
+        self.atlas          = game.AnimationAtlas()
+        self.atlas.add_table("mob", game.health_frames(self.mob_img, game.MOB_HEALTH))
+
+    def load_map(self, map_name, merge=game.MERGE_COLLISION):
+        self.map            = game.Map(path.join(MAP_FOLDER, map_name))
+        load_walls(self, self.map, merge)
+
+    def index_mobs(self):
+        game.Game.index_mobs(self)
+
+    def spawn_mob(self, x, y):
+        return game.Game.spawn_mob(self, x, y)
+
+
+class Probe():
+    def __init__(self, rect):
+        self.rect       = rect
+        self.hit_rect   = rect
+        self.pos        = game.vec(rect.center)
+        self.vel        = game.vec(0, 0)
+
+
+def init_display():
+    pygame.init()
+    if pygame.display.get_surface() is None:
+        pygame.display.set_mode((1, 1))
+
+
+def load_walls(world, map, merge=game.MERGE_COLLISION):
+    for x, y, columns, rows in map.collision_rects(merge):
+        game.Obstacle(world, x, y, map.tilewidth, map.tileheight, columns, rows)
+    world.wall_grid = game.SpatialGrid(map.tilewidth)
+    for wall in world.walls:
+        world.wall_grid.add(wall)
+    world.wall_index = game.wall_index(world.walls, world.wall_grid)
+
+
+def spawn_mobs(world, count, rng, spacing=game.MOB_RADIUS):
+    # Square area sized so the mob density stays the same for every count
+    side = max(1, int(count ** 0.5)) * spacing
+    world.player = Probe(pygame.Rect(0, 0, 1, 1))
+    world.player.pos = game.vec(side / 2, side / 2)
+    for _ in range(count):
+        game.Mob(world, rng.uniform(0, side), rng.uniform(0, side))
+
+
+def free_positions(map, count, rng):
+    # Random points on tiles outside the "collision" layer
+    solid = set(map.collision_tiles())
+    tw, th = map.tilewidth, map.tileheight
+    tiles = [(x, y) for y in range(map.rows) for x in range(map.columns) if (x, y) not in solid]
+    positions = []
+    for _ in range(count):
+        x, y = rng.choice(tiles)
+        positions.append(game.vec(rng.uniform(x * tw, (x + 1) * tw), rng.uniform(y * th, (y + 1) * th)))
+    return positions
+
+
+class ScriptedKeys():
+    def __init__(self, walk=SCENARIO_PATH, slash=SCENARIO_SLASH):
+        """
+        Keys    : Keyboard state for Game.get_pressed, walking along walk, a list of (key name, frames), in a loop
+                  and slashing every slash frames. step() moves on to the next frame.
+        """
+        self.walk   = [(getattr(pygame, key), frames) for key, frames in walk]
+        self.length = sum(frames for key, frames in self.walk)
+        self.slash  = slash
+        self.frame  = 0
+        self.down   = set()
+
+    def __getitem__(self, key):
+        return key in self.down
+
+    def step(self):
+        frame = self.frame % self.length
+        for key, frames in self.walk:
+            if frame < frames:
+                break
+            frame -= frames
+        self.down = {key}
+        if self.frame % self.slash == 0:
+            self.down.add(pygame.K_SPACE)
+        self.frame += 1
+
+
+class WaypointKeys():
+    def __init__(self, world, waypoints, tolerance=8):
+        """
+        Keys    : Keyboard state for Game.get_pressed walking the player of world to each of waypoints in turn, in world
+                  pixels of its WorldStreamer. step() picks the keys of the next frame, done is set at the last waypoint.
+        """
+        self.world      = world
+        self.waypoints  = [game.vec(waypoint) for waypoint in waypoints]
+        self.tolerance  = tolerance
+        self.index      = 0
+        self.done       = False
+        self.down       = set()
+
+    def __getitem__(self, key):
+        return key in self.down
+
+    def step(self):
+        self.down = set()
+        pos = self.world.world.world_pos(self.world.player.pos)
+        dx, dy = self.waypoints[self.index] - pos
+        if abs(dx) <= self.tolerance and abs(dy) <= self.tolerance:
+            self.index += 1
+            self.done = self.index == len(self.waypoints)
+            if self.done:
+                return
+            dx, dy = self.waypoints[self.index] - pos
+        if abs(dx) > self.tolerance:
+            self.down.add(pygame.K_RIGHT if dx > 0 else pygame.K_LEFT)
+        if abs(dy) > self.tolerance:
+            self.down.add(pygame.K_DOWN if dy > 0 else pygame.K_UP)
+
+
+def tiled_map(map, times):
+    # Map repeated times x times, the objects of the first copy only
+    tiled = copy.copy(map)
+    tiled.columns, tiled.rows = map.columns * times, map.rows * times
+    tiled.width, tiled.height = map.width * times, map.height * times
+    tiled.layers = []
+    for name, visible, gids in map.layers:
+        rows = [gids[y * map.columns:(y + 1) * map.columns] * times for y in range(map.rows)]
+        tiled.layers.append((name, visible, game.array("I", b"".join(row.tobytes() for row in rows * times))))
+    tiled.rects = None
+    return tiled
+
+
+def percentiles(times):
+    # Nearest rank percentiles, in milliseconds
+    times = sorted(times)
+    result = {}
+    for p in (50, 95, 99):
+        result["p%d" % p] = times[max(0, math.ceil(p / 100 * len(times)) - 1)] * 1000
+    result["mean"] = sum(times) / len(times) * 1000
+    return result
+
+
+def data_folder():
+    """
+    Data    : The game data folder, or a temporary copy of links merging Data and data where the file system is case sensitive
+    """
+    folder = path.join(PROJECT_FOLDER, "data")
+    if path.isdir(path.join(folder, "map")):
+        return folder
+    merged = tempfile.mkdtemp()
+    for name in os.listdir(folder):
+        if name != "graphics":
+            os.symlink(path.join(folder, name), path.join(merged, name))
+    os.symlink(MAP_FOLDER, path.join(merged, "map"))
+    os.symlink(path.join(PROJECT_FOLDER, "Data", "Tilesheet"), path.join(merged, "Tilesheet"))
+    os.mkdir(path.join(merged, "graphics"))
+    for folder_graphics in (path.join(folder, "graphics"), GRAPHICS_FOLDER):
+        for name in os.listdir(folder_graphics):
+            if not path.exists(path.join(merged, "graphics", name)):
+                os.symlink(path.join(folder_graphics, name), path.join(merged, "graphics", name))
+    return merged
+
+
+def timed(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+
+"""
+    Benchmarks
+"""
+def bench_collision(entity_counts=(10, 100, 1000), repeat=20):
+    """
+    Compare : collide_with_walls queries through the wall group scan and the SpatialGrid
+    Frame   : One "x" and one "y" query per moving entity, as in Player.update and Mob.update
+    Walls   : Run with one Obstacle per tile and with merged collision rectangles
+    Default : The structure wall_index picks for the map, grid from WALL_GRID_MIN walls and group below
+    """
+    init_display()
+    print("Wall collision (ms per frame)")
+    print("%-10s %7s %9s %10s %10s %8s %8s" % ("map", "walls", "entities", "group", "grid", "speedup", "default"))
+    for map_name in MAPS:
+        map = game.Map(path.join(MAP_FOLDER, map_name))
+        for merge in (False, True):
+            world = BenchWorld()
+            load_walls(world, map, merge)
+            rng = Random(map_name)
+            for count in entity_counts:
+                probes = []
+                for _ in range(count):
+                    rect = game.MOB_HIT_RECT.copy()
+                    rect.center = (rng.uniform(0, map.width), rng.uniform(0, map.height))
+                    probes.append(Probe(rect))
+                for probe in probes:
+                    assert game.wall_hits(probe, world.walls) == game.wall_hits(probe, world.wall_grid)
+
+                def frame(walls):
+                    for probe in probes:
+                        game.wall_hits(probe, walls)
+                        game.wall_hits(probe, walls)
+
+                group_time = timed(lambda: frame(world.walls), repeat)
+                grid_time = timed(lambda: frame(world.wall_grid), repeat)
+                default = "grid" if world.wall_index is world.wall_grid else "group"
+                print("%-10s %7d %9d %10.3f %10.3f %7.1fx %8s" % (map_name, len(world.walls), count, group_time * 1000, grid_time * 1000, group_time / grid_time, default))
+
+
+def bench_merge(probe_count=5000, repeat=20):
+    """
+    Report  : Obstacle count per map in Data/Map with one Obstacle per tile and with merged rectangles
+    Check   : collide_with_walls resolves random probes to the same positions with both
+    """
+    init_display()
+    print("Collision merge")
+    print("%-22s %9s %8s %12s %12s" % ("map", "per-tile", "merged", "per-tile ms", "merged ms"))
+    for map_name in sorted(os.listdir(MAP_FOLDER)):
+        if not map_name.endswith(".tmx"):
+            continue
+        map = game.Map(path.join(MAP_FOLDER, map_name))
+        tiled, merged = BenchWorld(), BenchWorld()
+        load_walls(tiled, map, merge=False)
+        load_walls(merged, map, merge=True)
+
+        rng = Random(map_name)
+        centers = [(rng.uniform(0, map.width), rng.uniform(0, map.height)) for _ in range(probe_count)]
+
+        def resolve(world):
+            positions = []
+            for center in centers:
+                rect = game.MOB_HIT_RECT.copy()
+                rect.center = center
+                probe = Probe(rect)
+                game.collide_with_walls(probe, world.wall_index, "x")
+                game.collide_with_walls(probe, world.wall_index, "y")
+                positions.append(tuple(probe.pos))
+            return positions
+
+        assert resolve(tiled) == resolve(merged)
+        tiled_time = timed(lambda: resolve(tiled), repeat)
+        merged_time = timed(lambda: resolve(merged), repeat)
+        print("%-22s %9d %8d %12.3f %12.3f" % (map_name, len(tiled.walls), len(merged.walls), tiled_time * 1000, merged_time * 1000))
+
+
+def avoid_mobs_scan(mob):
+    # Mob.avoid_mobs before the mob grid: every mob against every other mob
+    for other in mob.game.mobs:
+        if other != mob:
+            dist = mob.pos - other.pos
+            if 0 < dist.length() < game.MOB_RADIUS:
+                if mob.acc != -dist.normalize():
+                    mob.acc += dist.normalize()
+                else:
+                    mob.acc += game.vec(random.choice((mob.acc.y, -mob.acc.y)), random.choice((mob.acc.x, -mob.acc.x)))
+
+
+def bench_separation(mob_counts=(50, 500, 5000)):
+    """
+    Compare : Mob.avoid_mobs through the mob grid against the all-pairs scan it replaced
+    Frame   : Seek acceleration then separation for every mob, as in Mob.update
+    """
+    init_display()
+    print("Mob separation (ms per frame)")
+    print("%-8s %10s %10s %8s" % ("mobs", "scan", "grid", "speedup"))
+    for count in mob_counts:
+        world = BenchWorld()
+        world.load_images()
+        spawn_mobs(world, count, Random(count))
+        world.index_mobs()
+
+        def frame(avoid):
+            results = []
+            random.seed(count)
+            for mob in world.mobs:
+                mob.acc = game.vec(1, 0).rotate(-(world.player.pos - mob.pos).angle_to(game.vec(1, 0)))
+                avoid(mob)
+                results.append(tuple(mob.acc))
+            return results
+
+        assert frame(avoid_mobs_scan) == frame(game.Mob.avoid_mobs)
+        repeat = max(1, 2000 // count)
+        scan_time = timed(lambda: frame(avoid_mobs_scan), max(1, repeat // 10) if count > 500 else repeat)
+        grid_time = timed(lambda: world.index_mobs() or frame(game.Mob.avoid_mobs), repeat)
+        print("%-8d %10.3f %10.3f %7.1fx" % (count, scan_time * 1000, grid_time * 1000, scan_time / grid_time))
+
+
+def bench_batch(mob_counts=(500, 1000, 2000, 5000), frames=10):
+    """
+    Compare : Mob.update for every mob against one MobBatch.update
+    Map     : Mobs spread over the free tiles of Map_1 and resolving against its walls.
+              DETECT_RADIUS is raised to cover the map so every mob chases the player.
+    """
+    if game.numpy is None:
+        print("Mob batch: numpy is not installed")
+        return
+    init_display()
+    detect_radius = game.DETECT_RADIUS
+    print("Mob batch (ms per frame)")
+    print("%-8s %10s %10s %8s %10s" % ("mobs", "sprites", "batch", "speedup", "batch fps"))
+    for count in mob_counts:
+        times = []
+        for batch in (False, True):
+            world = BenchWorld()
+            world.load_images()
+            world.load_map("Map_1.tmx")
+            world.player = Probe(pygame.Rect(0, 0, 1, 1))
+            world.player.pos = game.vec(world.map.width / 2, world.map.height / 2)
+            if batch:
+                world.mob_batch = game.MobBatch(world)
+            for position in free_positions(world.map, count, Random(count)):
+                world.spawn_mob(position.x, position.y)
+            game.DETECT_RADIUS = world.map.width + world.map.height
+
+            def frame():
+                if world.mob_batch is not None:
+                    world.mob_batch.update()
+                else:
+                    world.index_mobs()
+                for mob in world.mobs:
+                    mob.update()
+
+            frame()
+            times.append(timed(frame, frames))
+            game.DETECT_RADIUS = detect_radius
+        print("%-8d %10.2f %10.2f %7.1fx %10.0f" % (count, times[0] * 1000, times[1] * 1000, times[0] / times[1], 1 / times[1]))
+
+
+def bench_chunks(budgets=(game.MAP_CACHE_BUDGET, 2 * 1024 * 1024)):
+    """
+    Compare : Map.make_map full render against MapRenderer chunks while the camera sweeps the map
+    Check   : Both produce the same pixels in view
+    Maps    : Each map, and Map_1 tiled 4 x 4 times, larger than the small budget outside the view
+    """
+    init_display()
+    screen = pygame.Surface((game.WIDTH, game.HEIGHT))
+    print("Map rendering")
+    print("%-10s %10s %10s %10s %12s %12s %10s %8s %9s" % ("map", "full ms", "full KB", "budget KB", "first ms", "worst ms", "peak KB", "evicted", "rendered"))
+    maps = [(map_name, game.Map(path.join(MAP_FOLDER, map_name))) for map_name in MAPS]
+    maps.append(("Map_1 x4", tiled_map(maps[0][1], 4)))
+    for map_name, map in maps:
+        start = time.perf_counter()
+        map_img = map.make_map()
+        full_time = time.perf_counter() - start
+        full_bytes = map_img.get_width() * map_img.get_height() * map_img.get_bytesize()
+
+        # Camera path: left to right along three rows
+        target = Probe(pygame.Rect(0, 0, 1, 1))
+        path_points = [(x, y) for y in (0, map.height // 2, map.height) for x in range(0, map.width + 1, 8)]
+        for budget in budgets:
+            renderer = game.MapRenderer(map, budget=budget)
+            camera = game.Camera(map.width, map.height)
+            times, peak = [], 0
+            for point in path_points:
+                target.rect.center = point
+                camera.update(target)
+                start = time.perf_counter()
+                renderer.draw(screen, camera)
+                times.append(time.perf_counter() - start)
+                peak = max(peak, renderer.memory)
+                if len(times) % 50 == 1:
+                    expected = pygame.Surface((game.WIDTH, game.HEIGHT))
+                    expected.blit(map_img, camera.apply_rect(map_img.get_rect()))
+                    assert pygame.image.tobytes(expected, "RGB") == pygame.image.tobytes(screen, "RGB")
+            print("%-10s %10.2f %10d %10d %12.2f %12.2f %10d %8d %9d" % (map_name, full_time * 1000, full_bytes // 1024, budget // 1024, times[0] * 1000, max(times) * 1000, peak // 1024, renderer.evicted, renderer.rendered))
+
+
+def bench_present(window_sizes=((800, 600), (640, 480), (1024, 768), (1280, 960), (1600, 1200)), frames=200):
+    """
+    Compare : ScaledGame.update before (caption every frame, new scaled surface every frame)
+              and ScaledGame.present with the caption at CAPTION_RATE, without display.flip
+    """
+    pygame.init()
+    display = game.ScaledGame(game.project_title, game.screen_size, game.FPS)
+    display.fill(game.LIGHTBLUE)
+
+    def legacy():
+        pygame.display.set_caption(display.title + " - " + str(int(display.clock.get_fps())) + "fps")
+        display.screen.blit(pygame.transform.scale(display, display.game_scaled), display.game_gap)
+
+    def present():
+        now = pygame.time.get_ticks()
+        if now - display.caption_time >= game.CAPTION_RATE:
+            display.caption_time = now
+            pygame.display.set_caption(display.title + " - " + str(int(display.clock.get_fps())) + "fps")
+        display.present()
+
+    print("Present (ms per frame)")
+    print("%-12s %10s %10s %10s" % ("window", "legacy", "nearest", "smooth"))
+    for size in window_sizes:
+        display.screen = pygame.display.set_mode(size)
+        display.game_scaled = size
+        display.scaled_surface = None
+        legacy_time = timed(legacy, frames)
+        display.smooth = False
+        nearest_time = timed(present, frames)
+        display.smooth = True
+        display.scaled_surface = None
+        smooth_time = timed(present, frames)
+        print("%-12s %10.3f %10.3f %10.3f" % ("%dx%d" % size, legacy_time * 1000, nearest_time * 1000, smooth_time * 1000))
+
+
+def bench_text(frames=500):
+    """
+    Compare : HUD coin counter and paused title, rendered every frame before and through the font and text caches
+    """
+    init_display()
+    world = BenchWorld()
+    world.gameDisplay = pygame.Surface(game.screen_size)
+
+    def legacy(coin):
+        font = pygame.font.SysFont(None, 32)
+        world.gameDisplay.blit(font.render(str(coin), True, game.WHITE), (52, 46))
+        font = pygame.font.Font(None, 105)
+        world.gameDisplay.blit(font.render("Paused", True, game.RED), (0, 0))
+
+    def cached(coin):
+        game.Text((world.gameDisplay, coin, game.text_interface), (False, 52, 46))
+        game.Game.draw_text(world, "Paused", None, 105, game.RED, game.WIDTH / 2, game.HEIGHT / 2, align="center")
+
+    print("Text (ms per frame)")
+    print("%-8s %10s %10s" % ("changes", "legacy", "cached"))
+    for changes in (0, 10, 100):
+        # The coin count changes every frames // changes frames
+        coins = [i * changes // frames for i in range(frames)]
+        legacy_time = timed(lambda: [legacy(coin) for coin in coins], 1) / frames
+        cached_time = timed(lambda: [cached(coin) for coin in coins], 1) / frames
+        print("%-8d %10.3f %10.3f" % (changes, legacy_time * 1000, cached_time * 1000))
+    print("cache hits %d, misses %d" % (game.Text.cache.hits, game.Text.cache.misses))
+
+
+def bench_assets(repeat=3):
+    """
+    Compare : Startup asset loading, everything loaded in order on one thread against the thread pool with lazy voices and maps
+    """
+    init_display()
+    folder = data_folder()
+    print("Assets (ms)")
+    print("%-24s %10s %8s" % ("loader", "load", "assets"))
+    for label, workers, lazy in (("sequential", 1, True), ("pool %d + lazy" % game.ASSET_WORKERS, game.ASSET_WORKERS, False)):
+        total = 0
+        for _ in range(repeat):
+            assets = game.AssetManager(workers)
+            game.asset_manifest(assets, folder)
+            assets.load(lazy=lazy)
+            assets.pool.shutdown()
+            total += assets.load_time
+        print("%-24s %10.2f %8d" % (label, total / repeat * 1000, len(assets.timings)))
+    print(assets.report())
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def cold_start(folder, archive_file=None):
+    # Run in a fresh process by bench_archive: display, asset manager and the startup assets
+    start = time.perf_counter()
+    init_display()
+    archive = game.AssetArchive(archive_file) if archive_file else None
+    assets = game.AssetManager(archive=archive)
+    game.asset_manifest(assets, folder)
+    assets.load()
+    files = sum(sum(timing) for name, timing in assets.timings.items() if assets.manifest[name][0] != "map")
+    print("%.3f %.3f %.3f" % ((time.perf_counter() - start) * 1000, assets.load_time * 1000, files * 1000))
+
+
+def bench_archive(runs=5):
+    """
+    Compare : Cold start of a fresh process loading the startup assets from the loose files and from the packed archive
+    """
+    folder = data_folder()
+    archive_file = path.join(tempfile.mkdtemp(), game.ARCHIVE_FILE)
+    entries = game.pack_assets(archive_file, folder)
+    print("Archive: %d entries, %d KB" % (entries, path.getsize(archive_file) // 1024))
+    print("Cold start (ms, median of %d processes)" % runs)
+    print("%-10s %10s %10s %10s %10s" % ("mode", "process", "startup", "assets", "non-map"))
+    for mode, archive in (("loose", ""), ("archive", archive_file)):
+        results = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, __file__, "cold_start", folder, archive], capture_output=True, text=True, check=True).stdout
+            startup, assets, files = output.split()[-3:]
+            results.append(((time.perf_counter() - start) * 1000, float(startup), float(assets), float(files)))
+        results.sort()
+        print("%-10s %10.2f %10.2f %10.2f %10.2f" % ((mode,) + results[runs // 2]))
+    shutil.rmtree(path.dirname(archive_file))
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_maps(repeat=5):
+    """
+    Compare : Map load parsed from the .tmx by pytmx against the compiled map, and the collision and objects walk of Game.new
+    """
+    init_display()
+    print("Maps (ms)")
+    print("%-10s %10s %10s %10s" % ("map", "tmx", "compiled", "walk"))
+    for map_name in MAPS:
+        filename = path.join(MAP_FOLDER, map_name)
+        game.MAP_COMPILE = False
+        tmx_time = timed(lambda: game.Map(filename), repeat)
+        game.MAP_COMPILE = True
+        map = game.Map(filename)
+        compiled_time = timed(lambda: game.Map(filename), repeat)
+        walk_time = timed(lambda: (map.collision_rects(), [name for name, x, y, width, height in map.objects]), repeat)
+        print("%-10s %10.2f %10.2f %10.3f" % (map_name, tmx_time * 1000, compiled_time * 1000, walk_time * 1000))
+
+
+def bench_headless(mob_counts=(0, 100, 500), steps=600):
+    """
+    Measure : Simulation throughput of a headless Game stepped with a fixed dt, in ticks per second
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    rng = Random(1)
+    print("Headless (%d steps of %.1f ms)" % (steps, game.SIM_DT * 1000))
+    print("%-8s %10s %12s" % ("mobs", "ms/tick", "ticks/s"))
+    for count in mob_counts:
+        world.new()
+        world.player.health = 10 ** 9
+        for x, y in free_positions(world.map, count, rng):
+            world.spawn_mob(x, y)
+        start = time.perf_counter()
+        ticks = world.step(steps)
+        elapsed = time.perf_counter() - start
+        print("%-8d %10.3f %12.0f" % (len(world.mobs), elapsed / ticks * 1000, ticks / elapsed))
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def top_up(world, mobs, items, effects, rng):
+    # Entities killed or picked up are replaced and the player healed, away from the timed frames
+    world.player.health = game.PLAYER_HEALTH
+    if len(world.mobs) < mobs:
+        for x, y in free_positions(world.map, mobs - len(world.mobs), rng):
+            world.spawn_mob(x, y)
+    if len(world.items) < items:
+        for position in free_positions(world.map, items - len(world.items), rng):
+            world.spawn(game.Item, position, rng.choice(list(game.ITEM_IMAGES)))
+    while len(world.effects) < effects:
+        offset = game.vec(rng.uniform(-game.WIDTH / 2, game.WIDTH / 2), rng.uniform(-game.HEIGHT / 2, game.HEIGHT / 2))
+        world.spawn(game.Effect, world.player.pos + offset, "pick_up")
+
+
+def run_scenario(world, map_name, mobs, items, effects, frames, rng):
+    world.load_map(map_name)
+    world.new()
+    if not any(name == "player" for name, x, y, width, height in world.map.objects):
+        position = free_positions(world.map, 1, rng)[0]
+        world.player = game.Player(world, position.x, position.y)
+    keys = ScriptedKeys()
+    world.get_pressed = lambda: keys
+
+    # Collision timed inside update
+    collide_times = []
+    def collide():
+        start = time.perf_counter()
+        game.Game.collide(world)
+        collide_times.append(time.perf_counter() - start)
+    world.collide = collide
+
+    update_times, draw_times, frame_times = [], [], []
+    for _ in range(frames):
+        top_up(world, mobs, items, effects, rng)
+        keys.step()
+        start = time.perf_counter()
+        world.dt = game.SIM_DT
+        world.events()
+        world.update()
+        updated = time.perf_counter()
+        world.draw()
+        drawn = time.perf_counter()
+        update_times.append(updated - start - collide_times[-1])
+        draw_times.append(drawn - updated)
+        frame_times.append(drawn - start)
+    return {"map": map_name, "mobs": mobs, "items": items, "effects": effects, "frames": frames,
+            "update": percentiles(update_times), "collision": percentiles(collide_times),
+            "draw": percentiles(draw_times), "frame": percentiles(frame_times)}
+
+
+def compare_results(baseline, results):
+    # Scenarios whose p95 got slower than the baseline, by section
+    previous = dict(((s["map"], s["mobs"], s["items"], s["effects"]), s) for s in baseline["scenarios"])
+    regressions = []
+    for scenario in results["scenarios"]:
+        base = previous.get((scenario["map"], scenario["mobs"], scenario["items"], scenario["effects"]))
+        if base is None:
+            continue
+        for section in ("update", "collision", "draw", "frame"):
+            old, new = base[section]["p95"], scenario[section]["p95"]
+            if new > old * (1 + REGRESSION) and new - old > REGRESSION_MS:
+                regressions.append((scenario["map"], scenario["mobs"], scenario["items"], scenario["effects"], section, old, new))
+    return regressions
+
+
+def bench_scenarios():
+    """
+    Measure : Frame time percentiles of a headless Game on every map, split into update, collision and draw,
+              with the player walking SCENARIO_PATH and slashing, for each SCENARIO_ENTITIES count.
+    Output  : Results written as JSON to RESULTS_FILE, compared with BASELINE_FILE when given.
+    Return  : True when a scenario regressed against the baseline.
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    results = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(), "pygame": pygame.version.ver,
+               "platform": platform.platform(), "dt": game.SIM_DT, "scenarios": []}
+    print("Scenarios (ms, p50 / p95 / p99)")
+    print("%-10s %-14s %-22s %-22s %-22s" % ("map", "mobs/items/fx", "update", "collision", "draw"))
+    for map_name in MAPS:
+        for mobs, items, effects in SCENARIO_ENTITIES:
+            scenario = run_scenario(world, map_name, mobs, items, effects, SCENARIO_FRAMES, Random(1))
+            results["scenarios"].append(scenario)
+            columns = ["%6.2f %6.2f %6.2f" % (scenario[section]["p50"], scenario[section]["p95"], scenario[section]["p99"]) for section in ("update", "collision", "draw")]
+            print("%-10s %-14s %-22s %-22s %-22s" % ((map_name, "%d/%d/%d" % (mobs, items, effects)) + tuple(columns)))
+    with open(RESULTS_FILE, "w") as file:
+        json.dump(results, file, indent=2)
+    print("Results written to %s" % RESULTS_FILE)
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+    if BASELINE_FILE:
+        with open(BASELINE_FILE) as file:
+            regressions = compare_results(json.load(file), results)
+        for map_name, mobs, items, effects, section, old, new in regressions:
+            print("Regression: %s %d/%d/%d %s p95 %.2f -> %.2f ms" % (map_name, mobs, items, effects, section, old, new))
+        print("%d regressions against %s" % (len(regressions), BASELINE_FILE))
+        return len(regressions) > 0
+    return False
+
+
+def world_state(world):
+    # Everything a replay has to reproduce
+    return (world.ticks, tuple(world.player.pos), world.player.health, world.player.coin,
+            sorted((tuple(mob.pos), mob.health) for mob in world.mobs), sorted((tuple(item.pos), item.type) for item in world.items))
+
+
+def bench_replay(ticks=1800, replays=3):
+    """
+    Check   : A session recorded with scripted keys replays to the same state every time, headless.
+    Measure : Recording overhead, trace size and replay speed in ticks per second.
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    trace_file = path.join(tempfile.mkdtemp(), "trace.bin")
+    keys = ScriptedKeys()
+    world.get_pressed = lambda: keys
+    world.start_recording(trace_file)
+    start = time.perf_counter()
+    for _ in range(ticks):
+        keys.step()
+        if world.step() == 0:
+            break
+    record_time = time.perf_counter() - start
+    recorded = world_state(world)
+    count = world.recorder.count
+    world.stop_recording()
+    del world.get_pressed
+
+    print("Replay (%d ticks, trace %d bytes)" % (count, path.getsize(trace_file)))
+    print("%-10s %10s %12s %10s" % ("run", "seconds", "ticks/s", "same"))
+    print("%-10s %10.3f %12.0f %10s" % ("record", record_time, count / record_time, "-"))
+    for run in range(replays):
+        world.start_replay(trace_file)
+        start = time.perf_counter()
+        world.run()
+        replay_time = time.perf_counter() - start
+        print("%-10s %10.3f %12.0f %10s" % ("replay %d" % (run + 1), replay_time, world.replay.tick / replay_time, world_state(world) == recorded))
+    world.replay = None
+    shutil.rmtree(path.dirname(trace_file))
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_contacts(entity_counts=(3, 10, 30, 100, 150, 300, 1000), area=(2400, 2400), repeat=10):
+    """
+    Compare : Broadphase contacts for all COLLISION_PAIRS against testing every pair of sprites, as groupcollide does,
+              through the grid always (grid) and with the default COLLISION_DIRECT, below which pairs are tested directly
+    Frame   : count mobs, swords and items spread over area, the player in the middle
+    Check   : All find the same (a, b) pairs in the same order
+    """
+    print("Contacts (ms per frame, direct up to %d hitboxes)" % game.COLLISION_DIRECT)
+    print("%-9s %10s %10s %10s %8s %9s" % ("entities", "pairs", "grid", "default", "speedup", "contacts"))
+    for count in entity_counts:
+        rng = Random(count)
+        entries = []
+        player = Probe(game.PLAYER_HIT_RECT.copy())
+        player.rect.center = (area[0] // 2, area[1] // 2)
+        entries.append(("player", player, player.hit_rect))
+        entries.append(("reach", player, player.rect))
+        for category, size in (("mob", (48, 48)), ("sword", game.SWORD_HIT_RECT.size), ("item", (32, 32))):
+            for _ in range(count):
+                rect = pygame.Rect((0, 0), size)
+                rect.center = (rng.uniform(0, area[0]), rng.uniform(0, area[1]))
+                entries.append((category, Probe(rect), rect))
+
+        def pairs():
+            contacts = {}
+            for first, second in game.COLLISION_PAIRS:
+                contacts[first, second] = [(sprite, other) for category, sprite, rect in entries if category == first
+                                           for other_category, other, other_rect in entries
+                                           if other_category == second and other is not sprite and rect.colliderect(other_rect)]
+            return contacts
+
+        def broad(broadphase):
+            broadphase.clear()
+            for entry in entries:
+                broadphase.add(*entry)
+            return broadphase.contacts()
+
+        grid, default = game.Broadphase(direct=0), game.Broadphase()
+        contacts = broad(default)
+        assert contacts == pairs() == broad(grid)
+        pairs_time = timed(pairs, max(1, repeat * 100 // count))
+        grid_time = timed(lambda: broad(grid), max(repeat, repeat * 100 // count))
+        default_time = timed(lambda: broad(default), max(repeat, repeat * 100 // count))
+        found = sum(len(found) for found in contacts.values())
+        print("%-9d %10.3f %10.3f %10.3f %7.1fx %9d" % (3 * count, pairs_time * 1000, grid_time * 1000, default_time * 1000, pairs_time / default_time, found))
+
+
+def bench_pools(churns=(2, 10, 40), frames=600):
+    """
+    Compare : Swords, effects and items built for every spawn against taken from the game's SpritePools
+    Frame   : The player slashes every frame and churn items fall on the player, each picked up into an effect
+    Measure : Sprites built, garbage collections, time spent collecting and update time per frame
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    sword_rate = game.SWORD_RATE
+    game.SWORD_RATE = 0
+    keys = ScriptedKeys(slash=1)
+    world.get_pressed = lambda: keys
+
+    collecting = []
+    def collected(phase, info):
+        collecting.append(-time.perf_counter() if phase == "start" else time.perf_counter())
+    gc.callbacks.append(collected)
+
+    print("Sprite pools (%d frames)" % frames)
+    print("%-6s %-6s %8s %8s %8s %10s %10s %10s" % ("churn", "pools", "spawned", "built", "reused", "gc runs", "gc ms", "ms/frame"))
+    for churn in churns:
+        for pooled in (False, True):
+            game.POOL_SPRITES = pooled
+            world.new(seed=1)
+            created = sum(pool.created for pool in world.pools.values())
+            reused = sum(pool.reused for pool in world.pools.values())
+            spawned = [0]
+            def spawn(*arguments):
+                spawned[0] += 1
+                return game.Game.spawn(world, *arguments)
+            world.spawn = spawn
+            gc.collect()
+            del collecting[:]
+            start = time.perf_counter()
+            for frame in range(frames):
+                keys.step()
+                world.player.health = game.PLAYER_HEALTH
+                for _ in range(churn):
+                    world.spawn(game.Item, world.player.pos, "coin")
+                world.step()
+            elapsed = time.perf_counter() - start
+            del world.spawn
+            reused = sum(pool.reused for pool in world.pools.values()) - reused
+            built = sum(pool.created for pool in world.pools.values()) - created if pooled else spawned[0]
+            print("%-6d %-6s %8d %8d %8d %10d %10.2f %10.3f" % (churn, pooled, spawned[0], built, reused, len(collecting) // 2, sum(collecting) * 1000, elapsed / frames * 1000))
+    for pool in world.pools.values():
+        print(pool.report())
+    gc.callbacks.remove(collected)
+    game.SWORD_RATE = sword_rate
+    game.POOL_SPRITES = True
+    del world.get_pressed
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_audio(mob_counts=(10, 100), frames=600):
+    """
+    Measure : Sounds asked for, played, suppressed and stolen by the AudioManager in a fight around the player,
+              slashing every frame with mobs spawned next to the player and an item dropped on it each frame.
+    Compare : Time spent starting sounds through AudioManager.play against Sound.play on any free channel
+    Note    : Headless runs faster than real time and sounds play in real time, so they last more frames than in a game
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    sword_rate = game.SWORD_RATE
+    game.SWORD_RATE = 0
+    keys = ScriptedKeys(slash=1)
+    world.get_pressed = lambda: keys
+    latency = game.AUDIO_BUFFER / game.AUDIO_FREQUENCY * 1000
+    print("Audio (%d frames, %d channels, %.1f ms mixer buffer)" % (frames, pygame.mixer.get_num_channels(), latency))
+    print("%-6s %-8s %-16s %8s %8s %10s %8s %10s" % ("mobs", "mode", "sound", "asked", "played", "suppressed", "stolen", "ms/sound"))
+    for count in mob_counts:
+        for managed in (True, False):
+            pygame.mixer.stop()
+            world.new(seed=1)
+            rng = Random(count)
+            world.audio = audio = game.AudioManager(world)
+            manager_play = audio.play
+            asked = dict((name, 0) for name in game.AUDIO_SOUNDS)
+            spent, played = [0], [0]
+            def play(name, sound):
+                asked[name] += 1
+                start = time.perf_counter()
+                if managed:
+                    channel = manager_play(name, sound)
+                else:
+                    channel = sound.play()
+                spent[0] += time.perf_counter() - start
+                played[0] += channel is not None
+            audio.play = play
+            # The manager reserves every channel, Sound.play only finds them unreserved
+            pygame.mixer.set_reserved(pygame.mixer.get_num_channels() if managed else 0)
+            for _ in range(frames):
+                keys.step()
+                # Enough health to live through every mob hitting at once
+                world.player.health = game.PLAYER_HEALTH + count * game.MOB_DAMAGE
+                while len(world.mobs) < count:
+                    world.spawn_mob(world.player.pos.x + rng.uniform(-40, 40), world.player.pos.y + rng.uniform(-40, 40))
+                world.spawn(game.Item, world.player.pos, "coin")
+                world.step()
+            total = sum(asked.values())
+            for name in game.AUDIO_SOUNDS:
+                if managed:
+                    print("%-6d %-8s %-16s %8d %8d %10d %8d" % (count, "manager", name, asked[name], audio.played[name], audio.suppressed[name], audio.stolen[name]))
+            print("%-6d %-8s %-16s %8d %8d %10d %8s %10.4f" % (count, "manager" if managed else "direct", "all", total, played[0], total - played[0], "", spent[0] / max(1, total) * 1000))
+            del audio.play
+    pygame.mixer.set_reserved(pygame.mixer.get_num_channels())
+    game.SWORD_RATE = sword_rate
+    del world.get_pressed
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_activity(sizes=(1, 3, 6), density=150, steps=300):
+    """
+    Compare : Headless step time with every mob updated each frame against the ActivityScheduler (MOB_LOD)
+    Map     : Map_1 tiled sizes x sizes times with density mobs per copy, so the mobs near the player stay the same
+              while the mobs on the map grow. The player walks SCENARIO_PATH.
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    keys = ScriptedKeys()
+    world.get_pressed = lambda: keys
+    lod = game.MOB_LOD
+    print("Activity (ms per step)")
+    print("%-8s %8s %10s %10s %8s %8s %8s %8s" % ("map", "mobs", "all", "lod", "speedup", "full", "middle", "asleep"))
+    base = world.assets.get("Map_1.tmx")
+    for size in sizes:
+        times = []
+        for enabled in (False, True):
+            game.MOB_LOD = enabled
+            world.map = tiled_map(base, size)
+            world.map_renderer = game.MapRenderer(world.map)
+            world.new(seed=1)
+            for x, y in free_positions(world.map, density * size * size, Random(size)):
+                world.spawn_mob(x, y)
+            keys.frame = 0
+            start = time.perf_counter()
+            for _ in range(steps):
+                keys.step()
+                world.player.health = game.PLAYER_HEALTH + len(world.mobs) * game.MOB_DAMAGE
+                world.step()
+            times.append((time.perf_counter() - start) / steps)
+        activity = world.activity
+        print("%-8s %8d %10.3f %10.3f %7.1fx %8d %8d %8d" % ("%dx%d" % (size, size), len(world.mobs), times[0] * 1000, times[1] * 1000, times[0] / times[1],
+                                                            activity.full, activity.middle, activity.asleep))
+    game.MOB_LOD = lod
+    del world.get_pressed
+    world.load_map("Map_1.tmx")
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_flow(radii=(12, game.FLOW_RADIUS, None), lookups=10000, chase_mobs=40, chase_frames=300):
+    """
+    Measure : Time to search a new FlowField when the player changes tile, from every free tile of each map,
+              for each search radius (None for the whole map), and the time of one Mob steering lookup
+    Chase   : One mob at a time from chase_mobs places within DETECT_RADIUS of a still player, how many reach it
+              within chase_frames and in how many frames, steering straight at the player against following the field
+    """
+    init_display()
+    print("Flow field (ms per player tile change)")
+    print("%-10s %7s %8s %8s %8s %9s %8s %10s" % ("map", "radius", "mean", "p95", "max", "reached", "bytes", "steer us"))
+    for map_name in MAPS:
+        map = game.Map(path.join(MAP_FOLDER, map_name))
+        solid = set(map.collision_tiles())
+        tiles = [(x, y) for y in range(map.rows) for x in range(map.columns) if (x, y) not in solid]
+        for radius in radii:
+            field = game.FlowField(map, radius, budget=map.columns * map.rows)
+            times, reached = [], 0
+            for x, y in tiles:
+                start = time.perf_counter()
+                field.start(y * map.columns + x)
+                field.step(field.budget)
+                times.append(time.perf_counter() - start)
+                reached += len(field.directions) - field.directions.count(0) + 1
+            rng = Random(map_name)
+            points = [(rng.uniform(0, map.width), rng.uniform(0, map.height)) for _ in range(lookups)]
+            start = time.perf_counter()
+            for point in points:
+                field.steer(point)
+            steer_time = (time.perf_counter() - start) / lookups
+            stats = percentiles(times)
+            print("%-10s %7s %8.3f %8.3f %8.3f %9.0f %8d %10.3f" % (map_name, radius, stats["mean"], stats["p95"], max(times) * 1000,
+                                                                   reached / len(tiles), len(field.directions) + len(field.blocked), steer_time * 1e6))
+
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    flow = game.MOB_FLOW
+    print()
+    print("Chase (%d mobs within DETECT_RADIUS, one at a time, %d frames)" % (chase_mobs, chase_frames))
+    print("%-10s %10s %10s %12s %12s" % ("map", "straight", "flow", "straight fr", "flow fr"))
+    keys = ScriptedKeys()
+    world.get_pressed = lambda: keys
+    for map_name in MAPS:
+        world.load_map(map_name)
+        world.new(seed=1)
+        rng = Random(map_name)
+        home = [game.vec(x + width / 2, y + height / 2) for name, x, y, width, height in world.map.objects if name == "player"]
+        home = home[0] if home else free_positions(world.map, 1, rng)[0]
+        starts = []
+        while len(starts) < chase_mobs:
+            position = free_positions(world.map, 1, rng)[0]
+            if 3 * game.TILESIZE < position.distance_to(home) < game.DETECT_RADIUS:
+                starts.append(position)
+        reached, frames = [], []
+        for enabled in (False, True):
+            game.MOB_FLOW = enabled
+            arrived = []
+            for position in starts:
+                world.new(seed=1)
+                if not hasattr(world, "player") or world.player not in world.all_sprites:
+                    world.player = game.Player(world, home.x, home.y)
+                mob = world.spawn_mob(position.x, position.y)
+                for frame in range(chase_frames):
+                    world.player.pos = game.vec(home)
+                    world.player.health = game.PLAYER_HEALTH + len(world.mobs) * game.MOB_DAMAGE
+                    world.step()
+                    if mob.pos.distance_to(world.player.pos) < game.TILESIZE * 1.5:
+                        arrived.append(frame)
+                        break
+            reached.append(len(arrived))
+            frames.append(sum(arrived) / max(1, len(arrived)))
+        print("%-10s %10d %10d %12.0f %12.0f" % (map_name, reached[0], reached[1], frames[0], frames[1]))
+    game.MOB_FLOW = flow
+    del world.get_pressed
+    world.load_map("Map_1.tmx")
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_dirty(mob_counts=(3, 20, 100), frames=300):
+    """
+    Compare : Game.draw with full redraws against DIRTY_RECTS, the player standing still (idle) and walking (scroll).
+              Both modes run the same seeded game and must leave the same pixels on the window every frame.
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    world.draw_dirty_frames = 0
+    draw_dirty = world.draw_dirty
+    def counted(*arguments):
+        world.draw_dirty_frames += 1
+        draw_dirty(*arguments)
+    world.draw_dirty = counted
+    # Mobs hit for nothing: a dead player would freeze the scene, and the hearts of the HUD stay the same
+    mob_damage = game.MOB_DAMAGE
+    game.MOB_DAMAGE = 0
+
+    def run(dirty, mobs, walk):
+        game.DIRTY_RECTS = dirty
+        world.new(seed=1)
+        for x, y in free_positions(world.map, mobs, Random(1)):
+            world.spawn_mob(x, y)
+        keys = ScriptedKeys()
+        world.get_pressed = lambda: keys
+        world.draw_dirty_frames = 0
+        draw_time, screens = 0, []
+        for frame in range(frames):
+            if walk:
+                keys.step()
+            assert world.step() == 1
+            start = time.perf_counter()
+            world.draw()
+            draw_time += time.perf_counter() - start
+            screens.append(hash(pygame.image.tobytes(pygame.display.get_surface(), "RGB")))
+        return draw_time / frames, world.draw_dirty_frames, screens
+
+    print("Dirty rects (ms per frame)")
+    print("%-8s %-8s %10s %10s %10s %6s" % ("scene", "mobs", "full", "dirty", "partial", "same"))
+    for walk in (False, True):
+        for mobs in mob_counts:
+            full_time, partial, full_screens = run(False, mobs, walk)
+            dirty_time, partial, dirty_screens = run(True, mobs, walk)
+            print("%-8s %-8d %10.3f %10.3f %9d%% %6s" % ("scroll" if walk else "idle", mobs, full_time * 1000, dirty_time * 1000, partial * 100 // frames, full_screens == dirty_screens))
+    game.DIRTY_RECTS = False
+    game.MOB_DAMAGE = mob_damage
+    del world.get_pressed
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_stream(budgets=(game.STREAM_BUDGET, 2 * 1024 * 1024), max_frames=4000, repeat=3):
+    """
+    Compare : Frame times walking from the start of Map_2 up into the exit of Map_1, then to Map_3 and back, through their
+              open borders, with each region loaded when entered (sync) against a WorldStreamer preparing them in the
+              background (stream), with and without compiled maps. A small budget unloads the regions left behind.
+    Measure : Frame p50, p99 and max of update and draw over repeat walks, the max of the frames entering a region, where
+              a load hitches, frames over SIM_DT, stalls, evictions and the load latency and memory of each region.
+              Frames are paced to SIM_DT as the game loop would, which is the time the background loads get.
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    compile_setting = game.MAP_COMPILE
+    reports = []
+
+    def run(background, budget):
+        for name in game.WORLD_REGIONS:
+            if name != game.WORLD_START:
+                world.assets.unload(name)
+        world.world = game.WorldStreamer(world, budget=budget, background=background)
+        world.new(seed=1)
+        route = [world.world.world_pos(world.player.pos), (1056, 1104), (1056, 720), (1056, 1104), (1616, 1104)]
+        keys = WaypointKeys(world, route + route[-2::-1])
+        world.get_pressed = lambda: keys
+        times, entries = [], []
+        while not keys.done and len(times) < max_frames:
+            keys.step()
+            world.player.health = game.PLAYER_HEALTH + len(world.mobs) * game.MOB_DAMAGE
+            region = world.world.current
+            begin = time.perf_counter()
+            world.step()
+            world.draw()
+            times.append(time.perf_counter() - begin)
+            if world.world.current is not region:
+                entries.append(times[-1])
+            time.sleep(max(0, begin + game.SIM_DT - time.perf_counter()))
+        world.world.pool.shutdown()
+        return times, entries, keys
+
+    print("Stream (frame ms, %d walks of %d regions and back)" % (repeat, len(game.WORLD_REGIONS)))
+    print("%-6s %-8s %10s %8s %8s %8s %8s %8s %6s %7s %9s %8s" % ("mode", "compiled", "budget KB", "frames", "p50", "p99", "max", "entry", "over", "stalls", "evictions", "arrived"))
+    for compiled in (True, False):
+        game.MAP_COMPILE = compiled
+        for background, budget in [(False, budgets[0])] + [(True, budget) for budget in budgets]:
+            times, entries, stalls, evictions, arrived = [], [], 0, 0, True
+            for _ in range(repeat):
+                walk_times, walk_entries, keys = run(background, budget)
+                times += walk_times
+                entries += walk_entries
+                stalls += world.world.stalls
+                evictions += world.world.evictions
+                arrived = arrived and keys.done
+            result = percentiles(times)
+            streamer = world.world
+            print("%-6s %-8s %10d %8d %8.2f %8.2f %8.2f %8.2f %6d %7d %9d %8s" % ("stream" if background else "sync", compiled, budget // 1024, len(times),
+                  result["p50"], result["p99"], max(times) * 1000, max(entries) * 1000, sum(1 for frame in times if frame > game.SIM_DT),
+                  stalls, evictions, arrived))
+            if background and budget == budgets[0]:
+                reports.append(("compiled" if compiled else "parsed", streamer.report()))
+    for name, report in reports:
+        print()
+        print("Regions, stream, %s maps" % name)
+        print(report)
+    game.MAP_COMPILE = compile_setting
+    world.world = None
+    del world.get_pressed
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_vector(env_count=8, steps=200):
+    """
+    Measure : Environment steps per second with random actions, of one GameEnv stepped in this process and of
+              VectorEnvs sharding env_count environments over 1, 2, 4... workers, up to twice the cores.
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    cores = os.cpu_count() or 1
+    rng = Random(1)
+    def actions(count):
+        return [rng.getrandbits(len(game.INPUT_KEYS)) for _ in range(count)]
+
+    env = game.GameEnv(seed=1)
+    env.reset()
+    start = time.perf_counter()
+    for action in actions(steps):
+        if env.step(action)[2]:
+            env.reset()
+    single = steps / (time.perf_counter() - start)
+
+    print("Vector (%d environments, %d steps of %d updates, %d cores)" % (env_count, steps, game.ENV_REPEAT, cores))
+    print("%-10s %10s %12s %10s %10s" % ("workers", "start s", "steps/s", "speedup", "per core"))
+    print("%-10s %10s %12.0f %10s %10s" % ("in process", "-", single, "-", "-"))
+    workers, base = 1, None
+    while workers <= max(2, 2 * cores):
+        start = time.perf_counter()
+        vector = game.VectorEnv(env_count, workers, seed=1)
+        vector.reset()
+        start_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(steps):
+            vector.step(actions(env_count))
+        rate = env_count * steps / (time.perf_counter() - start)
+        vector.close()
+        base = base or rate
+        print("%-10d %10.2f %12.0f %10.2f %10.2f" % (workers, start_time, rate, rate / base, rate / base / min(workers, cores)))
+        workers *= 2
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+def bench_snapshots(entity_counts=(10, 1000, 5000), repeat=10, rollback=120):
+    """
+    Measure : Size, save and restore time of Game.snapshot with count mobs, count / 2 items and count / 4 effects,
+              against rebuilding the same game with new() and spawning the mobs again.
+    Check   : Restoring a snapshot and playing the same keys again reaches the same state (rollback),
+              restart() plays the same game as new() with the same seed (restart).
+    """
+    folder = data_folder()
+    game.DATA_FOLDER = folder
+    world = game.Game(headless=True)
+    keys = ScriptedKeys()
+    world.get_pressed = lambda: keys
+
+    def play(frames):
+        for _ in range(frames):
+            keys.step()
+            world.player.health = game.PLAYER_HEALTH + len(world.mobs) * game.MOB_DAMAGE
+            world.step()
+        return world_state(world)
+
+    def populate(count):
+        world.new(seed=1)
+        rng = Random(1)
+        positions = free_positions(world.map, count + count // 2 + count // 4, rng)
+        for x, y in positions[:count]:
+            world.spawn_mob(x, y)
+        for x, y in positions[count:count + count // 2]:
+            world.spawn(game.Item, game.vec(x, y), rng.choice(game.ITEM_DROPS))
+        for x, y in positions[count + count // 2:]:
+            world.spawn(game.Effect, game.vec(x, y), "pick_up")
+        return positions[:count]
+
+    print("Snapshots (%d saves and restores)" % repeat)
+    print("%-8s %8s %10s %8s %10s %10s %10s %9s" % ("mobs", "sprites", "bytes", "B/sprite", "save ms", "restore ms", "rebuild ms", "rollback"))
+    for count in entity_counts:
+        mobs = populate(count)
+        keys.frame = 0
+        play(30)
+        sprites = len(world.mobs) + len(world.items) + len(world.effects) + len(world.sword)
+        data = world.snapshot()
+        save_time = timed(world.snapshot, repeat)
+        restore_time = timed(lambda: world.restore(data), repeat)
+
+        def rebuild():
+            world.new(seed=1)
+            for x, y in mobs:
+                world.spawn_mob(x, y)
+        rebuild_time = timed(rebuild, repeat)
+
+        # Rollback: back to the snapshot and the same keys again
+        world.restore(data)
+        frame = keys.frame
+        played = play(rollback)
+        world.restore(data)
+        keys.frame = frame
+        replayed = play(rollback)
+        print("%-8d %8d %10d %8.1f %10.3f %10.3f %10.3f %9s" % (count, sprites, len(data), len(data) / max(1, sprites),
+              save_time * 1000, restore_time * 1000, rebuild_time * 1000, played == replayed))
+
+    # Restart after a game against a new game with the same seed
+    world.new(seed=5)
+    keys.frame = 0
+    fresh = play(300)
+    play(200)
+    world.restart(seed=5)
+    keys.frame = 0
+    restarted = play(300)
+    print("restart same as new: %s" % (fresh == restarted))
+    del world.get_pressed
+    if folder != path.join(PROJECT_FOLDER, "data"):
+        shutil.rmtree(folder)
+
+
+BENCHMARKS = {
+    "collision": bench_collision,
+    "contacts": bench_contacts,
+    "merge": bench_merge,
+    "separation": bench_separation,
+    "batch": bench_batch,
+    "chunks": bench_chunks,
+    "present": bench_present,
+    "text": bench_text,
+    "assets": bench_assets,
+    "archive": bench_archive,
+    "maps": bench_maps,
+    "headless": bench_headless,
+    "scenarios": bench_scenarios,
+    "replay": bench_replay,
+    "pools": bench_pools,
+    "audio": bench_audio,
+    "activity": bench_activity,
+    "flow": bench_flow,
+    "dirty": bench_dirty,
+    "stream": bench_stream,
+    "vector": bench_vector,
+    "snapshots": bench_snapshots,
+}
+
+if __name__ == "__main__" and sys.argv[1:2] == ["cold_start"]:
+    cold_start(*sys.argv[2:])
+elif __name__ == "__main__":
+    names = []
+    for argument in sys.argv[1:]:
+        if argument.startswith("--output="):
+            RESULTS_FILE = argument.split("=", 1)[1]
+        elif argument.startswith("--compare="):
+            BASELINE_FILE = argument.split("=", 1)[1]
+        else:
+            names.append(argument)
+    failed = []
+    for name in names or list(BENCHMARKS):
+        if BENCHMARKS[name]():
+            failed.append(name)
+        print()
+    sys.exit(1 if failed else 0)
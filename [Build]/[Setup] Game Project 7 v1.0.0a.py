@@ -1,11 +1,20 @@
 import cx_Freeze
+import importlib.util
 import os.path
 
 PYTHON_INSTALL_DIR = os.path.dirname(os.path.dirname(os.__file__))
 os.environ['TCL_LIBRARY'] = os.path.join(PYTHON_INSTALL_DIR, 'tcl', 'tcl8.6')
 os.environ['TK_LIBRARY'] = os.path.join(PYTHON_INSTALL_DIR, 'tcl', 'tk8.6')
 
-executables = [cx_Freeze.Executable("[Game Project 7] Adventurers of Elrualia v1.0.0a.py")]
+GAME_FILE = "[Game Project 7] Adventurers of Elrualia v1.0.0a.py"
+
+# Pack the graphics, sounds and sprite frames into one archive shipped in the data folder
+spec = importlib.util.spec_from_file_location("elrualia", GAME_FILE)
+game = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(game)
+game.pack_assets(os.path.join("data", game.ARCHIVE_FILE), "data")
+
+executables = [cx_Freeze.Executable(GAME_FILE)]
 
 cx_Freeze.setup(
     name="Adventurers of Elrualia",
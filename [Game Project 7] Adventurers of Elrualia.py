@@ -1,10 +1,31 @@
 import pygame
+import csv
+import hashlib
+import heapq
+import io
+import math
+import mmap
+import multiprocessing
 import os
+import re
+import struct
+import sys
+import time
+import warnings
+import zlib
 import pytmx
 import pytweening as tween
 from pygame.locals import *
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from multiprocessing.shared_memory import SharedMemory
 from os import path
-from random import choice, random
+from random import Random
+try:
+    import numpy
+except ImportError:
+    numpy = None
 vec = pygame.math.Vector2
 
 """
@@ -15,10 +36,116 @@ project_title = "Adventurers of Elrualia"
 screen_size = WIDTH, HEIGHT = 800, 600
 FPS = 60
 
+# Simulation Settings
+HEADLESS        = False         # No window, sound or drawing: the game is stepped with SIM_DT as fast as possible
+SIM_DT          = 1 / FPS       # Seconds per update when headless or stepped with Game.step()
+
+# Display Settings
+PRESENT_SMOOTH  = False         # Smooth scaling of the game to the window instead of nearest neighbour
+CAPTION_RATE    = 500           # Milliseconds between FPS updates in the window title
+TEXT_CACHE_SIZE = 128           # Rendered text surfaces kept by Text.cache
+DIRTY_RECTS     = False         # Redraw and present only the changed parts of the screen while the camera is still
+DIRTY_MAX_AREA  = 0.5           # Fraction of the screen above which a full redraw is cheaper
+
+# Input Trace Settings
+INPUT_KEYS          = [pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN, pygame.K_a, pygame.K_d, pygame.K_w, pygame.K_s, pygame.K_SPACE]
+INPUT_MAGIC         = b"ELRI"
+INPUT_VERSION       = 1
+INPUT_HEADER        = struct.Struct("<4sHQH")   # magic, version, seed, map name length
+INPUT_TICK          = struct.Struct("<dH")      # dt, pressed INPUT_KEYS bits with the paused flag on top
+INPUT_PAUSED        = 1 << 15
+
+# Profiler Settings
+PROFILER_KEY        = pygame.K_F3       # Shows the frame profiler overlay
+PROFILER_CSV_KEY    = pygame.K_F4       # Starts and stops streaming the frame samples to PROFILER_CSV
+PROFILER_CSV        = "frame_profile.csv"
+PROFILER_HISTORY    = 240               # Frames in the graph and the phase averages
+PROFILER_LABEL_RATE = 250               # Milliseconds between updates of the overlay numbers
+PROFILER_PHASES     = ["events", "update", "broadphase", "player_mobs", "player_items", "sword_mobs", "map", "hud", "sprites", "overlay", "present"]
+PROFILER_COLORS     = [(230, 25, 75), (60, 180, 75), (255, 225, 25), (0, 130, 200), (245, 130, 48), (145, 30, 180), (70, 240, 240), (240, 50, 230), (210, 245, 60), (250, 190, 190), (170, 255, 195)]
+
+# Asset Settings
+DATA_FOLDER     = "data"        # Relative to the game folder
+ASSET_WORKERS   = 4             # Threads decoding assets at startup
+ASSET_TIMINGS   = False         # Print the per-asset load timings after startup
+ARCHIVE_FILE    = "assets.pak"  # Packed assets in the data folder, built by pack_assets()
+USE_ARCHIVE     = True          # Load from the archive when it exists, otherwise from the loose files
+ARCHIVE_MAGIC   = b"ELRA"
+ARCHIVE_VERSION = 1
+ARCHIVE_HEADER  = struct.Struct("<4sHI")         # magic, version, entries
+ARCHIVE_ENTRY   = struct.Struct("<64s12sQIHHHH") # name, kind, offset, size, width, height, tile width, tile height
+
 TILESIZE    = 32
 GRIDWIDTH   = WIDTH  / TILESIZE
 GRIDHEIGHT  = HEIGHT / TILESIZE
 
+# Map Settings
+MERGE_COLLISION     = True
+WALL_GRID_MIN       = 24                    # Walls from which sprites collide through the SpatialGrid, fewer are faster scanned as a group
+MAP_CHUNK_SIZE      = 512                   # Side of a rendered map chunk in pixels
+MAP_CHUNK_MARGIN    = 128                   # Chunks this close to the view are rendered ahead
+MAP_CACHE_BUDGET    = 32 * 1024 * 1024      # Bytes of rendered chunks kept, above the chunks the view and its margin need
+MAP_COMPILE         = True                  # Keep a compiled copy of each map, loaded instead of the .tmx while up to date
+MAP_COMPILE_FOLDER  = None                  # Folder of the compiled maps, next to the .tmx files when None
+MAP_COMPILE_SUFFIX  = ".cache"
+MAP_COMPILE_MAGIC   = b"ELRM"
+MAP_COMPILE_VERSION = 1
+MAP_COMPILE_HEADER  = struct.Struct("=4sHdQ20sHHHHIIIII")  # magic, version, tmx mtime, size and sha1, columns, rows, tile size, dependencies, tiles, layers, objects, rects
+
+# World Settings
+WORLD_STREAMING = False                     # Walk between the maps of WORLD_REGIONS through their open borders, loaded by a WorldStreamer
+WORLD_START     = "Map_2.tmx"                 # Map_1 is walled in, Map_2 opens onto its exit and onto Map_3
+WORLD_REGIONS   = {"Map_1.tmx": (3, 0, 40, 24), "Map_2.tmx": (0, 24, 40, 24), "Map_3.tmx": (40, 24, 40, 24)}  # Rect of each map in world tiles
+STREAM_DISTANCE = 256                       # Regions within this of the player are loaded in the background
+STREAM_BUDGET   = 24 * 1024 * 1024          # Bytes of loaded regions kept, the furthest ones not wanted are unloaded above it
+STREAM_REPORT   = False                     # Print the load latency and memory of each region when the game quits
+
+# Environment Settings
+ENV_REPEAT          = 4             # Game updates per GameEnv step, the action is held through them
+ENV_MAX_STEPS       = 1000          # Steps before an episode is done, 0 for no limit
+ENV_MOBS            = 4             # Nearest mobs in an observation
+ENV_ITEMS           = 2             # Nearest items in an observation
+ENV_OBSERVATION     = 5 + 3 * ENV_MOBS + 3 * ENV_ITEMS      # Floats in an observation
+ENV_REWARDS         = {"coin": 1.0, "kill": 1.0, "damage": -1.0}    # Reward per coin picked up, mob killed and health lost
+ENV_START_METHOD    = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"  # Of the VectorEnv workers
+
+# Snapshot Settings
+SNAPSHOT_FILE       = "quicksave.bin"
+SNAPSHOT_SAVE_KEY   = pygame.K_F5
+SNAPSHOT_LOAD_KEY   = pygame.K_F9
+SNAPSHOT_MAGIC      = b"ELRS"
+SNAPSHOT_VERSION    = 1
+SNAPSHOT_HEADER     = struct.Struct("<4sHdQ?IiiHIIII")  # magic, version, ticks, seed, playing, activity frame, camera, map name length, mobs, items, effects, swords
+SNAPSHOT_RANDOM     = struct.Struct("<625Id")           # Mersenne Twister words and index, gauss_next or NaN
+SNAPSHOT_PLAYER     = struct.Struct("<5ddIdBBd")        # pos, vel, rot, health, coin, last_slash, index, direction, current_time
+SNAPSHOT_MOB        = struct.Struct("<7ddBBdB4h")       # pos, vel, acc, rot, health, index, direction, current_time, activity phase, mob grid and activity cells
+SNAPSHOT_ITEM       = struct.Struct("<2dBdb")           # pos, type in ITEM_IMAGES, bobbing step and direction
+SNAPSHOT_EFFECT     = struct.Struct("<2dBBd")           # pos, type in EFFECT_IMAGES, index, current_time
+SNAPSHOT_SWORD      = struct.Struct("<5d?d")            # pos, vel, rot, hit, spawn_time
+
+# Collision Settings
+COLLISION_CELL   = 64           # Side of a broadphase cell in pixels
+COLLISION_PAIRS  = [("player", "mob"), ("reach", "item"), ("sword", "mob")]  # Hitbox categories tested against each other
+COLLISION_DIRECT = 512          # Hitboxes up to which the broadphase tests the pairs directly, without building its grid
+
+# Pool Settings
+POOL_SPRITES    = True          # Reuse killed swords, effects and items instead of building new sprites
+POOL_REPORT     = False         # Print the pool counters when the game quits
+
+# Audio Settings
+AUDIO_FREQUENCY = 44100
+AUDIO_SIZE      = -16
+AUDIO_STEREO    = 2
+AUDIO_BUFFER    = 2048          # Samples per mixer buffer: lower for less latency, raise if the sound crackles
+AUDIO_REPORT    = False         # Print the played, suppressed and stolen sounds when the game quits
+AUDIO_GROUPS    = {"voice": 2, "sword": 3, "effect": 3}   # Mixer channels reserved for each group of sounds
+AUDIO_SOUNDS    = {                                     # Group, priority, cooldown in ms and most instances at once
+    "player_damage":    ("voice",  3, 200, 1),
+    "player_attack":    ("voice",  2, 0,   1),
+    "sword":            ("sword",  2, 50,  2),
+    "pick_up":          ("effect", 1, 30,  2),
+}
+
 # Player Settings
 PLAYER_IMG      = "character_pipoya_male_01_2.png"
 PLAYER_INDEX    = 1
@@ -35,6 +162,16 @@ MOB_DAMAGE      = 1
 MOB_KNOCKBACK   = 20
 MOB_RADIUS      = 30
 DETECT_RADIUS   = 300
+MOB_BATCH       = False         # Simulate mobs with NumPy arrays (MobBatch), needs numpy. Runs without MOB_LOD and MOB_FLOW,
+                                # holds 60 FPS up to about 1500 mobs, 5000 take about 85 ms a frame
+MOB_LOD         = True          # Update mobs by distance to the player with an ActivityScheduler, distant mobs sleep
+LOD_FULL_MARGIN = 64            # Mobs within DETECT_RADIUS plus this update every frame
+LOD_MIDDLE      = 640           # Mobs within this of the player, or near the view, update every LOD_MIDDLE_RATE frames
+LOD_MIDDLE_RATE = 4
+LOD_REGION      = 128           # Side of the activity regions the mobs are indexed by
+MOB_FLOW        = True          # Mobs chasing the player follow a FlowField around the walls
+FLOW_RADIUS     = 24            # Tiles searched from the player's tile, further mobs steer straight at the player
+FLOW_BUDGET     = 4096          # Tiles searched per frame, a larger search goes on over the next frames
 
 # Sword Settings
 SWORD_IMG       = "Sword_PixelHole_x2.png"
@@ -46,6 +183,13 @@ SWORD_LIFETIME  = 300
 SWORD_RATE      = 500
 SWORD_OFFSET    = vec(20, 0)
 
+# Animation Settings
+DIRECTION_BOTTOM    = 0         # Rows of the character tile tables
+DIRECTION_LEFT      = 1
+DIRECTION_RIGHT     = 2
+DIRECTION_TOP       = 3
+SWORD_ANGLES        = [-180, -90, 0, 90]   # Sword image rotations for the four player facings (rot - 90)
+
 # Tweening
 BOB_RANGE = 10
 BOB_SPEED = 0.3
@@ -114,10 +258,9 @@ def update_time_dependent(sprite):
     if sprite.current_time >= sprite.animation_time:
         sprite.current_time = 0
         sprite.index = (sprite.index + 1) % len(sprite.images)
-        sprite.image = sprite.images[sprite.index]
-    sprite.rect = sprite.image.get_rect()
+    sprite.image = sprite.images[sprite.index]
+    sprite.rect.size = sprite.image.get_size()
     sprite.rect.center = sprite.pos
-    sprite.image = pygame.transform.rotate(sprite.image, 0)
 
 def update_bobbing(sprite):
     offset = BOB_RANGE * (sprite.tween(sprite.step / BOB_RANGE) - 0.5)
@@ -128,27 +271,256 @@ def update_bobbing(sprite):
         sprite.dir *= -1
 
 
-def draw_health(self):
-    if 100*self.health/self.maxhealth > 60:
+def draw_health_bar(surface, health, maxhealth):
+    if 100*health/maxhealth > 60:
         color = GREEN
-    elif 100*self.health/self.maxhealth > 30:
+    elif 100*health/maxhealth > 30:
         color = YELLOW
     else:
         color = RED
-    if self.health < 0:
-        self.health = 0
-    width = int(self.rect.width * self.health/self.maxhealth)
-    pygame.draw.rect(self.image, color, pygame.Rect(0, 0, width, 7))
+    width = int(surface.get_width() * health/maxhealth)
+    pygame.draw.rect(surface, color, pygame.Rect(0, 0, width, 7))
+
+def health_frames(tile_table, maxhealth):
+    """
+    Frames  : Copies of every frame of tile_table with the health bar painted for each health value.
+    Return  : frames[health][row][column] for health in 0..maxhealth.
+    """
+    frames = []
+    for health in range(maxhealth + 1):
+        table = []
+        for line in tile_table:
+            row = []
+            for image in line:
+                image = image.copy()
+                draw_health_bar(image, health, maxhealth)
+                row.append(image)
+            table.append(row)
+        frames.append(table)
+    return frames
 
 
 
 def text_interface():
-    font = pygame.font.SysFont(None, 32)
+    font = get_font(None, 32, sysfont=True)
     color = WHITE
     return font, color
 
 
 
+fonts = {}
+def get_font(name, size, sysfont=False):
+    """
+    Font    : Loaded once per (name, size), pygame.font.SysFont if sysfont else pygame.font.Font.
+    """
+    key = name, size, sysfont
+    font = fonts.get(key)
+    if font is None:
+        if sysfont:
+            font = pygame.font.SysFont(name, size)
+        else:
+            font = pygame.font.Font(name, size)
+        fonts[key] = font
+    return font
+
+
+
+class TextCache():
+    def __init__(self, size):
+        """
+        Cache   : Rendered text surfaces by key, least recently used first out once more than size are kept.
+        """
+        self.size       = size
+        self.surfaces   = OrderedDict()
+        self.hits       = 0
+        self.misses     = 0
+
+    def get(self, key, render):
+        surface = self.surfaces.get(key)
+        if surface is not None:
+            self.surfaces.move_to_end(key)
+            self.hits += 1
+            return surface
+        surface = render()
+        self.surfaces[key] = surface
+        self.misses += 1
+        if len(self.surfaces) > self.size:
+            self.surfaces.popitem(last=False)
+        return surface
+
+
+
+class InputState():
+    def __init__(self, bits=0):
+        """
+        State   : Keyboard state of INPUT_KEYS as bits, indexed by key like pygame.key.get_pressed().
+        """
+        self.bits = bits
+
+    def __getitem__(self, key):
+        if key in INPUT_KEYS:
+            return bool(self.bits & (1 << INPUT_KEYS.index(key)))
+        return False
+
+
+class InputRecorder():
+    def __init__(self, filename, map_name, seed):
+        """
+        Trace   : Map, RNG seed, then the dt, keys and pause of every tick, saved zlib compressed to filename by close().
+        """
+        self.filename   = filename
+        self.map_name   = map_name
+        self.seed       = seed
+        self.ticks      = bytearray()
+        self.count      = 0
+
+    def add(self, dt, keys, paused):
+        bits = INPUT_PAUSED if paused else 0
+        for index, key in enumerate(INPUT_KEYS):
+            if keys[key]:
+                bits |= 1 << index
+        self.ticks += INPUT_TICK.pack(dt, bits)
+        self.count += 1
+
+    def close(self):
+        name = self.map_name.encode("utf-8")
+        with open(self.filename, "wb") as file:
+            file.write(INPUT_HEADER.pack(INPUT_MAGIC, INPUT_VERSION, self.seed, len(name)) + name)
+            file.write(zlib.compress(bytes(self.ticks)))
+
+
+class InputReplay():
+    def __init__(self, filename):
+        """
+        Replay  : Trace written by InputRecorder, read back one tick at a time by next().
+        """
+        with open(filename, "rb") as file:
+            data = file.read()
+        magic, version, self.seed, length = INPUT_HEADER.unpack_from(data, 0)
+        if magic != INPUT_MAGIC or version != INPUT_VERSION:
+            raise ValueError("%s is not a version %d input trace" % (filename, INPUT_VERSION))
+        self.map_name   = data[INPUT_HEADER.size:INPUT_HEADER.size + length].decode("utf-8")
+        self.ticks      = zlib.decompress(data[INPUT_HEADER.size + length:])
+        self.count      = len(self.ticks) // INPUT_TICK.size
+        self.tick       = 0
+        self.keys       = InputState()
+
+    def next(self):
+        # dt and paused of the next tick, None once the trace is over
+        if self.tick >= self.count:
+            return None
+        dt, bits = INPUT_TICK.unpack_from(self.ticks, self.tick * INPUT_TICK.size)
+        self.tick += 1
+        self.keys.bits = bits & ~INPUT_PAUSED
+        return dt, bool(bits & INPUT_PAUSED)
+
+
+def unpack_records(record, data, offset, count):
+    # count records of the struct record from offset in data, and the offset after them
+    return [record.unpack_from(data, offset + index * record.size) for index in range(count)], offset + count * record.size
+
+
+class FrameProfiler():
+    def __init__(self, history=PROFILER_HISTORY):
+        """
+        Profiler : Time spent in each of PROFILER_PHASES per frame, kept for the last history frames.
+        Laps     : begin() starts a frame, lap(phase) charges the time since the previous lap to phase, end() stores the frame.
+                   All three return at once while the profiler is off, or until the first begin() after it is turned on.
+        CSV      : Every frame is written to the CSV file while streaming.
+        """
+        self.enabled    = False
+        self.overlay    = False
+        self.frames     = deque(maxlen=history)
+        self.phases     = dict((phase, 0) for phase in PROFILER_PHASES)
+        self.frame      = 0
+        self.start      = None
+        self.last       = 0
+        self.csv_file   = None
+        self.csv_writer = None
+        self.panel      = None
+        self.panel_time = 0
+
+    def toggle_overlay(self):
+        self.overlay = not self.overlay
+        self.set_enabled()
+
+    def toggle_csv(self, filename=PROFILER_CSV):
+        if self.csv_file is None:
+            self.csv_file = open(filename, "w", newline="")
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(["frame", "time", "total"] + PROFILER_PHASES)
+        else:
+            self.csv_file.close()
+            self.csv_file = self.csv_writer = None
+        self.set_enabled()
+
+    def set_enabled(self):
+        # A frame begun while off is not recorded, its laps would hold the time the profiler was off
+        enabled = self.overlay or self.csv_file is not None
+        if enabled and not self.enabled:
+            self.start = None
+        self.enabled = enabled
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self.start = self.last = time.perf_counter()
+        for phase in self.phases:
+            self.phases[phase] = 0
+
+    def lap(self, phase):
+        if not self.enabled or self.start is None:
+            return
+        now = time.perf_counter()
+        self.phases[phase] += now - self.last
+        self.last = now
+
+    def end(self):
+        if not self.enabled or self.start is None:
+            return
+        total = self.last - self.start
+        sample = [self.phases[phase] for phase in PROFILER_PHASES]
+        self.frames.append((total, sample))
+        self.frame += 1
+        if self.csv_writer is not None:
+            self.csv_writer.writerow([self.frame, "%.6f" % self.start, "%.3f" % (total * 1000)] + ["%.3f" % (value * 1000) for value in sample])
+
+    def draw(self, surface):
+        """
+        Overlay : Rolling graph of the frame times against the frame budget, and a bar per phase with its average.
+        """
+        if not self.overlay or not self.frames:
+            return
+        budget = 1000 / FPS
+        graph = pygame.Rect(10, HEIGHT - 110, PROFILER_HISTORY, 100)
+        pygame.draw.rect(surface, BLACK, graph)
+        for x, (total, sample) in enumerate(self.frames):
+            height = min(graph.height, int(total * 1000 / (2 * budget) * graph.height))
+            color = GREEN if total * 1000 <= budget else RED
+            pygame.draw.line(surface, color, (graph.left + x, graph.bottom - 1), (graph.left + x, graph.bottom - height))
+        pygame.draw.line(surface, YELLOW, (graph.left, graph.centery), (graph.right - 1, graph.centery))
+
+        # Phase averages, redrawn at PROFILER_LABEL_RATE
+        now = pygame.time.get_ticks()
+        if self.panel is None or now - self.panel_time >= PROFILER_LABEL_RATE:
+            self.panel_time = now
+            font = get_font(None, 18)
+            count = len(self.frames)
+            averages = [sum(sample[index] for total, sample in self.frames) / count * 1000 for index in range(len(PROFILER_PHASES))]
+            average_total = sum(total for total, sample in self.frames) / count * 1000
+            worst = max(total for total, sample in self.frames) * 1000
+            self.panel = pygame.Surface((240, 16 * (len(PROFILER_PHASES) + 1) + 4))
+            self.panel.fill(BLACK)
+            self.panel.blit(font.render("frame %.2f ms  worst %.2f ms" % (average_total, worst), True, WHITE), (4, 2))
+            for index, phase in enumerate(PROFILER_PHASES):
+                y = 16 * (index + 1) + 2
+                width = int(min(1, averages[index] / budget) * 100)
+                pygame.draw.rect(self.panel, PROFILER_COLORS[index], (130, y + 2, max(1, width), 10))
+                self.panel.blit(font.render("%s %.2f" % (phase, averages[index]), True, WHITE), (4, y))
+        surface.blit(self.panel, (graph.right + 10, HEIGHT - 10 - self.panel.get_height()))
+
+
+
 def load_file(path, image=False):
     """
     Load    : All texts/images in directory. The directory must only contain texts/images.
@@ -172,8 +544,39 @@ def load_image(image_path, image_list):
 
 
 
+class AnimationAtlas():
+    def __init__(self):
+        """
+        Tables    : Animation frames by name, nested lists built once (variant, direction, frame...).
+        Rotations : Rotated copies of an image by (name, angle), the given angles built up front.
+        """
+        self.tables     = {}
+        self.images     = {}
+        self.rotations  = {}
+
+    def add_table(self, name, table):
+        self.tables[name] = table
+
+    def add_rotations(self, name, image, angles):
+        self.images[name] = image
+        for angle in angles:
+            self.rotated(name, angle)
+
+    def rotated(self, name, angle):
+        key = name, angle
+        image = self.rotations.get(key)
+        if image is None:
+            image = pygame.transform.rotate(self.images[name], angle)
+            self.rotations[key] = image
+        return image
+
+
+
 def load_tile_table(filename, width, height, colorkey=(0,0,0)):
-    image = pygame.image.load(filename).convert()
+    return slice_tile_table(pygame.image.load(filename), width, height, colorkey)
+
+def slice_tile_table(image, width, height, colorkey=(0,0,0)):
+    image = image.convert()
     image.set_colorkey(colorkey)
     image_width, image_height = image.get_size()
     tile_table = []
@@ -187,50 +590,1212 @@ def load_tile_table(filename, width, height, colorkey=(0,0,0)):
 
 
 
+class AssetManager():
+    def __init__(self, workers=ASSET_WORKERS, archive=None):
+        """
+        Manifest : Assets by name with their kind and file, added with add().
+        Load     : Files are decoded in a thread pool, the display dependent convert() runs on the main thread.
+        Archive  : Assets packed in the AssetArchive are decoded from it instead of their loose file.
+        Lazy     : Lazy assets are only loaded by the first get().
+        Timings  : Seconds spent decoding and finishing each asset, see report().
+        """
+        self.archive    = archive
+        self.manifest   = OrderedDict()
+        self.assets     = {}
+        self.futures    = {}
+        self.timings    = OrderedDict()
+        self.pool       = ThreadPoolExecutor(max_workers=workers)
+        self.load_time  = 0
+
+    def add(self, name, kind, filename, lazy=False):
+        self.manifest[name] = kind, filename, lazy
+
+    def submit(self, name):
+        if name not in self.futures and name not in self.assets:
+            kind, filename, lazy = self.manifest[name]
+            packed = self.archive.entry(name) if self.archive is not None and name in self.archive else None
+            self.futures[name] = self.pool.submit(decode_asset, kind, filename, packed)
+
+    def finish(self, name):
+        kind, filename, lazy = self.manifest[name]
+        data, decode_time = self.futures.pop(name).result()
+        start = time.perf_counter()
+        self.assets[name] = finish_asset(kind, filename, data)
+        self.timings[name] = decode_time, time.perf_counter() - start
+        return self.assets[name]
+
+    def load(self, progress=None, lazy=False):
+        start = time.perf_counter()
+        names = [name for name, (kind, filename, is_lazy) in self.manifest.items() if (lazy or not is_lazy) and name not in self.assets]
+        for name in names:
+            self.submit(name)
+        pending = dict((self.futures[name], name) for name in names)
+        for done, future in enumerate(as_completed(pending), 1):
+            name = pending[future]
+            self.finish(name)
+            if progress:
+                progress(done, len(names), name)
+        self.load_time += time.perf_counter() - start
+
+    def get(self, name):
+        if name not in self.assets:
+            self.submit(name)
+            self.finish(name)
+        return self.assets[name]
+
+    def unload(self, name):
+        # Loaded again by the next submit() or get()
+        self.assets.pop(name, None)
+
+    def report(self):
+        lines = ["%-50s %10s %10s" % ("asset", "decode ms", "finish ms")]
+        for name, (decode_time, finish_time) in sorted(self.timings.items(), key=lambda item: -sum(item[1])):
+            lines.append("%-50s %10.2f %10.2f" % (name, decode_time * 1000, finish_time * 1000))
+        lines.append("%d assets loaded in %.2f ms" % (len(self.timings), self.load_time * 1000))
+        return "\n".join(lines)
+
+
+class AssetGroup(dict):
+    def __init__(self, assets, names):
+        """
+        Group   : Lists of assets by key, each list loaded from the AssetManager on its first lookup.
+        """
+        dict.__init__(self)
+        self.assets = assets
+        self.names  = names
+
+    def __missing__(self, key):
+        value = [self.assets.get(name) for name in self.names[key]]
+        self[key] = value
+        return value
+
+
+class AssetArchive():
+    def __init__(self, filename):
+        """
+        Archive : One memory-mapped file holding the assets written by pack_assets().
+        Index   : Header and entries at the start of the file, read straight from the map.
+        Entries : Raw RGBA pixels for images, RGB frames for tile tables and the file bytes for sounds.
+        """
+        self.filename   = filename
+        self.file       = open(filename, "rb")
+        self.buffer     = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view       = memoryview(self.buffer)
+
+        magic, version, count = ARCHIVE_HEADER.unpack_from(self.buffer, 0)
+        if magic != ARCHIVE_MAGIC or version != ARCHIVE_VERSION:
+            raise ValueError("%s is not a version %d asset archive" % (filename, ARCHIVE_VERSION))
+        self.index = {}
+        end = ARCHIVE_HEADER.size + count * ARCHIVE_ENTRY.size
+        for name, kind, offset, size, width, height, tile_width, tile_height in ARCHIVE_ENTRY.iter_unpack(self.view[ARCHIVE_HEADER.size:end]):
+            self.index[name.rstrip(b"\0").decode()] = kind.rstrip(b"\0").decode(), offset, size, width, height, tile_width, tile_height
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def entry(self, name):
+        kind, offset, size, width, height, tile_width, tile_height = self.index[name]
+        return kind, self.view[offset:offset + size], (width, height), (tile_width, tile_height)
+
+
+def pack_assets(filename, data_folder):
+    """
+    Build   : Packs the assets of asset_manifest() into an AssetArchive.
+    Loose   : Maps stay next to their tilesets and the music is streamed from its file.
+    """
+    assets = AssetManager(workers=1)
+    asset_manifest(assets, data_folder)
+    entries = []
+    for name, (kind, source, lazy) in assets.manifest.items():
+        size = tile_size = (0, 0)
+        if kind == "image":
+            image = pygame.image.load(source)
+            size, data = image.get_size(), pygame.image.tobytes(image, "RGBA")
+        elif kind == "tile_table":
+            image = pygame.image.load(source)
+            size, tile_size = image.get_size(), (32, 32)
+            frames = []
+            for tile_y in range(size[1] // tile_size[1]):
+                for tile_x in range(size[0] // tile_size[0]):
+                    rect = (tile_x*tile_size[0], tile_y*tile_size[1], tile_size[0], tile_size[1])
+                    frames.append(pygame.image.tobytes(image.subsurface(rect), "RGB"))
+            data = b"".join(frames)
+        elif kind == "sound":
+            with open(source, "rb") as file:
+                data = file.read()
+        else:
+            continue
+        entries.append((name, kind, data, size, tile_size))
+
+    offset = ARCHIVE_HEADER.size + len(entries) * ARCHIVE_ENTRY.size
+    with open(filename, "wb") as file:
+        file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, len(entries)))
+        for name, kind, data, size, tile_size in entries:
+            file.write(ARCHIVE_ENTRY.pack(name.encode(), kind.encode(), offset, len(data), size[0], size[1], tile_size[0], tile_size[1]))
+            offset += len(data)
+        for name, kind, data, size, tile_size in entries:
+            file.write(data)
+    return len(entries)
+
+
+def decode_packed(kind, packed):
+    # Worker thread: surfaces and sounds read from the archive buffer, without opening or decoding a file
+    kind, data, size, tile_size = packed
+    if kind == "image":
+        return pygame.image.frombuffer(data, size, "RGBA")
+    if kind == "tile_table":
+        frame_size = tile_size[0] * tile_size[1] * 3
+        columns, rows = size[0] // tile_size[0], size[1] // tile_size[1]
+        return [[pygame.image.frombuffer(data[(y*columns + x) * frame_size:(y*columns + x + 1) * frame_size], tile_size, "RGB") for x in range(columns)] for y in range(rows)]
+    if kind == "sound":
+        return pygame.mixer.Sound(file=io.BytesIO(data))
+
+def decode_asset(kind, filename, packed=None):
+    # Worker thread: everything that does not need the display
+    start = time.perf_counter()
+    if packed is not None:
+        data = decode_packed(kind, packed)
+    elif kind in ("image", "tile_table"):
+        data = pygame.image.load(filename)
+    elif kind == "sound":
+        data = pygame.mixer.Sound(filename)
+    elif kind == "map":
+        data = decode_map(filename)
+    else:
+        data = None
+    return data, time.perf_counter() - start
+
+def finish_asset(kind, filename, data):
+    # Main thread: conversion to the display format
+    if kind == "image":
+        return data.convert_alpha()
+    if kind == "tile_table" and isinstance(data, list):
+        return [[convert_frame(frame) for frame in line] for line in data]
+    if kind == "tile_table":
+        return slice_tile_table(data, 32, 32)
+    if kind == "map":
+        return Map(filename, data)
+    if kind == "music":
+        pygame.mixer.music.load(filename)
+        return filename
+    return data
+
+def convert_frame(frame, colorkey=(0,0,0)):
+    frame = frame.convert()
+    frame.set_colorkey(colorkey)
+    return frame
+
+def decode_map(filename):
+    """
+    Decode  : The compiled map when it is up to date, otherwise the TMX parsed without images and its tileset images decoded.
+              Either is ready for Map(filename, decoded).
+    """
+    if MAP_COMPILE:
+        compiled = read_compiled_map(filename)
+        if compiled is not None:
+            return compiled, None
+    tmxdata = pytmx.TiledMap(filename)
+    images = {}
+    for tileset in tmxdata.tilesets:
+        if tileset.source is not None:
+            image_path = path.join(path.dirname(tmxdata.filename), tileset.source)
+            images[image_path] = pygame.image.load(image_path)
+    return tmxdata, images
+
+def decoded_image_loader(images, loaded=None):
+    # pytmx image loader using already decoded tileset images, see pytmx.util_pygame.pygame_image_loader
+    # The image files it reads are added to the loaded set
+    def image_loader(filename, colorkey, **kwargs):
+        if colorkey:
+            colorkey = pygame.Color("#{0}".format(colorkey))
+        pixelalpha = kwargs.get("pixelalpha", True)
+        image = images.get(filename)
+        if image is None:
+            image = pygame.image.load(filename)
+
+        def load_tile(rect=None, flags=None):
+            tile = image.subsurface(rect) if rect else image.copy()
+            if flags:
+                tile = pytmx.util_pygame.handle_transformation(tile, flags)
+            tile = pytmx.util_pygame.smart_convert(tile, colorkey, pixelalpha)
+            if loaded is not None:
+                loaded.add(filename)
+            return tile
+        return load_tile
+    return image_loader
+
+
+class CompiledMap():
+    def __init__(self):
+        """
+        Compiled : A map read back from its compiled file, see write_compiled_map for the layout.
+        Tiles    : Unconverted tile surfaces by gid, with the conversion pytmx chose for each.
+        """
+        self.columns    = 0
+        self.rows       = 0
+        self.tilewidth  = 0
+        self.tileheight = 0
+        self.tiles      = {}
+        self.layers     = []
+        self.objects    = []
+        self.rects      = []
+
+
+def compiled_map_file(filename):
+    folder = MAP_COMPILE_FOLDER or path.dirname(filename)
+    return path.join(folder, path.basename(filename) + MAP_COMPILE_SUFFIX)
+
+def map_dependencies(filename, images):
+    # External tilesets and tileset images the map is built from
+    with open(filename, "rb") as file:
+        text = file.read().decode("utf-8")
+    folder = path.dirname(filename)
+    files = [path.normpath(path.join(folder, source)) for source in re.findall(r'<tileset[^>]*source="([^"]+)"', text)]
+    files.extend(path.normpath(image) for image in images)
+    return sorted(set(files))
+
+def write_compiled_map(map, filename, dependencies):
+    """
+    Layout  : Header, then the dependencies (mtime, path), the tiles (gid, size, conversion, colorkey, RGBA pixels),
+              the layers (visible, name, gid array), the objects (rect, name) and the merged collision rectangles.
+              Native byte order: the file is only read back on the machine that wrote it.
+    """
+    with open(filename, "rb") as file:
+        data = file.read()
+    parts = []
+    folder = path.dirname(filename)
+    for dependency in dependencies:
+        name = path.relpath(dependency, folder).encode("utf-8")
+        parts.append(struct.pack("=dH", os.stat(dependency).st_mtime, len(name)) + name)
+    tiles = [(gid, image) for gid, image in enumerate(map.images) if image]
+    for gid, image in tiles:
+        if image.get_colorkey() is not None:
+            mode, colorkey = 1, tuple(image.get_colorkey())
+        else:
+            mode, colorkey = (2 if image.get_flags() & SRCALPHA else 0), (0, 0, 0, 0)
+        parts.append(struct.pack("=IHHB4B", gid, image.get_width(), image.get_height(), mode, *colorkey))
+        parts.append(pygame.image.tobytes(image, "RGBA"))
+    for name, visible, gids in map.layers:
+        name = name.encode("utf-8")
+        parts.append(struct.pack("=BH", visible, len(name)) + name + gids.tobytes())
+    for name, x, y, width, height in map.objects:
+        name = name.encode("utf-8")
+        parts.append(struct.pack("=ffffH", x, y, width, height, len(name)) + name)
+    rects = map.collision_rects(merge=True)
+    parts.append(array("H", [value for rect in rects for value in rect]).tobytes())
+
+    header = MAP_COMPILE_HEADER.pack(MAP_COMPILE_MAGIC, MAP_COMPILE_VERSION, os.stat(filename).st_mtime, len(data), hashlib.sha1(data).digest(),
+                                     map.columns, map.rows, map.tilewidth, map.tileheight,
+                                     len(dependencies), len(tiles), len(map.layers), len(map.objects), len(rects))
+    compiled_file = compiled_map_file(filename)
+    with open(compiled_file + ".tmp", "wb") as file:
+        file.write(header + b"".join(parts))
+    os.replace(compiled_file + ".tmp", compiled_file)
+
+def read_compiled_map(filename):
+    """
+    Read    : The compiled map of filename, or None when it is missing or stale.
+    Stale   : The .tmx changed (mtime, or size and sha1 when only the mtime moved) or a dependency changed its mtime.
+    """
+    try:
+        with open(compiled_map_file(filename), "rb") as file:
+            data = file.read()
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    if len(data) < MAP_COMPILE_HEADER.size:
+        return None
+    (magic, version, mtime, size, digest, columns, rows, tilewidth, tileheight,
+     dependencies, tiles, layers, objects, rects) = MAP_COMPILE_HEADER.unpack_from(data, 0)
+    if magic != MAP_COMPILE_MAGIC or version != MAP_COMPILE_VERSION:
+        return None
+    if stat.st_mtime != mtime:
+        with open(filename, "rb") as file:
+            source = file.read()
+        if len(source) != size or hashlib.sha1(source).digest() != digest:
+            return None
+
+    offset = MAP_COMPILE_HEADER.size
+    folder = path.dirname(filename)
+    for _ in range(dependencies):
+        mtime, length = struct.unpack_from("=dH", data, offset)
+        offset += 10
+        dependency = path.join(folder, data[offset:offset + length].decode("utf-8"))
+        offset += length
+        if not path.isfile(dependency) or os.stat(dependency).st_mtime != mtime:
+            return None
+
+    compiled = CompiledMap()
+    compiled.columns, compiled.rows = columns, rows
+    compiled.tilewidth, compiled.tileheight = tilewidth, tileheight
+    for _ in range(tiles):
+        gid, width, height, mode, r, g, b, a = struct.unpack_from("=IHHB4B", data, offset)
+        offset += 13
+        image = pygame.image.frombuffer(data[offset:offset + width * height * 4], (width, height), "RGBA")
+        offset += width * height * 4
+        compiled.tiles[gid] = image, mode, (r, g, b, a)
+    for _ in range(layers):
+        visible, length = struct.unpack_from("=BH", data, offset)
+        offset += 3
+        name = data[offset:offset + length].decode("utf-8")
+        offset += length
+        gids = array("I")
+        gids.frombytes(data[offset:offset + columns * rows * gids.itemsize])
+        offset += columns * rows * gids.itemsize
+        compiled.layers.append((name, bool(visible), gids))
+    for _ in range(objects):
+        x, y, width, height, length = struct.unpack_from("=ffffH", data, offset)
+        offset += 18
+        compiled.objects.append((data[offset:offset + length].decode("utf-8"), x, y, width, height))
+        offset += length
+    values = array("H")
+    values.frombytes(data[offset:offset + rects * 4 * values.itemsize])
+    compiled.rects = [tuple(values[i:i + 4]) for i in range(0, len(values), 4)]
+    return compiled
+
+def convert_tile(image, mode, colorkey):
+    # Same conversions as pytmx.util_pygame.smart_convert
+    if mode == 1:
+        tile = image.convert()
+        tile.set_colorkey(colorkey, pygame.RLEACCEL)
+        return tile
+    if mode == 2:
+        return image.convert_alpha()
+    return image.convert()
+
+def asset_manifest(assets, data_folder):
+    graphics_folder     = path.join(data_folder, "graphics")
+    map_folder          = path.join(data_folder, "map")
+    sfx_folder          = path.join(data_folder, "sfx")
+    voice_folder        = path.join(data_folder, "voice")
+    music_folder        = path.join(data_folder, "music")
+
+    # Maps
+    assets.add("Map_1.tmx", "map", path.join(map_folder, "Map_1.tmx"))
+    for map_name in ["Map_2.tmx", "Map_3.tmx"]:
+        assets.add(map_name, "map", path.join(map_folder, map_name), lazy=True)
+
+    # Graphics
+    for image in [PLAYER_IMG, MOB_IMG]:
+        assets.add(image, "tile_table", path.join(graphics_folder, image))
+    for image in [IMAGE_HEART, IMAGE_COIN, SWORD_IMG]:
+        assets.add(image, "image", path.join(graphics_folder, image))
+    for images in list(ITEM_IMAGES.values()) + list(EFFECT_IMAGES.values()):
+        for image in images:
+            assets.add(image, "image", path.join(graphics_folder, image))
+
+    # Sounds
+    for sound in [SOUNDS_PICK_UP] + SOUNDS_SWORD_ATTACK:
+        assets.add(sound, "sound", path.join(sfx_folder, sound))
+    for voice in VOICE_PLAYER_ATTACK + VOICE_PLAYER_DAMAGE:
+        assets.add(voice, "sound", path.join(voice_folder, voice), lazy=True)
+    assets.add(BG_MUSIC, "music", path.join(music_folder, BG_MUSIC))
+
+
+
 def collide_with_walls(sprite, group, dir):
     if dir == "x":
-        hits = pygame.sprite.spritecollide(sprite, group, False, collide_hit_rect)
+        hits = wall_hits(sprite, group)
         if hits:
-            if hits[0].rect.centerx > sprite.hit_rect.centerx:
-                sprite.pos.x = hits[0].rect.left - sprite.hit_rect.width / 2
-            if hits[0].rect.centerx < sprite.hit_rect.centerx:
-                sprite.pos.x = hits[0].rect.right + sprite.hit_rect.width / 2
+            wall = wall_tile(hits, sprite.hit_rect)
+            if wall.centerx > sprite.hit_rect.centerx:
+                sprite.pos.x = wall.left - sprite.hit_rect.width / 2
+            if wall.centerx < sprite.hit_rect.centerx:
+                sprite.pos.x = wall.right + sprite.hit_rect.width / 2
             sprite.vel.x = 0
             sprite.hit_rect.centerx = sprite.pos.x
 
     if dir == "y":
-        hits = pygame.sprite.spritecollide(sprite, group, False, collide_hit_rect)
+        hits = wall_hits(sprite, group)
         if hits:
-            if hits[0].rect.centery > sprite.hit_rect.centery:
-                sprite.pos.y = hits[0].rect.top - sprite.hit_rect.height / 2
-            if hits[0].rect.centery < sprite.hit_rect.centery:
-                sprite.pos.y = hits[0].rect.bottom + sprite.hit_rect.height / 2
+            wall = wall_tile(hits, sprite.hit_rect)
+            if wall.centery > sprite.hit_rect.centery:
+                sprite.pos.y = wall.top - sprite.hit_rect.height / 2
+            if wall.centery < sprite.hit_rect.centery:
+                sprite.pos.y = wall.bottom + sprite.hit_rect.height / 2
             sprite.vel.y = 0
             sprite.hit_rect.centery = sprite.pos.y
 
 def collide_hit_rect(one, two):
     return one.hit_rect.colliderect(two.rect)
 
+def wall_index(walls, grid):
+    # Walls the sprites collide with: the grid, or the group while it has too few walls for the grid to pay
+    return grid if len(walls) >= WALL_GRID_MIN else walls
+
+def wall_hits(sprite, walls):
+    if isinstance(walls, SpatialGrid):
+        return walls.spritecollide(sprite, collide_hit_rect)
+    return pygame.sprite.spritecollide(sprite, walls, False, collide_hit_rect)
+
+def wall_tile(hits, hit_rect):
+    """
+    Tile    : The first tile in row-major order covered by both the hit walls and hit_rect.
+              Merged walls resolve against the same tile a wall made of one Obstacle per tile would.
+    """
+    if len(hits) == 1 and hits[0].columns == 1 and hits[0].rows == 1:
+        return hits[0].rect
+    first = None
+    for wall in hits:
+        row     = max(wall.rect.top,  hit_rect.top)  // wall.tile_h
+        column  = max(wall.rect.left, hit_rect.left) // wall.tile_w
+        if first is None or (row, column) < first[:2]:
+            first = row, column, wall
+    row, column, wall = first
+    return pygame.Rect(column * wall.tile_w, row * wall.tile_h, wall.tile_w, wall.tile_h)
+
+
+
+def merge_tiles(tiles):
+    """
+    Merge   : Greedy merge of solid tiles into axis-aligned rectangles.
+              Each rectangle grows along its row first, then downwards while the whole run stays solid.
+    Tiles   : Iterable of (x, y) tile coordinates.
+    Return  : List of (x, y, columns, rows) in tile units.
+    """
+    solid = set(tiles)
+    rects = []
+    for x, y in sorted(solid, key=lambda tile: (tile[1], tile[0])):
+        if (x, y) not in solid:
+            continue
+        columns = 1
+        while (x + columns, y) in solid:
+            columns += 1
+        rows = 1
+        while all((x + i, y + rows) in solid for i in range(columns)):
+            rows += 1
+        for j in range(rows):
+            for i in range(columns):
+                solid.discard((x + i, y + j))
+        rects.append((x, y, columns, rows))
+    return rects
+
+def merge_rects(rects, bounds):
+    """
+    Merge   : Rects clipped to bounds, overlapping ones joined into their union.
+    """
+    merged = []
+    for rect in rects:
+        rect = rect.clip(bounds)
+        if not rect.width or not rect.height:
+            continue
+        index = rect.collidelist(merged)
+        while index != -1:
+            rect.union_ip(merged.pop(index))
+            index = rect.collidelist(merged)
+        merged.append(rect)
+    return merged
+
+
+
+"""
+    Spatial Index
+"""
+class SpatialGrid():
+    def __init__(self, cell_size):
+        """
+        Grid     : Uniform grid of square cells, each cell holds the items overlapping it
+        Order    : Query results keep insertion order, like a pygame.sprite.Group
+        """
+        self.cell_size  = cell_size
+        self.cells      = {}
+        self.items      = {}
+        self.counter    = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def cell_range(self, rect):
+        size = self.cell_size
+        x1, y1 = int(rect.left // size), int(rect.top // size)
+        x2, y2 = int(max(rect.right - 1, rect.left) // size), int(max(rect.bottom - 1, rect.top) // size)
+        return [(x, y) for y in range(y1, y2 + 1) for x in range(x1, x2 + 1)]
+
+    def add(self, item, rect=None):
+        if rect is None:
+            rect = item.rect
+        keys = self.cell_range(rect)
+        self.items[item] = (self.counter, keys)
+        self.counter += 1
+        for key in keys:
+            self.cells.setdefault(key, []).append(item)
+
+    def remove(self, item):
+        order, keys = self.items.pop(item)
+        for key in keys:
+            cell = self.cells[key]
+            cell.remove(item)
+            if not cell:
+                del self.cells[key]
+
+    def move(self, item, rect=None):
+        if rect is None:
+            rect = item.rect
+        order, keys = self.items[item]
+        new_keys = self.cell_range(rect)
+        if new_keys == keys:
+            return
+        for key in keys:
+            cell = self.cells[key]
+            cell.remove(item)
+            if not cell:
+                del self.cells[key]
+        # Keep each cell sorted by insertion order
+        items = self.items
+        for key in new_keys:
+            cell = self.cells.setdefault(key, [])
+            index = len(cell)
+            while index > 0 and items[cell[index - 1]][0] > order:
+                index -= 1
+            cell.insert(index, item)
+        self.items[item] = (order, new_keys)
+
+    def clear(self):
+        self.cells.clear()
+        self.items.clear()
+        self.counter = 0
+
+    def cell(self, item, rect):
+        # Cell of an item indexed by a point, or of rect when not indexed
+        if item in self.items:
+            return self.items[item][1][0]
+        return self.cell_range(rect)[0]
+
+    def add_cell(self, item, cell):
+        # add() of an item indexed by a point, at the cell() saved earlier
+        self.items[item] = (self.counter, [cell])
+        self.counter += 1
+        self.cells.setdefault(cell, []).append(item)
+
+    def query(self, rect):
+        size, cells = self.cell_size, self.cells
+        x1, y1 = int(rect.left // size), int(rect.top // size)
+        x2, y2 = int(max(rect.right - 1, rect.left) // size), int(max(rect.bottom - 1, rect.top) // size)
+        if x1 == x2 and y1 == y2:
+            return list(cells.get((x1, y1), ()))
+        found = {}
+        for y in range(y1, y2 + 1):
+            for x in range(x1, x2 + 1):
+                cell = cells.get((x, y))
+                if cell:
+                    for item in cell:
+                        found[item] = None
+        if len(found) > 1:
+            items = self.items
+            return sorted(found, key=lambda item: items[item][0])
+        return list(found)
+
+    def spritecollide(self, sprite, collided):
+        return [item for item in self.query(sprite.hit_rect) if collided(sprite, item)]
+
+
+class Broadphase():
+    def __init__(self, cell_size=COLLISION_CELL, pairs=COLLISION_PAIRS, direct=COLLISION_DIRECT):
+        """
+        Broadphase : Hitboxes of every category rebuilt each frame in one uniform grid, tested once for all category pairs.
+        Contacts   : contacts() gives the overlapping (a, b) sprites of each pair of categories, in the order they were added.
+        Direct     : Up to direct hitboxes, the grid costs more than it saves, each pair of categories is tested directly.
+        """
+        self.cell_size  = cell_size
+        self.direct     = direct
+        self.pairs      = list(pairs)
+        self.targets    = {}
+        for first, second in self.pairs:
+            self.targets.setdefault(first, []).append(second)
+        self.indexed    = set(second for first, second in self.pairs)
+        self.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries    = []
+
+    def add(self, category, sprite, rect):
+        # The rect is kept, not copied: hitboxes are read when contacts() runs
+        self.entries.append((category, sprite, rect))
+
+    def contacts(self):
+        entries = self.entries
+        contacts = dict((pair, []) for pair in self.pairs)
+        if len(entries) <= self.direct:
+            return self.direct_contacts(contacts)
+
+        # Only the categories found by others go into the grid, the others only search it
+        size, cells = self.cell_size, {}
+        for index, (category, sprite, rect) in enumerate(entries):
+            if category not in self.indexed:
+                continue
+            x1, y1 = int(rect.left // size), int(rect.top // size)
+            x2, y2 = int(max(rect.right - 1, rect.left) // size), int(max(rect.bottom - 1, rect.top) // size)
+            for y in range(y1, y2 + 1):
+                for x in range(x1, x2 + 1):
+                    cells.setdefault((x, y), []).append(index)
+
+        for index, (category, sprite, rect) in enumerate(entries):
+            targets = self.targets.get(category)
+            if targets is None:
+                continue
+            x1, y1 = int(rect.left // size), int(rect.top // size)
+            x2, y2 = int(max(rect.right - 1, rect.left) // size), int(max(rect.bottom - 1, rect.top) // size)
+            found = set()
+            for y in range(y1, y2 + 1):
+                for x in range(x1, x2 + 1):
+                    found.update(cells.get((x, y), ()))
+            for other in sorted(found):
+                other_category, other_sprite, other_rect = entries[other]
+                if other_category in targets and other_sprite is not sprite and rect.colliderect(other_rect):
+                    contacts[category, other_category].append((sprite, other_sprite))
+        return contacts
+
+    def direct_contacts(self, contacts):
+        # Every hitbox of the first category of a pair against the list of the second, in the order they were added
+        categories = {}
+        for category, sprite, rect in self.entries:
+            sprites, rects = categories.setdefault(category, ([], []))
+            sprites.append(sprite)
+            rects.append(rect)
+        for first, second in self.pairs:
+            if first not in categories or second not in categories:
+                continue
+            found = contacts[first, second]
+            others, other_rects = categories[second]
+            for sprite, rect in zip(*categories[first]):
+                for index in rect.collidelistall(other_rects):
+                    if others[index] is not sprite:
+                        found.append((sprite, others[index]))
+        return contacts
+
+
+
+"""
+    Pathfinding
+"""
+FLOW_NEIGHBOURS = [(0, 0), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]     # By direction code, 0 is none
+
+class FlowField():
+    def __init__(self, map, radius=FLOW_RADIUS, budget=FLOW_BUDGET):
+        """
+        Field    : Breadth first search over the collision tiles from the player's tile, run again only when it changes tile.
+                   Each reached tile keeps one byte, the direction code of its neighbour closest to the player,
+                   diagonals only when both tiles beside them are free so mobs do not cut wall corners.
+        Bounds   : The search stops radius tiles away, at most budget tiles are searched per update.
+                   Mobs steer with the last finished field while the next one is searched.
+        """
+        self.columns, self.rows = map.columns, map.rows
+        self.tilewidth, self.tileheight = map.tilewidth, map.tileheight
+        self.radius     = radius if radius is not None else self.columns * self.rows
+        self.budget     = budget
+        self.blocked    = bytearray(self.columns * self.rows)
+        for x, y in map.collision_tiles():
+            self.blocked[y * self.columns + x] = 1
+        self.directions = bytearray(self.columns * self.rows)
+        self.target     = None
+
+        # Search in progress
+        self.search     = None
+        self.distance   = None
+        self.queue      = None
+        self.reached    = None
+        self.searched   = 0
+
+    def tile(self, pos):
+        x, y = int(pos[0] // self.tilewidth), int(pos[1] // self.tileheight)
+        if 0 <= x < self.columns and 0 <= y < self.rows:
+            return y * self.columns + x
+        return None
+
+    def update(self, pos):
+        tile = self.tile(pos)
+        if tile is not None and tile != self.search and tile != self.target and not self.blocked[tile]:
+            self.start(tile)
+        if self.search is not None:
+            self.step(self.budget)
+
+    def start(self, tile):
+        self.search     = tile
+        self.distance   = array("H", [0xFFFF]) * (self.columns * self.rows)
+        self.distance[tile] = 0
+        self.queue      = deque([tile])
+        self.reached    = [tile]
+        self.searched   = 0
+
+    def step(self, budget):
+        columns, rows, blocked, distance, queue, reached = self.columns, self.rows, self.blocked, self.distance, self.queue, self.reached
+        while queue and budget > 0:
+            tile = queue.popleft()
+            budget -= 1
+            self.searched += 1
+            next_distance = distance[tile] + 1
+            if next_distance > self.radius:
+                continue
+            x = tile % columns
+            for neighbour, valid in ((tile - 1, x > 0), (tile + 1, x < columns - 1), (tile - columns, tile >= columns), (tile + columns, tile < (rows - 1) * columns)):
+                if valid and not blocked[neighbour] and distance[neighbour] == 0xFFFF:
+                    distance[neighbour] = next_distance
+                    queue.append(neighbour)
+                    reached.append(neighbour)
+        if not queue:
+            self.finish()
+
+    def finish(self):
+        # Direction of every reached tile, the others keep none
+        columns, rows, blocked, distance = self.columns, self.rows, self.blocked, self.distance
+        directions = bytearray(columns * rows)
+        for tile in self.reached:
+            x, y = tile % columns, tile // columns
+            best, best_distance = 0, distance[tile]
+            for code in range(1, 9):
+                dx, dy = FLOW_NEIGHBOURS[code]
+                nx, ny = x + dx, y + dy
+                if not (0 <= nx < columns and 0 <= ny < rows):
+                    continue
+                neighbour = ny * columns + nx
+                if distance[neighbour] >= best_distance:
+                    continue
+                if dx and dy and (blocked[y * columns + nx] or blocked[ny * columns + x]):
+                    continue
+                best, best_distance = code, distance[neighbour]
+            directions[tile] = best
+        self.directions = directions
+        self.target     = self.search
+        self.search     = None
+        self.distance   = None
+        self.queue      = None
+        self.reached    = None
+
+    def steer(self, pos):
+        """
+        Steer   : Vector from pos to the centre of the next tile towards the player,
+                  None next to the player's tile, or where the field does not reach.
+        """
+        tile = self.tile(pos)
+        if tile is None:
+            return None
+        code = self.directions[tile]
+        if not code:
+            return None
+        dx, dy = FLOW_NEIGHBOURS[code]
+        x, y = tile % self.columns + dx, tile // self.columns + dy
+        if y * self.columns + x == self.target:
+            return None
+        return vec((x + 0.5) * self.tilewidth - pos[0], (y + 0.5) * self.tileheight - pos[1])
+
+
+
+"""
+    Activity
+"""
+class ActivityScheduler():
+    def __init__(self, game):
+        """
+        Activity : Mobs indexed by region, only the regions around the player and the view are visited each frame.
+                   Within DETECT_RADIUS + LOD_FULL_MARGIN mobs update every frame, as they would without the scheduler.
+                   Further mobs only animate, updated every LOD_MIDDLE_RATE frames while near the player or the view.
+                   The rest sleep: no animation, no health frames, not even visited, until the player comes back.
+        Awake    : Mobs updated at full rate this frame, in spawn order, the only ones that can touch the player or a sword.
+        """
+        self.game       = game
+        self.grid       = SpatialGrid(LOD_REGION)
+        self.frame      = 0
+        self.awake      = []
+        self.full       = 0
+        self.middle     = 0
+        self.asleep     = 0
+
+    def add(self, mob):
+        mob.lod_phase = len(self.grid) % LOD_MIDDLE_RATE
+        self.grid.add(mob, mob.grid_rect())
+
+    def update(self):
+        game, grid = self.game, self.grid
+        full_radius = DETECT_RADIUS + LOD_FULL_MARGIN
+        middle_radius = max(LOD_MIDDLE, full_radius)
+        x, y = game.player.pos
+        area = pygame.Rect(int(x - middle_radius), int(y - middle_radius), 2 * middle_radius + 1, 2 * middle_radius + 1)
+        area.union_ip(game.camera.view.inflate(2 * LOD_REGION, 2 * LOD_REGION))
+
+        self.frame += 1
+        awake, middle = [], 0
+        for mob in grid.query(area):
+            dx, dy = mob.pos.x - x, mob.pos.y - y
+            if dx * dx + dy * dy <= full_radius * full_radius:
+                mob.update()
+                awake.append(mob)
+            elif (self.frame + mob.lod_phase) % LOD_MIDDLE_RATE == 0:
+                # With the animation time of the skipped frames
+                mob.current_time += mob.dt * (LOD_MIDDLE_RATE - 1)
+                mob.update()
+                middle += 1
+            else:
+                middle += 1
+                continue
+            if mob.alive():
+                grid.move(mob, mob.grid_rect())
+            else:
+                grid.remove(mob)
+        self.awake = [mob for mob in awake if mob.alive()]
+        self.full = len(self.awake)
+        self.middle = middle
+        self.asleep = len(grid) - self.full - middle
+
+
+
+"""
+    Audio
+"""
+class AudioManager():
+    def __init__(self, game, groups=AUDIO_GROUPS, sounds=AUDIO_SOUNDS):
+        """
+        Channels : Each group of sounds plays on its own reserved mixer channels, so effects never take the voices' channels.
+        Limits   : A sound is suppressed while in its cooldown or with its most instances playing.
+                   With no free channel in its group it stops the lowest priority, oldest sound of no higher priority.
+        Counters : played, suppressed and stolen, by sound.
+        """
+        self.game       = game
+        self.sounds     = sounds
+        self.groups     = {}
+        index = 0
+        pygame.mixer.set_num_channels(sum(groups.values()))
+        pygame.mixer.set_reserved(sum(groups.values()))
+        for group, count in groups.items():
+            self.groups[group] = [pygame.mixer.Channel(channel) for channel in range(index, index + count)]
+            index += count
+        self.playing    = {}
+        self.last_play  = {}
+        self.played     = dict((name, 0) for name in sounds)
+        self.suppressed = dict((name, 0) for name in sounds)
+        self.stolen     = dict((name, 0) for name in sounds)
+
+    def play(self, name, sound):
+        group, priority, cooldown, instances = self.sounds[name]
+        now = self.game.ticks
+        last = self.last_play.get(name)
+        if last is not None and now - last < cooldown:
+            self.suppressed[name] += 1
+            return None
+
+        # Channels in the group still playing, (priority, start, name) by channel
+        channels, free, count = self.groups[group], None, 0
+        for channel in channels:
+            if not channel.get_busy():
+                self.playing.pop(channel, None)
+                if free is None:
+                    free = channel
+            elif self.playing.get(channel, (0, 0, None))[2] == name:
+                count += 1
+        if count >= instances:
+            self.suppressed[name] += 1
+            return None
+        if free is None:
+            victim = min(channels, key=lambda channel: self.playing.get(channel, (0, 0, None))[:2])
+            victim_priority, start, victim_name = self.playing.get(victim, (0, 0, None))
+            if victim_priority > priority:
+                self.suppressed[name] += 1
+                return None
+            victim.stop()
+            if victim_name is not None:
+                self.stolen[victim_name] += 1
+            free = victim
+
+        free.play(sound)
+        self.playing[free] = (priority, now, name)
+        self.last_play[name] = now
+        self.played[name] += 1
+        return free
+
+    def restart(self):
+        # Cooldowns follow game.ticks, which starts over with each new game
+        self.last_play.clear()
+
+    def report(self):
+        lines = ["%-16s %8s %10s %8s" % ("sound", "played", "suppressed", "stolen")]
+        for name in self.sounds:
+            lines.append("%-16s %8d %10d %8d" % (name, self.played[name], self.suppressed[name], self.stolen[name]))
+        return "\n".join(lines)
+
+
+
+"""
+    Sprite Pools
+"""
+class SpritePool():
+    def __init__(self, sprite_class):
+        """
+        Pool    : Killed sprites of sprite_class, reset and added back to their groups by get() instead of built again.
+                  The sprite class takes the game first in both __init__ and reset, and releases itself when killed.
+        Stats   : created and reused sprites, active now and high_water, the most active at once.
+        """
+        self.sprite_class   = sprite_class
+        self.free           = []
+        self.created        = 0
+        self.reused         = 0
+        self.active         = 0
+        self.high_water     = 0
+
+    def get(self, game, *arguments):
+        if self.free:
+            sprite = self.free.pop()
+            sprite.reset(game, *arguments)
+            self.reused += 1
+        else:
+            sprite = self.sprite_class(game, *arguments)
+            sprite.pool = self
+            self.created += 1
+        self.active += 1
+        if self.active > self.high_water:
+            self.high_water = self.active
+        return sprite
+
+    def release(self, sprite):
+        self.active -= 1
+        self.free.append(sprite)
+
+    def restart(self):
+        # Sprites alive at a new game are dropped with the groups of the last one
+        self.active = 0
+
+    def report(self):
+        return "%-8s %8d created %8d reused %6d high water %6d free" % (self.sprite_class.__name__, self.created, self.reused, self.high_water, len(self.free))
+
+
+
+"""
+    World
+"""
+class Region():
+    def __init__(self, name, x, y, columns, rows):
+        """
+        Region  : One map of the world and its rect in world pixels, from the map's rect in world tiles.
+        State   : unloaded, decoding by the AssetManager, preparing by the WorldStreamer's worker, then ready to be played.
+        Stats   : loads, latency from the request to ready and the worker's last prepare_time.
+        """
+        self.name           = name
+        self.rect           = pygame.Rect(x * TILESIZE, y * TILESIZE, columns * TILESIZE, rows * TILESIZE)
+        self.state          = "unloaded"
+        self.map            = None
+        self.renderer       = None
+        self.future         = None
+        self.entry          = None
+        self.requested      = None
+        self.latency        = 0
+        self.prepare_time   = 0
+        self.loads          = 0
+        self.tiles_memory   = 0
+
+    def memory(self):
+        # Bytes of the converted tiles and the rendered chunks
+        if self.map is None:
+            return 0
+        return self.tiles_memory + self.renderer.memory
+
+def prepare_region(map, renderer, area):
+    """
+    Prepare : Collision rects of map and the chunks of renderer in area, off the main thread.
+    Return  : Seconds spent.
+    """
+    start = time.perf_counter()
+    map.collision_rects()
+    if area is not None:
+        keys = renderer.chunk_keys(area)
+        pinned = set(keys)
+        for key in keys:
+            renderer.get_chunk(key, pinned)
+            time.sleep(0)   # Hands the interpreter back to the main thread between chunks
+    return time.perf_counter() - start
+
+class WorldStreamer():
+    def __init__(self, game, regions=WORLD_REGIONS, start=WORLD_START, distance=STREAM_DISTANCE, budget=STREAM_BUDGET, background=True):
+        """
+        World    : Maps side by side as Regions, the player walks from one to the next through their open borders.
+                   Only the current region is played, in its own coordinates, the sprites of the last one are dropped.
+        Stream   : Regions within distance of the player are decoded by the AssetManager and prepared by a worker thread,
+                   the main thread only converts their tiles. Without background, regions are loaded when entered.
+                   Entering a region that is not ready waits for it, counted in stalls.
+        Budget   : Above budget bytes of tiles and chunks, the furthest ready regions out of reach are unloaded.
+        """
+        self.game           = game
+        self.regions        = OrderedDict((name, Region(name, *rect)) for name, rect in regions.items())
+        self.start          = self.regions[start]
+        self.distance       = distance
+        self.budget         = budget
+        self.background     = background
+        self.pool           = ThreadPoolExecutor(max_workers=1)
+        self.current        = None
+        self.stalls         = 0
+        self.evictions      = 0
+
+    def world_pos(self, pos):
+        return vec(pos) + self.current.rect.topleft
+
+    def region_at(self, pos):
+        for region in self.regions.values():
+            if region.rect.collidepoint(pos):
+                return region
+        return None
+
+    def entry_area(self, region, pos):
+        # Map rect of region in view when the player walks in from pos, in world pixels
+        if pos is None:
+            return None
+        margin = region.renderer.margin
+        area = pygame.Rect(0, 0, WIDTH + 2 * margin, HEIGHT + 2 * margin)
+        area.center = (min(max(pos[0], region.rect.left), region.rect.right - 1) - region.rect.x,
+                       min(max(pos[1], region.rect.top), region.rect.bottom - 1) - region.rect.y)
+        return area
+
+    def prepare(self, region, pos):
+        region.future       = self.pool.submit(prepare_region, region.map, region.renderer, self.entry_area(region, pos))
+        region.state        = "preparing"
+
+    def request(self, region, pos=None):
+        # Chunks around pos, in world pixels, are rendered ahead
+        if region.state == "unloaded":
+            region.state        = "decoding"
+            region.requested    = time.perf_counter()
+            region.entry        = pos
+            self.game.assets.submit(region.name)
+
+    def poll(self, region, wait=False):
+        # Moves a requested region on as far as it is done, to ready when wait
+        assets = self.game.assets
+        if region.state == "decoding" and (wait or region.name in assets.assets or assets.futures[region.name].done()):
+            map = assets.assets[region.name] if region.name in assets.assets else assets.finish(region.name)
+            if (map.width, map.height) != region.rect.size:
+                raise ValueError("%s is %dx%d pixels, WORLD_REGIONS makes it %dx%d" % ((region.name, map.width, map.height) + region.rect.size))
+            region.map          = map
+            region.renderer     = MapRenderer(map)
+            region.tiles_memory = sum(image.get_width() * image.get_height() * image.get_bytesize() for image in set(image for image in map.images if image))
+            self.prepare(region, region.entry)
+        if region.state == "preparing" and (wait or region.future.done()):
+            region.prepare_time = region.future.result()
+            region.future       = None
+            region.state        = "ready"
+            if region.requested is not None:
+                region.latency      = time.perf_counter() - region.requested
+                region.requested    = None
+                region.loads        += 1
+
+    def unload(self, region):
+        self.game.assets.unload(region.name)
+        region.map          = None
+        region.renderer     = None
+        region.tiles_memory = 0
+        region.state        = "unloaded"
+        self.evictions      += 1
+
+    def enter(self, region, pos=None):
+        # Map of the game from region, loaded first if needed, the caller builds its sprites
+        if region.state != "ready":
+            self.request(region, pos)
+            self.poll(region, wait=True)
+        self.current            = region
+        self.game.map           = region.map
+        self.game.map_renderer  = region.renderer
+        self.game.map_name      = region.name
+
+    def restart(self):
+        self.enter(self.start)
+
+    def place(self, pos):
+        """
+        Place   : The player at pos in world pixels, in the region there, whose sprites are built when it is entered.
+        Return  : False when no region is there.
+        """
+        game, player = self.game, self.game.player
+        region = self.region_at(pos)
+        if region is None:
+            return False
+        if region is not self.current:
+            self.enter(region, pos)
+            game.build_map(player)
+        player.pos = vec(pos) - region.rect.topleft
+        player.rect.center = player.pos
+        player.hit_rect.center = player.pos
+        return True
+
+    def update(self):
+        game, player = self.game, self.game.player
+        pos = self.world_pos(player.pos)
+        reach = pygame.Rect(int(pos.x) - self.distance, int(pos.y) - self.distance, 2 * self.distance, 2 * self.distance)
+        if self.background:
+            for region in self.regions.values():
+                if region.rect.colliderect(reach):
+                    self.request(region, pos)
+                    if region.state == "ready" and region is not self.current:
+                        # Loaded earlier, its chunks where the player would come in may be gone or never rendered
+                        area = self.entry_area(region, pos)
+                        if any(key not in region.renderer.chunks for key in region.renderer.chunk_keys(area)):
+                            self.prepare(region, pos)
+                self.poll(region)
+
+        if not self.current.rect.collidepoint(pos):
+            region = self.region_at(pos)
+            if region is None:
+                # No map there, the player stays on this one
+                player.pos.x = min(max(player.pos.x, 0), game.map.width - 1)
+                player.pos.y = min(max(player.pos.y, 0), game.map.height - 1)
+                player.rect.center = player.pos
+                player.hit_rect.center = player.pos
+            else:
+                if region.state != "ready":
+                    self.stalls += 1
+                self.place(pos)
+        self.evict(pos, reach)
+
+    def evict(self, pos, reach):
+        ready = [region for region in self.regions.values() if region.state == "ready"]
+        memory = sum(region.memory() for region in ready)
+        spare = [region for region in ready if region is not self.current and not region.rect.colliderect(reach)]
+        spare.sort(key=lambda region: -pos.distance_squared_to(region.rect.center))
+        for region in spare:
+            if memory <= self.budget:
+                break
+            memory -= region.memory()
+            self.unload(region)
+
+    def memory(self):
+        return sum(region.memory() for region in self.regions.values())
+
+    def report(self):
+        lines = ["%-12s %10s %6s %11s %11s %10s" % ("region", "state", "loads", "latency ms", "prepare ms", "memory KB")]
+        for region in self.regions.values():
+            lines.append("%-12s %10s %6d %11.2f %11.2f %10d" % (region.name, region.state, region.loads, region.latency * 1000, region.prepare_time * 1000, region.memory() // 1024))
+        lines.append("%d stalls, %d evictions, %d KB resident" % (self.stalls, self.evictions, self.memory() // 1024))
+        return "\n".join(lines)
+
 
 
 """
     Game
 """
 class Game:
-    def __init__(self):
-        pygame.mixer.pre_init(44100, -16, 2, 2048)
+    def __init__(self, headless=HEADLESS):
+        self.headless       = headless
+        if self.headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+            os.environ["SDL_AUDIODRIVER"] = "dummy"
+        pygame.mixer.pre_init(AUDIO_FREQUENCY, AUDIO_SIZE, AUDIO_STEREO, AUDIO_BUFFER)
         pygame.mixer.init()
         pygame.init()
         pygame.key.set_repeat(300, 75)
+        self.audio          = AudioManager(self)
         self.gameDisplay    = ScaledGame(project_title, screen_size, 60)
-        self.clock          = pygame.time.Clock()
-        self.dt             = self.clock.tick(FPS) / 1000
+        self.clock          = self.gameDisplay.clock
+        self.profiler       = FrameProfiler()
+        self.pools          = dict((sprite_class, SpritePool(sprite_class)) for sprite_class in (Sword, Effect, Item))
+        self.recorder       = None
+        self.replay         = None
+        self.dt             = SIM_DT if self.headless else self.clock.tick(FPS) / 1000
         self.load_data()
         self.new()
 
     def draw_text(self, text, font_name, size, color, x, y, align="nw"):
-        font = pygame.font.Font(font_name, size)
-        text_surface = font.render(text, True, color)
+        font = get_font(font_name, size)
+        text_surface = Text.cache.get((font, text, tuple(color), "plain"), lambda: font.render(text, True, color))
         text_rect = text_surface.get_rect()
         if align == "nw":
             text_rect.topleft = (x, y)
@@ -252,64 +1817,107 @@ class Game:
             text_rect.center = (x, y)
         self.gameDisplay.blit(text_surface, text_rect)
 
+    def draw_loading(self, done, total, name):
+        # Loading screen, redrawn at most every 50 ms
+        now = time.perf_counter()
+        if done < total and now - getattr(self, "loading_time", 0) < 0.05:
+            return
+        self.loading_time = now
+        pygame.event.pump()
+        bar = pygame.Rect(0, 0, WIDTH // 2, 20)
+        bar.center = (WIDTH / 2, HEIGHT / 2)
+        self.gameDisplay.fill(BLACK)
+        pygame.draw.rect(self.gameDisplay, COLOR_INTERFACE, (bar.x, bar.y, bar.width * done // total, bar.height))
+        pygame.draw.rect(self.gameDisplay, WHITE, bar, 1)
+        self.draw_text("Loading %d/%d" % (done, total), None, 32, WHITE, WIDTH / 2, bar.top - 10, align="s")
+        self.draw_text(name, None, 24, LIGHTGREY, WIDTH / 2, bar.bottom + 10, align="n")
+        self.gameDisplay.present()
+        pygame.display.flip()
+
     def load_data(self):
         game_folder         = path.dirname(__file__)
-        data_folder         = path.join(game_folder, "data")
-        graphics_folder     = path.join(data_folder, "graphics")
-        map_folder          = path.join(data_folder, "map")
-        sfx_folder          = path.join(data_folder, "sfx")
-        voice_folder        = path.join(data_folder, "voice")
-        music_folder        = path.join(data_folder, "music")
+        data_folder         = path.join(game_folder, DATA_FOLDER)
 
         self.font           = None
         self.dim_screen     = pygame.Surface(self.gameDisplay.get_size()).convert_alpha()
         self.dim_screen.fill((100, 100, 100, 120))
 
-        self.map            = Map(path.join(map_folder, "Map_1.tmx"))
-        self.map_img        = self.map.make_map()
-        self.map_rect       = self.map_img.get_rect()
+        # Assets
+        archive_file        = path.join(data_folder, ARCHIVE_FILE)
+        self.assets         = AssetManager(archive=AssetArchive(archive_file) if USE_ARCHIVE and path.isfile(archive_file) else None)
+        asset_manifest(self.assets, data_folder)
+        self.assets.load(None if self.headless else self.draw_loading)
+        if ASSET_TIMINGS:
+            print(self.assets.report())
+
+        self.load_map("Map_1.tmx")
+        self.world          = WorldStreamer(self) if WORLD_STREAMING else None
 
-        self.player_img     = load_tile_table(path.join(graphics_folder, PLAYER_IMG), 32, 32)
-        self.image_heart    = pygame.image.load(path.join(graphics_folder, IMAGE_HEART)).convert_alpha()
-        self.image_coin     = pygame.image.load(path.join(graphics_folder, IMAGE_COIN)).convert_alpha()
-        self.mob_img        = load_tile_table(path.join(graphics_folder, MOB_IMG), 32, 32)
-        self.sword_img      = pygame.image.load(path.join(graphics_folder, SWORD_IMG)).convert_alpha()
+        self.player_img     = self.assets.get(PLAYER_IMG)
+        self.image_heart    = self.assets.get(IMAGE_HEART)
+        self.image_coin     = self.assets.get(IMAGE_COIN)
+        self.mob_img        = self.assets.get(MOB_IMG)
+        self.sword_img      = self.assets.get(SWORD_IMG)
 
         # Image Items
         self.item_images = {}
         for item in ITEM_IMAGES:
-            self.item_images[item] = load_image(graphics_folder, ITEM_IMAGES[item])
+            self.item_images[item] = [self.assets.get(image) for image in ITEM_IMAGES[item]]
 
         # Image Effects
         self.effect_images = {}
         for effect in EFFECT_IMAGES:
-            self.effect_images[effect] = load_image(graphics_folder, EFFECT_IMAGES[effect])
+            self.effect_images[effect] = [self.assets.get(image) for image in EFFECT_IMAGES[effect]]
+
+        # Animation Atlas
+        self.atlas = AnimationAtlas()
+        self.atlas.add_table("player", self.player_img)
+        self.atlas.add_table("mob", health_frames(self.mob_img, MOB_HEALTH))
+        self.atlas.add_rotations("sword", self.sword_img, SWORD_ANGLES)
+        for item in self.item_images:
+            self.atlas.add_table(("item", item), self.item_images[item])
+        for effect in self.effect_images:
+            self.atlas.add_table(("effect", effect), self.effect_images[effect])
 
         # Sound Effects
         self.sounds_effects = {}
-        self.sounds_effects["pick_up"]  = pygame.mixer.Sound(path.join(sfx_folder, SOUNDS_PICK_UP))
-        self.sounds_effects["sword"]    = []
-        for sound in SOUNDS_SWORD_ATTACK:
-            self.sounds_effects["sword"].append(pygame.mixer.Sound(path.join(sfx_folder, sound)))
+        self.sounds_effects["pick_up"]  = self.assets.get(SOUNDS_PICK_UP)
+        self.sounds_effects["sword"]    = [self.assets.get(sound) for sound in SOUNDS_SWORD_ATTACK]
 
-        # Sound Voices
-        self.sounds_voice = {}
-        self.sounds_voice["player_attack"] = []
-        self.sounds_voice["player_damage"] = []
-        for voice in VOICE_PLAYER_ATTACK:
-            self.sounds_voice["player_attack"].append(pygame.mixer.Sound(path.join(voice_folder, voice)))
-        for voice in VOICE_PLAYER_DAMAGE:
-            self.sounds_voice["player_damage"].append(pygame.mixer.Sound(path.join(voice_folder, voice)))
+        # Sound Voices, loaded on first use
+        self.sounds_voice = AssetGroup(self.assets, {"player_attack": VOICE_PLAYER_ATTACK, "player_damage": VOICE_PLAYER_DAMAGE})
 
-        # Sound Musics
-        pygame.mixer.music.load(path.join(music_folder, BG_MUSIC))
 
-
-    def new(self):
+    def new(self, seed=None):
+        self.playing        = True
         self.paused         = False
+        self.ticks          = 0
+        self.dt             = SIM_DT   # Read by the sprites created below, the same on every start for replays
+        self.seed           = seed if seed is not None else int.from_bytes(os.urandom(8), "little")
+        self.random         = Random(self.seed)
+        self.drawn          = None
+        self.draw_state     = None
         self.draw_debug     = False
+        for pool in self.pools.values():
+            pool.restart()
+        self.audio.restart()
+        if self.world is not None:
+            self.world.restart()
+        self.build_map()
+        self.start_snapshot = self.snapshot()
+
+    def build_map(self, player=None):
+        """
+        Build   : Sprites, obstacles and grids of self.map and its objects.
+        Player  : Kept with its health and coins when given, instead of the map's player object.
+        """
+        if player is not None:
+            # Swords, items and effects of the last map go back to their pools
+            for sprite in self.sword.sprites() + self.items.sprites() + self.effects.sprites():
+                sprite.kill()
         self.camera         = Camera(self.map.width, self.map.height)
         self.all_sprites    = pygame.sprite.LayeredUpdates()
+        self.updating       = pygame.sprite.Group()     # Updated every frame, all but the mobs of the ActivityScheduler
         self.mobs           = pygame.sprite.Group()
         self.sword          = pygame.sprite.Group()
         self.walls          = pygame.sprite.Group()
@@ -317,34 +1925,276 @@ class Game:
         self.effects        = pygame.sprite.Group()
 
         # Map Obstacles
-        for tile_layer in self.map.tmxdata.layers:
-            if tile_layer.name == "collision":
-                for x, y, image in tile_layer.tiles():
-                    Obstacle(self, x, y, self.map.tmxdata.tilewidth, self.map.tmxdata.tileheight)
-
-        # Map Objects
-        for tile_object in self.map.tmxdata.objects:
-            obj_center = vec(tile_object.x + tile_object.width/2, tile_object.y + tile_object.height/2)
-            if tile_object.name == "player":
+        for x, y, columns, rows in self.map.collision_rects():
+            Obstacle(self, x, y, self.map.tilewidth, self.map.tileheight, columns, rows)
+        self.wall_grid      = SpatialGrid(self.map.tilewidth)
+        for wall in self.walls:
+            self.wall_grid.add(wall)
+        self.wall_index     = wall_index(self.walls, self.wall_grid)
+        self.mob_grid       = SpatialGrid(MOB_RADIUS)
+        self.broadphase     = Broadphase()
+
+        # Mob Batch
+        self.mob_batch      = None
+        if MOB_BATCH and numpy is not None:
+            self.mob_batch  = MobBatch(self)
+            if MOB_LOD or MOB_FLOW:
+                warnings.warn("MOB_BATCH simulates every mob each frame, MOB_LOD and MOB_FLOW are ignored with it")
+        self.activity       = None
+        if MOB_LOD and self.mob_batch is None:
+            self.activity   = ActivityScheduler(self)
+        self.flow           = None
+        if MOB_FLOW and self.mob_batch is None:
+            self.flow       = FlowField(self.map)
+
+        # Map Objects, the player starts on the free tile nearest the center of maps without a player object
+        if player is None and "player" not in [obj[0] for obj in self.map.objects]:
+            self.player = Player(self, *self.map.free_tile(self.map.width / 2, self.map.height / 2))
+        for name, x, y, width, height in self.map.objects:
+            obj_center = vec(x + width/2, y + height/2)
+            if name == "player" and player is None:
                 self.player = Player(self, obj_center.x, obj_center.y)
-            if tile_object.name == "mob":
-                self.mob = Mob(self, obj_center.x, obj_center.y)
-            if tile_object.name in ["heart"]:
-                Item(self, obj_center, tile_object.name)
+            if name == "mob":
+                self.mob = self.spawn_mob(obj_center.x, obj_center.y)
+            if name in ["heart"]:
+                self.spawn(Item, obj_center, name)
+        if player is not None:
+            self.player = player
+            player.groups = self.all_sprites, self.updating
+            player.add(player.groups)
 
 
     def run(self):
         self.playing = True
+        if self.headless:
+            while self.playing:
+                self.step()
+            return
         pygame.mixer.music.play(-1)
         while self.playing:
             self.dt = self.clock.tick(FPS) / 1000
+            self.profiler.begin()
             self.events()
-            if not self.paused:
+            self.input_tick()
+            self.profiler.lap("events")
+            if self.playing and not self.paused:
                 self.update()
             self.draw()
+            self.profiler.end()
+
+    def step(self, n=1, dt=SIM_DT):
+        """
+        Step    : n updates of dt seconds, without drawing or waiting on the clock.
+        Return  : Number of updates run, fewer than n when the game ended.
+        """
+        for i in range(n):
+            if not self.playing:
+                return i
+            self.dt = dt
+            self.events()
+            self.input_tick()
+            if self.playing and not self.paused:
+                self.update()
+        return n
+
+    def input_tick(self):
+        # Replayed dt, keys and pause of this tick, or the live ones saved by the recorder
+        if self.replay is not None:
+            tick = self.replay.next()
+            if tick is None:
+                self.playing = False
+                return
+            self.dt, self.paused = tick
+        if self.recorder is not None:
+            self.recorder.add(self.dt, self.get_pressed(), self.paused)
+
+    def start_recording(self, filename):
+        """
+        Record  : Restarts the game and saves its map, seed and the input and dt of every tick, until stop_recording().
+        """
+        self.new()
+        self.recorder = InputRecorder(filename, self.map_name, self.seed)
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def start_replay(self, filename):
+        """
+        Replay  : Restarts the game on the recorded map and seed, then feeds the recorded ticks to run() or step().
+                  The game stops playing at the end of the trace.
+        """
+        self.replay = InputReplay(filename)
+        self.load_map(self.replay.map_name)
+        self.new(self.replay.seed)
+
+
+    def snapshot(self):
+        """
+        Snapshot : The dynamic state of the game as bytes for restore(): ticks, RNG, camera, the player and every mob, item,
+                   effect and sword with its animation and timers. Positions are kept as doubles, a rollback replays exactly.
+                   The map, walls and audio are not saved.
+        """
+        player, activity = self.player, self.activity
+        name = self.map_name.encode("utf-8")
+        mobs, items, effects, swords = self.mobs.sprites(), self.items.sprites(), self.effects.sprites(), self.sword.sprites()
+        camera = self.camera.camera
+        data = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.ticks, self.seed, self.playing, activity.frame if activity is not None else 0,
+                                     camera.x, camera.y, len(name), len(mobs), len(items), len(effects), len(swords)), name]
+        version, state, gauss = self.random.getstate()
+        data.append(SNAPSHOT_RANDOM.pack(*state, math.nan if gauss is None else gauss))
+        data.append(SNAPSHOT_PLAYER.pack(player.pos.x, player.pos.y, player.vel.x, player.vel.y, player.rot, player.health, player.coin,
+                                         player.last_slash, player.index, player.direction, player.current_time))
+        for mob in mobs:
+            (x, y), (vx, vy), (ax, ay), grid_rect = mob.pos, mob.vel, mob.acc, mob.grid_rect()
+            cell = self.mob_grid.cell(mob, grid_rect)
+            region = activity.grid.cell(mob, grid_rect) if activity is not None else (0, 0)
+            data.append(SNAPSHOT_MOB.pack(x, y, vx, vy, ax, ay, mob.rot, mob.health, mob.index, mob.direction, mob.current_time,
+                                          getattr(mob, "lod_phase", 0), cell[0], cell[1], region[0], region[1]))
+        item_types, effect_types = list(ITEM_IMAGES), list(EFFECT_IMAGES)
+        for item in items:
+            data.append(SNAPSHOT_ITEM.pack(item.pos.x, item.pos.y, item_types.index(item.type), item.step, item.dir))
+        for effect in effects:
+            data.append(SNAPSHOT_EFFECT.pack(effect.pos.x, effect.pos.y, effect_types.index(effect.type), effect.index, effect.current_time))
+        for sword in swords:
+            data.append(SNAPSHOT_SWORD.pack(sword.pos.x, sword.pos.y, sword.vel.x, sword.vel.y, sword.rot, sword.hit, sword.spawn_time))
+        return b"".join(data)
+
+    def restore(self, data):
+        """
+        Restore : The state saved by snapshot(), in place. The map, walls and grids stay built, the sprites alive are reused
+                  in order and reset, only the missing ones are built or taken from their pools.
+                  A snapshot of another map is only restored on a region of the WorldStreamer.
+        Errors  : ValueError for data that is not a whole snapshot of this version, or of a map that cannot be entered,
+                  raised before the game is changed.
+        """
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("Not a version %d snapshot" % SNAPSHOT_VERSION)
+        magic, version, ticks, seed, playing, frame, camera_x, camera_y, length, mobs, items, effects, swords = SNAPSHOT_HEADER.unpack_from(data, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a version %d snapshot" % SNAPSHOT_VERSION)
+        size = (SNAPSHOT_HEADER.size + length + SNAPSHOT_RANDOM.size + SNAPSHOT_PLAYER.size + mobs * SNAPSHOT_MOB.size
+                + items * SNAPSHOT_ITEM.size + effects * SNAPSHOT_EFFECT.size + swords * SNAPSHOT_SWORD.size)
+        if len(data) != size:
+            raise ValueError("Snapshot of %d bytes, its header makes it %d" % (len(data), size))
+        offset = SNAPSHOT_HEADER.size
+        map_name = bytes(data[offset:offset + length]).decode("utf-8")
+        if map_name != self.map_name and (self.world is None or map_name not in self.world.regions):
+            raise ValueError("Snapshot of %s, not of %s" % (map_name, self.map_name))
+        random_state = SNAPSHOT_RANDOM.unpack_from(data, offset + length)
+        player_state = SNAPSHOT_PLAYER.unpack_from(data, offset + length + SNAPSHOT_RANDOM.size)
+        offset += length + SNAPSHOT_RANDOM.size + SNAPSHOT_PLAYER.size
+        mob_states, offset     = unpack_records(SNAPSHOT_MOB, data, offset, mobs)
+        item_states, offset    = unpack_records(SNAPSHOT_ITEM, data, offset, items)
+        effect_states, offset  = unpack_records(SNAPSHOT_EFFECT, data, offset, effects)
+        sword_states, offset   = unpack_records(SNAPSHOT_SWORD, data, offset, swords)
+        if map_name != self.map_name:
+            self.world.enter(self.world.regions[map_name])
+            self.build_map(self.player)
+
+        # Mobs, in the order of the grids they were indexed in
+        alive = self.mobs.sprites()
+        for mob in alive[mobs:]:
+            if self.mob_batch is not None:
+                self.mob_batch.remove(mob.slot)
+            mob.kill()
+        self.mob_grid.clear()
+        if self.activity is not None:
+            self.activity.grid.clear()
+            self.activity.frame = frame
+        for index, (x, y, vx, vy, ax, ay, rot, health, image_index, direction, current_time, phase, cx, cy, rx, ry) in enumerate(mob_states):
+            if index < len(alive):
+                mob = alive[index]
+            else:
+                mob = Mob(self, x, y) if self.mob_batch is None else BatchMob(self, x, y)
+            mob.pos, mob.vel, mob.acc   = vec(x, y), vec(vx, vy), vec(ax, ay)
+            mob.rot, mob.health         = rot, health
+            mob.index, mob.direction    = image_index, direction
+            mob.current_time            = current_time
+            mob.target                  = self.player
+            mob.update_images()
+            mob.image                   = mob.images[mob.index]
+            mob.rect.size               = mob.image.get_size()
+            mob.rect.center             = mob.pos
+            mob.hit_rect.center         = mob.rect.center
+            if self.mob_batch is None:
+                self.mob_grid.add_cell(mob, (cx, cy))
+            if self.activity is not None:
+                self.activity.grid.add_cell(mob, (rx, ry))
+                mob.lod_phase = phase
+
+        # Items, effects and swords, reset in place while alive
+        reused = {}
+        for group, count in ((self.items, items), (self.effects, effects), (self.sword, swords)):
+            alive = group.sprites()
+            for sprite in alive[count:]:
+                sprite.kill()
+            reused[group] = alive[:count]
+        def revive(group, index, sprite_class, *arguments):
+            if index < len(reused[group]):
+                sprite = reused[group][index]
+                sprite.reset(self, *arguments)
+                return sprite
+            return self.spawn(sprite_class, *arguments)
+        item_types, effect_types = list(ITEM_IMAGES), list(EFFECT_IMAGES)
+        for index, (x, y, type, step, dir) in enumerate(item_states):
+            item = revive(self.items, index, Item, (x, y), item_types[type])
+            item.step, item.dir = step, dir
+        for index, (x, y, type, image_index, current_time) in enumerate(effect_states):
+            effect = revive(self.effects, index, Effect, (x, y), effect_types[type])
+            effect.index, effect.current_time = image_index, current_time
+            effect.image            = effect.images[image_index]
+            effect.rect.size        = effect.image.get_size()
+            effect.rect.center      = effect.pos
+        for index, (x, y, vx, vy, rot, hit, spawn_time) in enumerate(sword_states):
+            sword = revive(self.sword, index, Sword, self.player)
+            sword.pos.update(x, y)
+            sword.vel.update(vx, vy)
+            sword.rot, sword.hit, sword.spawn_time = rot, hit, spawn_time
+            sword.image             = self.atlas.rotated("sword", rot - 90)
+            sword.rect.size         = sword.image.get_size()
+            sword.rect.center       = sword.pos
+            sword.hit_rect.center   = sword.rect.center
+
+        # Player, after the swords which set its last slash
+        player = self.player
+        x, y, vx, vy, player.rot, player.health, player.coin, player.last_slash, player.index, player.direction, player.current_time = player_state
+        player.pos.update(x, y)
+        player.vel.update(vx, vy)
+        player.images           = self.atlas.tables["player"][player.direction]
+        player.image            = player.images[player.index]
+        player.rect             = player.image.get_rect()
+        player.rect.center      = player.pos
+        player.hit_rect.center  = player.pos
+        player.add(self.all_sprites, self.updating)
+
+        self.ticks, self.seed, self.playing, self.paused = ticks, seed, playing, False
+        self.random.setstate((3, random_state[:625], None if math.isnan(random_state[625]) else random_state[625]))
+        self.camera.camera      = pygame.Rect(camera_x, camera_y, self.camera.width, self.camera.height)
+        self.camera.view        = pygame.Rect(-camera_x, -camera_y, WIDTH, HEIGHT)
+        if self.flow is not None:
+            self.flow = FlowField(self.map)
+        self.drawn              = None
+
+    def restart(self, seed=None):
+        """
+        Restart : A new game from the snapshot new() took, without reading the map objects or building the map again.
+        """
+        self.restore(self.start_snapshot)
+        self.seed   = seed if seed is not None else int.from_bytes(os.urandom(8), "little")
+        self.random = Random(self.seed)
+        self.audio.restart()
 
 
     def quit_game(self):
+        self.stop_recording()
+        if POOL_REPORT:
+            print("\n".join(pool.report() for pool in self.pools.values()))
+        if AUDIO_REPORT:
+            print(self.audio.report())
+        if STREAM_REPORT and self.world is not None:
+            print(self.world.report())
         pygame.quit()
         quit()
 
@@ -361,60 +2211,215 @@ class Game:
                     self.draw_debug = not self.draw_debug
                 if event.key == pygame.K_p:
                     self.paused = not self.paused
-
+                if event.key == PROFILER_KEY:
+                    self.profiler.toggle_overlay()
+                if event.key == PROFILER_CSV_KEY:
+                    self.profiler.toggle_csv()
+                if event.key == SNAPSHOT_SAVE_KEY:
+                    with open(SNAPSHOT_FILE, "wb") as file:
+                        file.write(self.snapshot())
+                if event.key == SNAPSHOT_LOAD_KEY:
+                    try:
+                        with open(SNAPSHOT_FILE, "rb") as file:
+                            self.restore(file.read())
+                    except (OSError, ValueError):
+                        pass    # No quicksave, or one of another version or map, the game goes on
+
+
+    def get_pressed(self):
+        # Keyboard state read by the player, from the replay while one runs, replaced to script the input
+        if self.replay is not None:
+            return self.replay.keys
+        return pygame.key.get_pressed()
+
+    def load_map(self, map_name):
+        # Map played from the next new()
+        self.map_name       = map_name
+        self.map            = self.assets.get(map_name)
+        self.map_renderer   = MapRenderer(self.map)
+
+    def spawn_mob(self, x, y):
+        if self.mob_batch is not None:
+            return BatchMob(self, x, y)
+        mob = Mob(self, x, y)
+        if self.activity is not None:
+            # Sleeping mobs are not indexed again each frame, they stay in the mob grid
+            self.mob_grid.add(mob, mob.grid_rect())
+            self.activity.add(mob)
+        return mob
+
+    def spawn(self, sprite_class, *arguments):
+        # Swords, effects and items, taken from their pool when POOL_SPRITES
+        if POOL_SPRITES:
+            return self.pools[sprite_class].get(self, *arguments)
+        return sprite_class(self, *arguments)
+
+    def index_mobs(self):
+        self.mob_grid.clear()
+        for mob in self.mobs:
+            self.mob_grid.add(mob, mob.grid_rect())
+
+    def index_mob(self, mob):
+        # Grids of a mob moved outside its update, the mob grid is not rebuilt each frame under the ActivityScheduler
+        if self.mob_batch is not None:
+            return
+        self.mob_grid.move(mob, mob.grid_rect())
+        if self.activity is not None:
+            self.activity.grid.move(mob, mob.grid_rect())
 
     def update(self):
-        self.all_sprites.update()
+        self.ticks += self.dt * 1000
+        if self.flow is not None:
+            self.flow.update(self.player.pos)
+        if self.mob_batch is not None:
+            self.mob_batch.update()
+            self.all_sprites.update()
+        elif self.activity is not None:
+            self.updating.update()
+            self.activity.update()
+        else:
+            self.index_mobs()
+            self.all_sprites.update()
+        if self.world is not None:
+            self.world.update()
         self.camera.update(self.player)
+        self.profiler.lap("update")
+        self.collide()
+
+    def collide(self):
+        # Broadphase, the player is hit with its hit rect and picks items up with its whole rect
+        broadphase = self.broadphase
+        broadphase.clear()
+        broadphase.add("player", self.player, self.player.hit_rect)
+        broadphase.add("reach", self.player, self.player.rect)
+        for mob in self.mobs if self.activity is None else self.activity.awake:
+            broadphase.add("mob", mob, mob.rect)
+        for sword in self.sword:
+            broadphase.add("sword", sword, sword.hit_rect)
+        for item in self.items:
+            broadphase.add("item", item, item.rect)
+        contacts = broadphase.contacts()
+        self.profiler.lap("broadphase")
 
         # Player => Mobs
-        hits = pygame.sprite.spritecollide(self.player, self.mobs, False, collide_hit_rect)
-        for hit in hits:
-            choice(self.sounds_voice["player_damage"]).play()
-            self.player.health -= MOB_DAMAGE
-            self.player.pos += vec(MOB_KNOCKBACK, 0).rotate(-hits[0].rot)
-            hit.vel = vec(0, 0)
-            if self.player.health <= 0:
+        for player, mob in contacts["player", "mob"]:
+            self.audio.play("player_damage", self.random.choice(self.sounds_voice["player_damage"]))
+            player.health -= MOB_DAMAGE
+            player.pos += vec(MOB_KNOCKBACK, 0).rotate(-mob.rot)
+            mob.vel = vec(0, 0)
+            if player.health <= 0:
                 self.playing = False
+        self.profiler.lap("player_mobs")
 
         # Player => Items
-        hits = pygame.sprite.spritecollide(self.player, self.items, True)
-        for hit in hits:
-            Effect(self, hit.pos, "pick_up")
-            self.sounds_effects["pick_up"].play()
+        for player, hit in contacts["reach", "item"]:
+            hit.kill()
+            self.spawn(Effect, hit.pos, "pick_up")
+            self.audio.play("pick_up", self.sounds_effects["pick_up"])
             if hit.type == "heart":
-                self.player.add_health(HEART_AMOUNT)
+                player.add_health(HEART_AMOUNT)
             if hit.type == "coin":
-                self.player.coin += 1
-
-        # Sword => Mobs
-        hits_1 = pygame.sprite.groupcollide(self.mobs, self.sword, False, False, collide_hit_rect)
-        hits_2 = pygame.sprite.groupcollide(self.sword, self.mobs, False, False, collide_hit_rect)
-        for mobs in hits_1:
-            for sword in hits_2:
-                if sword.hit == False:
-                    sword.hit = True
-                    choice(self.sounds_effects["sword"]).play()
-                    mobs.health -= SWORD_DAMAGE
-                    mobs.pos += vec(SWORD_KNOCKBACK, 0).rotate(-sword.rot)
-                    mobs.vel = vec(0, 0)
-
+                player.coin += 1
+        self.profiler.lap("player_items")
+
+        # Sword => Mobs, each sword hits the first mob it touches
+        for sword, mob in contacts["sword", "mob"]:
+            if sword.hit == False:
+                sword.hit = True
+                self.audio.play("sword", self.random.choice(self.sounds_effects["sword"]))
+                mob.health -= SWORD_DAMAGE
+                mob.pos += vec(SWORD_KNOCKBACK, 0).rotate(-sword.rot)
+                mob.vel = vec(0, 0)
+                self.index_mob(mob)
+        self.profiler.lap("sword_mobs")
+
+
+    def dirty_rects(self, sprites, visible):
+        """
+        Dirty   : Screen rects that changed since the last frame, when only sprites moved, animated, appeared or left.
+                  None when the whole screen has to be redrawn: camera moved, HUD or overlays changed, too much changed.
+        """
+        drawn = {}
+        for index in visible:
+            sprite = sprites[index]
+            drawn[sprite] = sprite.image, self.camera.apply(sprite)
+        state = self.camera.camera.topleft, self.paused, self.draw_debug, self.profiler.overlay, self.player.health, self.player.coin
+        previous, self.drawn = self.drawn, drawn
+        previous_state, self.draw_state = self.draw_state, state
+        if previous is None or state != previous_state or self.draw_debug or self.profiler.overlay:
+            return None
+
+        rects = []
+        for sprite, (image, rect) in drawn.items():
+            old = previous.pop(sprite, None)
+            if old is None:
+                rects.append(rect)
+            elif old[0] is not image or old[1] != rect:
+                rects.append(rect)
+                rects.append(old[1])
+        rects.extend(rect for image, rect in previous.values())
+        rects = merge_rects(rects, self.gameDisplay.get_rect())
+        if sum(rect.width * rect.height for rect in rects) > DIRTY_MAX_AREA * WIDTH * HEIGHT:
+            return None
+        return rects
+
+    def draw_dirty(self, sprites, visible, rects):
+        # Map, HUD and sprites redrawn inside the dirty rects only, then only those rects presented
+        for rect in rects:
+            self.gameDisplay.set_clip(rect)
+            self.map_renderer.draw(self.gameDisplay, self.camera)
+            self.player.draw_health()
+            self.player.draw_coin()
+            for index in visible:
+                sprite = sprites[index]
+                position = self.drawn[sprite][1]
+                if position.colliderect(rect):
+                    self.gameDisplay.blit(sprite.image, position)
+        self.gameDisplay.set_clip(None)
+        self.profiler.lap("sprites")
+        self.gameDisplay.update(rects)
+        self.profiler.lap("present")
 
     def draw(self):
-        self.gameDisplay.blit(self.map_img, self.camera.apply_rect(self.map_rect))
+        # Sprites in view, kept in layer order
+        sprites = self.all_sprites.sprites()
+        visible = self.camera.view.collidelistall([sprite.rect for sprite in sprites])
+        self.sprites_drawn  = len(visible)
+        self.sprites_culled = len(sprites) - len(visible)
+        if DIRTY_RECTS:
+            rects = self.dirty_rects(sprites, visible)
+            if rects is not None:
+                self.draw_dirty(sprites, visible, rects)
+                return
+
+        self.map_renderer.draw(self.gameDisplay, self.camera)
+        self.profiler.lap("map")
         self.player.draw_health()
         self.player.draw_coin()
-        for sprite in self.all_sprites:
+        self.profiler.lap("hud")
+
+        for index in visible:
+            sprite = sprites[index]
             self.gameDisplay.blit(sprite.image, self.camera.apply(sprite))
             if self.draw_debug:
                 pygame.draw.rect(self.gameDisplay, CYAN, self.camera.apply_rect(sprite.hit_rect), 1)
+        self.profiler.lap("sprites")
         if self.draw_debug:
-            for wall in self.walls:
+            for wall in self.wall_grid.query(self.camera.view):
                 pygame.draw.rect(self.gameDisplay, CYAN, self.camera.apply_rect(wall.rect), 1)
+            self.draw_text("Drawn: %d  Culled: %d" % (self.sprites_drawn, self.sprites_culled), self.font, 24, CYAN, WIDTH - 10, 10, align="ne")
+            self.draw_text("Chunks: %d  %d KB" % (len(self.map_renderer.chunks), self.map_renderer.memory // 1024), self.font, 24, CYAN, WIDTH - 10, 30, align="ne")
+            if self.activity is not None:
+                self.draw_text("Mobs: %d full  %d middle  %d asleep" % (self.activity.full, self.activity.middle, self.activity.asleep), self.font, 24, CYAN, WIDTH - 10, 50, align="ne")
+            if self.world is not None:
+                self.draw_text("Region: %s  %d KB resident" % (self.world.current.name, self.world.memory() // 1024), self.font, 24, CYAN, WIDTH - 10, 70, align="ne")
         if self.paused:
             self.gameDisplay.blit(self.dim_screen, (0, 0))
             self.draw_text("Paused", self.font, 105, RED, WIDTH/2, HEIGHT/2, align="center")
+        self.profiler.draw(self.gameDisplay)
+        self.profiler.lap("overlay")
         self.gameDisplay.update()
+        self.profiler.lap("present")
 
 
 
@@ -433,6 +2438,11 @@ class ScaledGame(pygame.Surface):
     set_fullscreen  = False
     factor_w        = 1
     factor_h        = 1
+    smooth          = PRESENT_SMOOTH
+    scaled_surface  = None
+    caption         = None
+    caption_time    = 0
+    redraw          = True
 
     def __init__(self, title, game_size, FPS, first_screen=False):
         # Title
@@ -481,19 +2491,54 @@ class ScaledGame(pygame.Surface):
             self.factor_w = 1
             self.factor_h = 1
             self.set_fullscreen = True
+            self.redraw = True
         else:
             self.resize = True
             self.set_fullscreen = False
 
 
-    def update(self):
+    def unscaled(self):
+        # Same size as the window, or not resized yet
+        return self.set_fullscreen == True or self.game_scaled is None or tuple(self.game_scaled) == tuple(self.game_size)
+
+    def present(self):
+        # Same size as the window, or not resized yet: no scaling
+        if self.unscaled():
+            self.screen.blit(self, self.game_gap)
+            return
+
+        # Destination reused until the next resize, the window itself when the game fills it
+        if self.scaled_surface is None:
+            if self.screen.get_size() == tuple(self.game_scaled) and tuple(self.game_gap) == (0, 0):
+                self.scaled_surface = self.screen
+            else:
+                self.scaled_surface = pygame.Surface(self.game_scaled, 0, self.screen)
+
+        if self.smooth == True and self.scaled_surface.get_bytesize() >= 3:
+            pygame.transform.smoothscale(self, self.game_scaled, self.scaled_surface)
+        else:
+            pygame.transform.scale(self, self.game_scaled, self.scaled_surface)
+        if self.scaled_surface is not self.screen:
+            self.screen.blit(self.scaled_surface, self.game_gap)
+
+    def update(self, rects=None):
+        """
+        Update  : Presents the game on the window, resized to fit it.
+        Rects   : Only these game rects are copied and pushed to the display, when the game is not scaled.
+        """
         # Display FPS in window title
         if self.fps == True:
-            pygame.display.set_caption(self.title + " - " + str(int(self.clock.get_fps())) + "fps")
+            now = pygame.time.get_ticks()
+            if now - self.caption_time >= CAPTION_RATE:
+                self.caption_time = now
+                caption = self.title + " - " + str(int(self.clock.get_fps())) + "fps"
+                if caption != self.caption:
+                    self.caption = caption
+                    pygame.display.set_caption(caption)
 
         # Updates screen properly
         win_size_done = False # Changes to True if the window size is got by the VIDEORESIZE event below
-        for event in pygame.event.get():
+        for event in pygame.event.get(VIDEORESIZE):
             if event.type == VIDEORESIZE:
                 ss = [event.w, event.h]
                 self.resize = True
@@ -502,12 +2547,8 @@ class ScaledGame(pygame.Surface):
                 if ss[0] == self.screen_info.current_w:
                     self.zoom = True
 
-        # Fullscreen
-        if self.set_fullscreen == True:
-            self.screen.blit(self, self.game_gap)
-
         # Resize
-        elif self.resize == True:
+        if self.set_fullscreen == False and self.resize == True:
             # Sizes not gotten by resize event
             if win_size_done == False:
                 ss = [self.screen.get_width(), self.screen.get_height()]
@@ -522,7 +2563,9 @@ class ScaledGame(pygame.Surface):
 
             # Scale game to screen resolution, keeping aspect ratio
             self.screen = pygame.display.set_mode(self.game_scaled, RESIZABLE)
+            self.scaled_surface = None
             self.resize = False
+            self.redraw = True
 
             # Usable Variables
             self.factor_w = self.game_scaled[0] / self.get_width()
@@ -530,14 +2573,22 @@ class ScaledGame(pygame.Surface):
             self.ss = ss
 
         # Add game to screen with the scaled size and gap required.
-        self.screen.blit(pygame.transform.scale(self, self.game_scaled), self.game_gap)
+        if rects is not None and not self.redraw and self.unscaled():
+            screen_rects = [rect.move(self.game_gap) for rect in rects]
+            for rect, screen_rect in zip(rects, screen_rects):
+                self.screen.blit(self, screen_rect, rect)
+            pygame.display.update(screen_rects)
+            return
+        self.present()
+        self.redraw = False
 
         pygame.display.flip()
-        self.clock.tick(self.FPS)
 
 
 
 class Text():
+    cache = TextCache(TEXT_CACHE_SIZE)
+
     def __init__(self, text, pos, hollow=False, outline=False, stroke=0):
         """
         Text     : text, font
@@ -554,7 +2605,7 @@ class Text():
         self.center = pos[0]
         self.x      = pos[1]
         self.y      = pos[2]
-        self.textSurface = self.font.render(self.text, True, self.color)
+        self.textSurface = self.cache.get((self.font, self.text, tuple(self.color), "plain"), lambda: self.font.render(self.text, True, self.color))
 
         # Center
         if self.center == False:
@@ -569,10 +2620,12 @@ class Text():
         self.outline    = outline
 
         if isinstance(self.outline, tuple) == True:
-            self.textSurface = self.textOutline(self.font, self.text, self.color, self.outline)
+            key = self.font, self.text, tuple(self.color), ("outline", self.outline)
+            self.textSurface = self.cache.get(key, lambda: self.textOutline(self.font, self.text, self.color, self.outline))
 
         elif hollow == True:
-            self.textSurface = self.textHollow(self.font, self.text, self.color)
+            key = self.font, self.text, tuple(self.color), "hollow"
+            self.textSurface = self.cache.get(key, lambda: self.textHollow(self.font, self.text, self.color))
 
         self.display.blit(self.textSurface, self.textRect)
 
@@ -606,19 +2659,94 @@ class Text():
 
 
 class Map():
-    def __init__(self, filename):
-        self.tmxdata    = pytmx.load_pygame(filename, pixelalpha=True)
-        self.width      = self.tmxdata.width  * self.tmxdata.tilewidth
-        self.height     = self.tmxdata.height * self.tmxdata.tileheight
-
-    def render(self, surface):
-        ti = self.tmxdata.get_tile_image_by_gid
-        for layer in self.tmxdata.visible_layers:
+    def __init__(self, filename, decoded=None):
+        """
+        Map     : Tile layers as flat arrays of gids, the objects and the collision of a .tmx file.
+        Load    : From the compiled map while it is up to date, otherwise parsed by pytmx and compiled again.
+        """
+        if decoded is None:
+            decoded = decode_map(filename)
+        self.filename   = filename
+        self.rects      = None
+        source, images  = decoded
+        if isinstance(source, CompiledMap):
+            self.load_compiled(source)
+        else:
+            self.load_tmx(source, images)
+        self.width      = self.columns * self.tilewidth
+        self.height     = self.rows    * self.tileheight
+
+    def load_compiled(self, compiled):
+        self.columns, self.rows         = compiled.columns, compiled.rows
+        self.tilewidth, self.tileheight = compiled.tilewidth, compiled.tileheight
+        self.layers     = compiled.layers
+        self.objects    = compiled.objects
+        self.rects      = compiled.rects
+        self.images     = [None] * (max(compiled.tiles, default=0) + 1)
+        for gid, (image, mode, colorkey) in compiled.tiles.items():
+            self.images[gid] = convert_tile(image, mode, colorkey)
+
+    def load_tmx(self, tmxdata, images):
+        # Parsed and decoded by decode_map, only the conversion is left
+        loaded = set()
+        tmxdata.image_loader = decoded_image_loader(images, loaded)
+        tmxdata.reload_images()
+        self.columns, self.rows         = tmxdata.width, tmxdata.height
+        self.tilewidth, self.tileheight = tmxdata.tilewidth, tmxdata.tileheight
+        self.images     = tmxdata.images
+        self.layers     = []
+        for layer in tmxdata.layers:
             if isinstance(layer, pytmx.TiledTileLayer):
-                for x, y, gid in layer:
-                    tile = ti(gid)
-                    if tile:
-                        surface.blit(tile, (x * self.tmxdata.tilewidth, y * self.tmxdata.tileheight))
+                self.layers.append((layer.name, bool(layer.visible), array("I", [gid for row in layer.data for gid in row])))
+        self.objects    = [(tile_object.name or "", tile_object.x, tile_object.y, tile_object.width, tile_object.height) for tile_object in tmxdata.objects]
+        if MAP_COMPILE:
+            try:
+                write_compiled_map(self, self.filename, map_dependencies(self.filename, set(images) | loaded))
+            except OSError:
+                pass
+
+    def collision_tiles(self):
+        tiles = []
+        for name, visible, gids in self.layers:
+            if name == "collision":
+                for index, gid in enumerate(gids):
+                    if gid:
+                        tiles.append((index % self.columns, index // self.columns))
+        return tiles
+
+    def free_tile(self, x, y):
+        # Center of the tile without collision nearest x, y in pixels
+        walls = set(self.collision_tiles())
+        column, row = min(((column, row) for row in range(self.rows) for column in range(self.columns) if (column, row) not in walls),
+                          key=lambda tile: (tile[0] * self.tilewidth + self.tilewidth / 2 - x) ** 2 + (tile[1] * self.tileheight + self.tileheight / 2 - y) ** 2)
+        return column * self.tilewidth + self.tilewidth / 2, row * self.tileheight + self.tileheight / 2
+
+    def collision_rects(self, merge=MERGE_COLLISION):
+        if merge:
+            if self.rects is None:
+                self.rects = merge_tiles(self.collision_tiles())
+            return list(self.rects)
+        return [(x, y, 1, 1) for x, y in self.collision_tiles()]
+
+    def render(self, surface, area=None):
+        """
+        Render  : Visible tile layers onto surface.
+        Area    : Map rectangle drawn at the surface origin, the whole map by default.
+        """
+        if area is None:
+            area = pygame.Rect(0, 0, self.width, self.height)
+        images = self.images
+        tw, th = self.tilewidth, self.tileheight
+        x1, y1 = max(0, area.left // tw), max(0, area.top // th)
+        x2, y2 = min(self.columns, (area.right - 1) // tw + 1), min(self.rows, (area.bottom - 1) // th + 1)
+        for name, visible, gids in self.layers:
+            if visible:
+                for y in range(y1, y2):
+                    row = y * self.columns
+                    for x in range(x1, x2):
+                        tile = images[gids[row + x]]
+                        if tile:
+                            surface.blit(tile, (x * tw - area.x, y * th - area.y))
 
     def make_map(self):
         temp_surface = pygame.Surface((self.width, self.height))
@@ -627,9 +2755,72 @@ class Map():
 
 
 
+class MapRenderer():
+    def __init__(self, map, chunk_size=MAP_CHUNK_SIZE, budget=MAP_CACHE_BUDGET, margin=MAP_CHUNK_MARGIN):
+        """
+        Chunks  : The map is rendered in chunk_size squares, only when they come within margin of the view.
+        Cache   : Rendered chunks are kept in least recently used order until they exceed budget bytes.
+                  The chunks the current draw needs are pinned, the budget only applies to the chunks outside them.
+        """
+        self.map        = map
+        self.chunk_size = chunk_size
+        self.budget     = budget
+        self.margin     = margin
+        self.chunks     = OrderedDict()
+        self.memory     = 0
+        self.rendered   = 0
+        self.evicted    = 0
+
+    def chunk_rect(self, key):
+        size = self.chunk_size
+        rect = pygame.Rect(key[0] * size, key[1] * size, size, size)
+        return rect.clip(pygame.Rect(0, 0, self.map.width, self.map.height))
+
+    def get_chunk(self, key, pinned=()):
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks.move_to_end(key)
+            return chunk
+        rect = self.chunk_rect(key)
+        chunk = pygame.Surface(rect.size)
+        self.map.render(chunk, rect)
+        self.chunks[key] = chunk
+        self.memory += chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+        self.rendered += 1
+        # Evict the least recently used chunks, never the one just rendered or a pinned one
+        if self.memory > self.budget:
+            for old_key in [old_key for old_key in self.chunks if old_key != key and old_key not in pinned]:
+                if self.memory <= self.budget:
+                    break
+                old_chunk = self.chunks.pop(old_key)
+                self.memory -= old_chunk.get_width() * old_chunk.get_height() * old_chunk.get_bytesize()
+                self.evicted += 1
+        return chunk
+
+    def chunk_keys(self, rect):
+        size = self.chunk_size
+        rect = rect.clip(pygame.Rect(0, 0, self.map.width, self.map.height))
+        if rect.width <= 0 or rect.height <= 0:
+            return []
+        return [(x, y) for y in range(rect.top // size, (rect.bottom - 1) // size + 1)
+                       for x in range(rect.left // size, (rect.right - 1) // size + 1)]
+
+    def draw(self, surface, camera):
+        view = camera.view
+        keys = self.chunk_keys(view.inflate(2 * self.margin, 2 * self.margin))
+        pinned = set(keys)
+        for key in keys:
+            chunk = self.get_chunk(key, pinned)
+            rect = self.chunk_rect(key)
+            if rect.colliderect(view):
+                surface.blit(chunk, camera.apply_rect(rect))
+
+
+
 class Camera():
     def __init__(self, width, height):
         self.camera = pygame.Rect(0, 0, width, height)
+        self.view   = pygame.Rect(0, 0, WIDTH, HEIGHT)
         self.width  = width
         self.height = height
     def apply(self, entity):
@@ -648,6 +2839,7 @@ class Camera():
         y = min(0, y)                           # Top
         y = max(-(self.height-HEIGHT), y)       # Bottom
         self.camera = pygame.Rect(x, y, self.width, self.height)
+        self.view   = pygame.Rect(-x, -y, WIDTH, HEIGHT)
 
 
 
@@ -655,7 +2847,7 @@ class Player(pygame.sprite.Sprite):
     def __init__(self, game, x, y):
         # Setup
         self.game               = game
-        self.groups             = self.game.all_sprites
+        self.groups             = self.game.all_sprites, self.game.updating
         self._layer             = LAYER_PLAYER
         pygame.sprite.Sprite.__init__(self, self.groups)
 
@@ -664,7 +2856,7 @@ class Player(pygame.sprite.Sprite):
         self.health             = self.maxhealth
         self.coin               = 0
 
-        self.last_slash         = 0
+        self.last_slash         = -SWORD_RATE
         self.moving             = False
 
         # Surface
@@ -674,17 +2866,18 @@ class Player(pygame.sprite.Sprite):
 
         self.base_index         = 1
         self.index              = self.base_index
-        self.images             = self.game.player_img
-        self.images_bottom      = self.images[0]
-        self.images_left        = self.images[1]
-        self.images_right       = self.images[2]
-        self.images_top         = self.images[3]
+        self.direction          = DIRECTION_BOTTOM
+        self.images             = self.game.atlas.tables["player"]
+        self.images_bottom      = self.images[DIRECTION_BOTTOM]
+        self.images_left        = self.images[DIRECTION_LEFT]
+        self.images_right       = self.images[DIRECTION_RIGHT]
+        self.images_top         = self.images[DIRECTION_TOP]
         self.images             = self.images_bottom
         self.image              = self.images_bottom[self.index]
 
         self.rect               = self.image.get_rect()
         self.rect.center        = self.pos
-        self.hit_rect           = PLAYER_HIT_RECT
+        self.hit_rect           = PLAYER_HIT_RECT.copy()   # Not shared by the players of several games in one process
         self.hit_rect.center    = self.rect.center
 
         self.dt                 = game.dt
@@ -692,24 +2885,28 @@ class Player(pygame.sprite.Sprite):
         self.animation_time     = 0.15
 
     def get_keys(self):
-        keys = pygame.key.get_pressed()
+        keys = self.game.get_pressed()
 
         # Movement
         self.vel = vec(0, 0)
         if keys[pygame.K_LEFT] or keys[pygame.K_a]:
             self.vel.x = -PLAYER_SPEED
+            self.direction = DIRECTION_LEFT
             self.images = self.images_left
             self.rot = 180
         if keys[pygame.K_RIGHT] or keys[pygame.K_d]:
             self.vel.x = +PLAYER_SPEED
+            self.direction = DIRECTION_RIGHT
             self.images = self.images_right
             self.rot = 0
         if keys[pygame.K_UP] or keys[pygame.K_w]:
             self.vel.y = -PLAYER_SPEED
+            self.direction = DIRECTION_TOP
             self.images = self.images_top
             self.rot = 90
         if keys[pygame.K_DOWN] or keys[pygame.K_s]:
             self.vel.y = +PLAYER_SPEED
+            self.direction = DIRECTION_BOTTOM
             self.images = self.images_bottom
             self.rot = -90
         if self.vel.x != 0 and self.vel.y != 0:
@@ -718,8 +2915,9 @@ class Player(pygame.sprite.Sprite):
 
         # Weapon
         if keys[pygame.K_SPACE]:
-            if pygame.time.get_ticks() - self.last_slash >= SWORD_RATE:
-                Sword(self.game, self)
+            if self.game.ticks - self.last_slash >= SWORD_RATE:
+                self.game.spawn(Sword, self)
+                self.game.audio.play("player_attack", self.game.random.choice(self.game.sounds_voice["player_attack"]))
 
     def draw_health(self):
         for x in range(int(self.health)):
@@ -747,9 +2945,9 @@ class Player(pygame.sprite.Sprite):
         self.rect.center = self.pos
 
         self.hit_rect.centerx = self.pos.x
-        collide_with_walls(self, self.game.walls, "x")
+        collide_with_walls(self, self.game.wall_index, "x")
         self.hit_rect.centery = self.pos.y
-        collide_with_walls(self, self.game.walls, "y")
+        collide_with_walls(self, self.game.wall_index, "y")
         self.rect.center = self.hit_rect.center
 
         if self.health <= 0:
@@ -777,13 +2975,9 @@ class Mob(pygame.sprite.Sprite):
         self.acc = vec(0, 0)
 
         self.index              = 0
-        self.images             = self.game.mob_img.copy()
-        self.images_bottom      = self.images[0]
-        self.images_left        = self.images[1]
-        self.images_right       = self.images[2]
-        self.images_top         = self.images[3]
-        self.images             = self.images_bottom
-        self.image              = self.images_bottom[self.index]
+        self.direction          = DIRECTION_BOTTOM
+        self.images             = self.game.atlas.tables["mob"][self.maxhealth][self.direction]
+        self.image              = self.images[self.index]
 
         self.rect               = self.image.get_rect()
         self.rect.center        = self.pos
@@ -796,75 +2990,402 @@ class Mob(pygame.sprite.Sprite):
 
     def update_angle(self):
         if -135 <= self.rot <= -45:
-            self.images = self.images_bottom
+            self.direction = DIRECTION_BOTTOM
         if -180 <= self.rot <= -135 or 135 <=  self.rot <= 180:
-            self.images = self.images_left
+            self.direction = DIRECTION_LEFT
         if -0 <= self.rot <= 45 or -45 <=  self.rot <= 0:
-            self.images = self.images_right
+            self.direction = DIRECTION_RIGHT
         if 45 <=  self.rot <= 135:
-            self.images = self.images_top
+            self.direction = DIRECTION_TOP
+
+    def update_images(self):
+        # Frames with the health bar for the current health
+        if self.health < 0:
+            self.health = 0
+        health = int(min(self.health, self.maxhealth))
+        self.images = self.game.atlas.tables["mob"][health][self.direction]
+
+    def grid_rect(self):
+        return pygame.Rect(int(self.pos.x), int(self.pos.y), 0, 0)
+
+    def neighbour_rect(self):
+        return pygame.Rect(int(self.pos.x) - MOB_RADIUS - 1, int(self.pos.y) - MOB_RADIUS - 1, 2 * MOB_RADIUS + 3, 2 * MOB_RADIUS + 3)
 
     def avoid_mobs(self):
-        for mob in self.game.mobs:
+        # Neighbours come from the mob grid in the same order as game.mobs
+        for mob in self.game.mob_grid.query(self.neighbour_rect()):
             if mob != self:
                 dist = self.pos - mob.pos
-                if 0 < dist.length() < MOB_RADIUS:
-                    if self.acc != -dist.normalize():
-                        self.acc += dist.normalize()
-                    else:
-                        self.acc += vec(choice((self.acc.y, -self.acc.y)), choice((self.acc.x, -self.acc.x)))
+                dist_squared = dist.length_squared()
+                if dist_squared == 0 or dist_squared >= MOB_RADIUS**2:
+                    continue
+                direction = dist.normalize()
+                if self.acc != -direction:
+                    self.acc += direction
+                else:
+                    self.acc += vec(self.game.random.choice((self.acc.y, -self.acc.y)), self.game.random.choice((self.acc.x, -self.acc.x)))
 
     def update(self):
         self.update_angle()
+        self.update_images()
         update_time_dependent(self)
 
         target_dist = self.target.pos - self.pos
         if target_dist.length_squared() <= DETECT_RADIUS**2:
+            # Around the walls while the flow field reaches, straight at the player next to it
+            steer = self.game.flow.steer(self.pos) if self.game.flow is not None else None
+            if steer is not None and steer.length_squared() > 0:
+                target_dist = steer
             self.rot = target_dist.angle_to(vec(1, 0))
             self.acc = vec(1, 0).rotate(-self.rot)
             self.avoid_mobs()
-            self.acc.scale_to_length(MOB_SPEED)
+            if self.acc.length_squared() > 0:
+                self.acc.scale_to_length(MOB_SPEED)
             self.acc -= self.vel
             self.vel += self.acc * self.game.dt
             self.pos += self.vel * self.game.dt + 0.5 * self.acc * self.game.dt ** 2
 
             self.hit_rect.centerx = self.pos.x
-            collide_with_walls(self, self.game.walls, "x")
+            collide_with_walls(self, self.game.wall_index, "x")
             self.hit_rect.centery = self.pos.y
-            collide_with_walls(self, self.game.walls, "y")
+            collide_with_walls(self, self.game.wall_index, "y")
             self.rect.center = self.hit_rect.center
+        # Also out of the chase, a sword may have knocked the mob into other cells since its last update
+        self.game.mob_grid.move(self, self.grid_rect())
 
-        draw_health(self)
         if self.health <= 0:
-            Item(self.game, self.pos, choice(ITEM_DROPS))
+            self.game.spawn(Item, self.pos, self.game.random.choice(ITEM_DROPS))
+            self.game.mob_grid.remove(self)
             self.kill()
 
 
-class Sword(pygame.sprite.Sprite):
+class BatchVector(vec):
+    """
+    Vector  : A vector read from a batch_field, changed in place it writes itself back to its slot of the MobBatch array.
+              Vectors computed from it are copies that do not write back.
+    """
+    field = None    # (batch, array name, slot)
+
+    def write(self):
+        if self.field is not None:
+            batch, name, slot = self.field
+            getattr(batch, name)[slot] = tuple(self)
+
+    def set_x(self, value):
+        vec.x.__set__(self, value)
+        self.write()
+
+    def set_y(self, value):
+        vec.y.__set__(self, value)
+        self.write()
+
+    x = property(vec.x.__get__, set_x)
+    y = property(vec.y.__get__, set_y)
+
+def write_back(method):
+    def changed(self, *arguments):
+        result = method(self, *arguments)
+        self.write()
+        return result
+    return changed
+
+for vector_method in ("__setitem__", "__iadd__", "__isub__", "__imul__", "__itruediv__", "__ifloordiv__", "update", "from_polar", "normalize_ip",
+             "scale_to_length", "rotate_ip", "rotate_ip_rad", "rotate_rad_ip", "reflect_ip", "clamp_magnitude_ip", "move_towards_ip"):
+    if hasattr(vec, vector_method):
+        setattr(BatchVector, vector_method, write_back(getattr(vec, vector_method)))
+
+def batch_field(name, vector=False):
+    # Attribute stored in the MobBatch array called name, at the slot of the sprite
+    def get(self):
+        value = getattr(self.batch, name)[self.slot]
+        if not vector:
+            return value.item()
+        vector_view = BatchVector(value.tolist())
+        vector_view.field = self.batch, name, self.slot
+        return vector_view
+    def set(self, value):
+        getattr(self.batch, name)[self.slot] = tuple(value) if vector else value
+    return property(get, set)
+
+
+class BatchMob(Mob):
+    """
+    Mob     : Thin view over one slot of the MobBatch arrays, used for rendering and gameplay hits.
+              Movement, facing, animation and death are simulated by MobBatch.update.
+    """
+    def __init__(self, game, x, y):
+        self.batch  = game.mob_batch
+        self.slot   = self.batch.add(self)
+        Mob.__init__(self, game, x, y)
+
+    pos     = batch_field("pos", vector=True)
+    vel     = batch_field("vel", vector=True)
+    acc     = batch_field("acc", vector=True)
+    rot     = batch_field("rot")
+    health  = batch_field("health")
+    index   = batch_field("index")
+    direction = batch_field("direction")
+    current_time = batch_field("timer")
+
+    def update(self):
+        pass
+
+
+
+class MobBatch():
+    def __init__(self, game, capacity=64):
+        """
+        Batch   : Structure-of-arrays simulation of every BatchMob.
+                  Detection, seek steering, separation, integration and facing run as NumPy operations once per frame.
+                  Only mobs whose hitbox reaches a solid tile go through collide_with_walls one by one.
+        Limits  : Every mob is simulated each frame, there is no ActivityScheduler (MOB_LOD) or FlowField (MOB_FLOW).
+                  Holds 60 FPS up to about 1500 mobs, 5000 mobs take about 85 ms a frame.
+        """
+        self.game       = game
+        self.capacity   = 0
+        self.count      = 0
+        self.free       = []
+        self.sprites    = []
+        self.pos        = numpy.zeros((0, 2))
+        self.vel        = numpy.zeros((0, 2))
+        self.acc        = numpy.zeros((0, 2))
+        self.rot        = numpy.zeros(0)
+        self.health     = numpy.zeros(0)
+        self.timer      = numpy.zeros(0)
+        self.frame_dt   = numpy.zeros(0)
+        self.index      = numpy.zeros(0, dtype=numpy.int32)
+        self.direction  = numpy.zeros(0, dtype=numpy.int32)
+        self.alive      = numpy.zeros(0, dtype=bool)
+        self.grow(capacity)
+
+        # Animation frames with the health bar already painted
+        self.frames     = game.atlas.tables["mob"]
+        self.frame_count = len(self.frames[0][0])
+
+        # Solid tiles as a summed-area table, to find the mobs that can touch a wall
+        map = game.map
+        self.tilewidth, self.tileheight = map.tilewidth, map.tileheight
+        solid = numpy.zeros((map.rows, map.columns), dtype=numpy.int32)
+        for x, y in map.collision_tiles():
+            solid[y, x] = 1
+        self.solid_sum  = numpy.zeros((map.rows + 1, map.columns + 1), dtype=numpy.int32)
+        self.solid_sum[1:, 1:] = solid.cumsum(0).cumsum(1)
+        self.wall_probe = WallProbe()
+
+    def grow(self, capacity):
+        extra = capacity - self.capacity
+        for name in ("pos", "vel", "acc", "rot", "health", "timer", "frame_dt", "index", "direction", "alive"):
+            array = getattr(self, name)
+            setattr(self, name, numpy.concatenate((array, numpy.zeros((extra,) + array.shape[1:], dtype=array.dtype))))
+        self.sprites.extend([None] * extra)
+        self.capacity = capacity
+
+    def add(self, sprite):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.count == self.capacity:
+                self.grow(self.capacity * 2)
+            slot = self.count
+            self.count += 1
+        self.sprites[slot]      = sprite
+        self.alive[slot]        = True
+        self.timer[slot]        = 0
+        self.frame_dt[slot]     = self.game.dt
+        self.index[slot]        = 0
+        self.direction[slot]    = DIRECTION_BOTTOM
+        return slot
+
+    def remove(self, slot):
+        self.sprites[slot]  = None
+        self.alive[slot]    = False
+        self.free.append(slot)
+
+    def update_angle(self, rot):
+        # Same ranges and precedence as Mob.update_angle: bottom, left, right, top
+        return numpy.select([(45 <= rot) & (rot <= 135),
+                             (-45 <= rot) & (rot <= 45),
+                             (rot <= -135) | (rot >= 135),
+                             (-135 <= rot) & (rot <= -45)],
+                            [DIRECTION_TOP, DIRECTION_RIGHT, DIRECTION_LEFT, DIRECTION_BOTTOM], default=-1)
+
+    def separation(self, movers, slots):
+        """
+        Separation : Sum of unit vectors pointing away from every mob closer than MOB_RADIUS,
+                     found through a sort on MOB_RADIUS-sized cells instead of all pairs.
+        """
+        pos     = self.pos
+        steer   = numpy.zeros((len(movers), 2))
+        cells   = numpy.floor(pos[slots] / MOB_RADIUS).astype(numpy.int64)
+        keys    = cells[:, 0] * 1000003 + cells[:, 1]
+        order   = numpy.argsort(keys, kind="stable")
+        sorted_keys, sorted_slots = keys[order], slots[order]
+        mover_cells = numpy.floor(pos[movers] / MOB_RADIUS).astype(numpy.int64)
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                search  = (mover_cells[:, 0] + dx) * 1000003 + mover_cells[:, 1] + dy
+                start   = numpy.searchsorted(sorted_keys, search, "left")
+                end     = numpy.searchsorted(sorted_keys, search, "right")
+                counts  = end - start
+                total   = counts.sum()
+                if not total:
+                    continue
+                owner   = numpy.repeat(numpy.arange(len(movers)), counts)
+                offset  = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                other   = sorted_slots[numpy.repeat(start, counts) + offset]
+                dist    = pos[movers[owner]] - pos[other]
+                length  = numpy.hypot(dist[:, 0], dist[:, 1])
+                close   = (length > 0) & (length < MOB_RADIUS)
+                if close.any():
+                    owner, away = owner[close], dist[close] / length[close, None]
+                    steer[:, 0] += numpy.bincount(owner, away[:, 0], len(movers))
+                    steer[:, 1] += numpy.bincount(owner, away[:, 1], len(movers))
+        return steer
+
+    def touches_wall(self, start, end):
+        # Tiles covered by the hitbox between its start and end position, clipped to the map
+        rows, columns = self.solid_sum.shape[0] - 1, self.solid_sum.shape[1] - 1
+        half_w, half_h = MOB_HIT_RECT.width / 2 + 1, MOB_HIT_RECT.height / 2 + 1
+        x1 = numpy.clip(numpy.floor((numpy.minimum(start[:, 0], end[:, 0]) - half_w) / self.tilewidth), 0, columns - 1).astype(int)
+        x2 = numpy.clip(numpy.floor((numpy.maximum(start[:, 0], end[:, 0]) + half_w) / self.tilewidth), 0, columns - 1).astype(int)
+        y1 = numpy.clip(numpy.floor((numpy.minimum(start[:, 1], end[:, 1]) - half_h) / self.tileheight), 0, rows - 1).astype(int)
+        y2 = numpy.clip(numpy.floor((numpy.maximum(start[:, 1], end[:, 1]) + half_h) / self.tileheight), 0, rows - 1).astype(int)
+        s = self.solid_sum
+        return (s[y2 + 1, x2 + 1] - s[y1, x2 + 1] - s[y2 + 1, x1] + s[y1, x1]) > 0
+
+    def collide_walls(self, slots):
+        probe = self.wall_probe
+        for slot in slots.tolist():
+            sprite = self.sprites[slot]
+            probe.pos       = vec(self.pos[slot].tolist())
+            probe.vel       = vec(self.vel[slot].tolist())
+            probe.rect      = sprite.rect
+            probe.hit_rect  = sprite.hit_rect
+            probe.hit_rect.centerx = probe.pos.x
+            collide_with_walls(probe, self.game.wall_index, "x")
+            probe.hit_rect.centery = probe.pos.y
+            collide_with_walls(probe, self.game.wall_index, "y")
+            self.pos[slot] = tuple(probe.pos)
+            self.vel[slot] = tuple(probe.vel)
+
+    def update(self):
+        slots = numpy.flatnonzero(self.alive[:self.count])
+        if not len(slots):
+            return
+        dt = self.game.dt
+
+        # Direction from the previous rotation (Mob.update_angle)
+        direction = self.update_angle(self.rot[slots])
+        keep = direction >= 0
+        self.direction[slots[keep]] = direction[keep]
+
+        # Animation (update_time_dependent, with the Mob.animation_time of 0.15)
+        self.timer[slots] += self.frame_dt[slots]
+        wrap = slots[self.timer[slots] >= 0.15]
+        self.timer[wrap] = 0
+        self.index[wrap] = (self.index[wrap] + 1) % self.frame_count
+
+        # Detection and seek steering
+        target = self.game.player.pos
+        dist = numpy.array((target.x, target.y)) - self.pos[slots]
+        near = (dist * dist).sum(1) <= DETECT_RADIUS**2
+        movers = slots[near]
+        if len(movers):
+            dist = dist[near]
+            length = numpy.hypot(dist[:, 0], dist[:, 1])
+            self.rot[movers] = -numpy.degrees(numpy.arctan2(dist[:, 1], dist[:, 0]))
+            steer = numpy.zeros((len(movers), 2))
+            steer[:, 0] = 1
+            moving = length > 0
+            steer[moving] = dist[moving] / length[moving, None]
+            steer += self.separation(movers, slots)
+            length = numpy.hypot(steer[:, 0], steer[:, 1])
+            moving = length > 0
+            steer[moving] *= (MOB_SPEED / length[moving])[:, None]
+
+            # Integration
+            start = self.pos[movers]
+            acc = steer - self.vel[movers]
+            self.vel[movers] += acc * dt
+            self.pos[movers] += self.vel[movers] * dt + 0.5 * acc * dt ** 2
+            self.acc[movers] = acc
+            walled = self.touches_wall(start, self.pos[movers])
+            if walled.any():
+                self.collide_walls(movers[walled])
+
+        # Sync the sprites
+        frames = self.frames
+        health = numpy.clip(self.health[slots], 0, MOB_HEALTH).astype(int).tolist()
+        for slot, center, direction, index, life in zip(slots.tolist(), self.pos[slots].tolist(), self.direction[slots].tolist(), self.index[slots].tolist(), health):
+            sprite = self.sprites[slot]
+            sprite.image = frames[life][direction][index]
+            sprite.rect.center = center
+            sprite.hit_rect.center = sprite.rect.center
+
+        # Deaths
+        for slot in slots[self.health[slots] <= 0].tolist():
+            self.game.spawn(Item, vec(self.pos[slot].tolist()), self.game.random.choice(ITEM_DROPS))
+            self.sprites[slot].kill()
+            self.remove(slot)
+
+
+
+class WallProbe():
+    def __init__(self):
+        self.pos        = vec(0, 0)
+        self.vel        = vec(0, 0)
+        self.rect       = None
+        self.hit_rect   = None
+
+
+
+class PooledSprite(pygame.sprite.Sprite):
+    pool = None
+
+    def kill(self):
+        # Back to the SpritePool it came from, once
+        alive = self.alive()
+        pygame.sprite.Sprite.kill(self)
+        if alive and self.pool is not None:
+            self.pool.release(self)
+
+
+
+class Sword(PooledSprite):
     def __init__(self, game, character):
+        pygame.sprite.Sprite.__init__(self)
+        self.pos                = vec(0, 0)
+        self.vel                = vec(0, 0)
+        self.rect               = pygame.Rect(0, 0, 0, 0)
+        self.hit_rect           = SWORD_HIT_RECT.copy()
+        self.reset(game, character)
+
+    def reset(self, game, character):
         # Setup
         self.game               = game
-        self.groups             = self.game.all_sprites, self.game.sword
+        self.groups             = self.game.all_sprites, self.game.updating, self.game.sword
         self._layer             = LAYER_SWORD
-        pygame.sprite.Sprite.__init__(self, self.groups)
+        self.add(self.groups)
 
         # Settings
         self.character              = character
         self.hit                    = False
-        self.spawn_time             = pygame.time.get_ticks()
+        self.spawn_time             = self.game.ticks
         self.character.last_slash   = self.spawn_time
-        choice(self.game.sounds_voice["player_attack"]).play()
 
         # Surface
         self.rot                = self.character.rot
-        self.pos                = vec(self.character.pos + SWORD_OFFSET.rotate(-self.rot))
-        self.vel                = vec(1, 0).rotate(-self.rot) * SWORD_SPEED
+        self.pos.update(SWORD_OFFSET)
+        self.pos.rotate_ip(-self.rot)
+        self.pos                += self.character.pos
+        self.vel.update(1, 0)
+        self.vel.rotate_ip(-self.rot)
+        self.vel                *= SWORD_SPEED
 
-        self.image              = pygame.transform.rotate(self.game.sword_img, self.rot-90)
+        self.image              = self.game.atlas.rotated("sword", self.rot-90)
 
-        self.rect               = self.image.get_rect()
+        self.rect.size          = self.image.get_size()
         self.rect.center        = self.pos
-        self.hit_rect           = SWORD_HIT_RECT
         self.hit_rect.center    = self.rect.center
 
     def update(self):
@@ -872,13 +3393,13 @@ class Sword(pygame.sprite.Sprite):
         self.rect.center = self.pos
         self.hit_rect.centerx = self.pos.x
         self.hit_rect.centery = self.pos.y
-        if pygame.time.get_ticks() - self.spawn_time > SWORD_LIFETIME:
+        if self.game.ticks - self.spawn_time > SWORD_LIFETIME:
             self.kill()
 
 
 
 class Obstacle(pygame.sprite.Sprite):
-    def __init__(self, game, x, y, w, h):
+    def __init__(self, game, x, y, w, h, columns=1, rows=1):
         # Settings
         self.game   = game
         self.groups = self.game.walls
@@ -886,34 +3407,45 @@ class Obstacle(pygame.sprite.Sprite):
         pygame.sprite.Sprite.__init__(self, self.groups)
 
         # Surface
-        self.rect = pygame.Rect(x, y, w, h)
+        self.rect = pygame.Rect(x, y, w * columns, h * rows)
         self.hit_rect = self.rect
         self.x = x
         self.y = y
+        self.tile_w = w
+        self.tile_h = h
+        self.columns = columns
+        self.rows = rows
         self.rect.x = self.x * w
         self.rect.y = self.y * h
 
 
 
-class Item(pygame.sprite.Sprite):
+class Item(PooledSprite):
     def __init__(self, game, pos, type):
+        pygame.sprite.Sprite.__init__(self)
+        self.pos                = vec(0, 0)
+        self.rect               = pygame.Rect(0, 0, 0, 0)
+        self.hit_rect           = pygame.Rect(0, 0, 0, 0)
+        self.reset(game, pos, type)
+
+    def reset(self, game, pos, type):
         # Setup
         self.game               = game
-        self.groups             = self.game.all_sprites, self.game.items
+        self.groups             = self.game.all_sprites, self.game.updating, self.game.items
         self._layer             = LAYER_ITEMS
-        pygame.sprite.Sprite.__init__(self, self.groups)
+        self.add(self.groups)
 
         # Settings
         self.type               = type
 
         # Surface
-        self.pos                = pos
+        self.pos.update(pos)
 
-        self.image              = self.game.item_images[self.type][0]
+        self.image              = self.game.atlas.tables[("item", self.type)][0]
 
-        self.rect               = self.image.get_rect()
+        self.rect.size          = self.image.get_size()
         self.rect.center        = self.pos
-        self.hit_rect           = self.image.get_rect()
+        self.hit_rect.size      = self.image.get_size()
         self.hit_rect.center    = self.rect.center
 
         self.tween = tween.linear
@@ -926,27 +3458,34 @@ class Item(pygame.sprite.Sprite):
 
 
 
-class Effect(pygame.sprite.Sprite):
+class Effect(PooledSprite):
     def __init__(self, game, pos, type):
+        pygame.sprite.Sprite.__init__(self)
+        self.pos                = vec(0, 0)
+        self.rect               = pygame.Rect(0, 0, 0, 0)
+        self.hit_rect           = pygame.Rect(0, 0, 0, 0)
+        self.reset(game, pos, type)
+
+    def reset(self, game, pos, type):
         # Setup
         self.game               = game
-        self.groups             = self.game.all_sprites, self.game.effects
+        self.groups             = self.game.all_sprites, self.game.updating, self.game.effects
         self._layer             = LAYER_EFFECTS
-        pygame.sprite.Sprite.__init__(self, self.groups)
+        self.add(self.groups)
 
         # Settings
         self.type               = type
 
         # Surface
-        self.pos                = pos
+        self.pos.update(pos)
 
         self.index              = 0
-        self.images             = self.game.effect_images[self.type]
+        self.images             = self.game.atlas.tables[("effect", self.type)]
         self.image              = self.images[self.index]
 
-        self.rect               = self.image.get_rect()
+        self.rect.size          = self.image.get_size()
         self.rect.center        = self.pos
-        self.hit_rect           = self.image.get_rect()
+        self.hit_rect.size      = self.image.get_size()
         self.hit_rect.center    = self.rect.center
 
         self.dt                 = game.dt
@@ -959,7 +3498,198 @@ class Effect(pygame.sprite.Sprite):
         if (self.index + 1) % len(self.images) == 0:
             self.kill()
 
-g = Game()
-while True:
-    g.new()
-    g.run()
+"""
+    Environment
+"""
+class GameEnv():
+    def __init__(self, map_name="Map_1.tmx", seed=None, repeat=ENV_REPEAT, max_steps=ENV_MAX_STEPS):
+        """
+        Env     : A headless Game played by actions, for bots and balancing runs: reset(), then step(action) until done.
+        Action  : Bits of the INPUT_KEYS held, as in the input traces, for the repeat updates of a step.
+        Observe : ENV_OBSERVATION floats, the player then the nearest ENV_MOBS mobs and ENV_ITEMS items, see observation().
+        Reward  : ENV_REWARDS per coin picked up, mob killed and health lost. Done when the player dies or after max_steps.
+        Seeds   : Each reset() without a seed starts the next game of the sequence seeded by seed.
+        """
+        self.game               = Game(headless=True)
+        self.game.load_map(map_name)
+        self.game.get_pressed   = lambda: self.keys
+        self.keys               = InputState()
+        self.repeat             = repeat
+        self.max_steps          = max_steps
+        self.seeds              = Random(seed)
+        self.steps              = 0
+
+    def reset(self, seed=None, out=None):
+        self.game.new(seed if seed is not None else self.seeds.getrandbits(64))
+        self.keys.bits  = 0
+        self.steps      = 0
+        return self.observation(out)
+
+    def step(self, action, out=None):
+        """
+        Step    : Holds action for repeat updates, the observation is written to out when given.
+        Return  : Observation, reward and done.
+        """
+        game, player = self.game, self.game.player
+        health, coin, mobs = player.health, player.coin, len(game.mobs)
+        self.keys.bits = action
+        game.step(self.repeat)
+        self.steps += 1
+        reward = ((player.coin - coin) * ENV_REWARDS["coin"] + (mobs - len(game.mobs)) * ENV_REWARDS["kill"]
+                  + max(0, health - player.health) * ENV_REWARDS["damage"])
+        done = not game.playing or (self.max_steps > 0 and self.steps >= self.max_steps)
+        return self.observation(out), reward, done
+
+    def observation(self, out=None):
+        """
+        Player  : x and y over the map size, health over PLAYER_HEALTH, coins, 1 when the sword is ready.
+        Sprites : Nearest first, x and y from the player over DETECT_RADIUS, then the mob's health over MOB_HEALTH
+                  or the item's index in ITEM_DROPS plus 1. Zeros for the missing ones.
+        Out     : Float buffer of ENV_OBSERVATION written in place, a new array when None.
+        """
+        game, player = self.game, self.game.player
+        x, y = player.pos
+        values = [x / game.map.width, y / game.map.height, player.health / PLAYER_HEALTH, player.coin,
+                  float(game.ticks - player.last_slash >= SWORD_RATE)]
+        for sprites, count, feature in ((game.mobs, ENV_MOBS, lambda mob: mob.health / MOB_HEALTH),
+                                        (game.items, ENV_ITEMS, lambda item: ITEM_DROPS.index(item.type) + 1)):
+            nearest = heapq.nsmallest(count, sprites, key=lambda sprite: player.pos.distance_squared_to(sprite.pos))
+            for sprite in nearest:
+                values += [(sprite.pos.x - x) / DETECT_RADIUS, (sprite.pos.y - y) / DETECT_RADIUS, feature(sprite)]
+            values += [0.0] * (3 * (count - len(nearest)))
+        if out is None:
+            return array("f", values)
+        out[:] = array("f", values)
+        return out
+
+def env_memory_size(count):
+    return count * (4 * ENV_OBSERVATION + 4 + 2 + 1)
+
+def env_buffers(buffer, count):
+    # Observations, rewards, actions and dones of count environments, in that order in buffer
+    sizes = [(count * ENV_OBSERVATION, "f", 4), (count, "f", 4), (count, "H", 2), (count, "B", 1)]
+    views, offset = [], 0
+    for length, format, itemsize in sizes:
+        views.append(buffer[offset:offset + length * itemsize].cast(format))
+        offset += length * itemsize
+    return views
+
+def env_worker(connection, memory_name, count, first, size, seed, options):
+    """
+    Worker  : Builds the environments first to first + size of a VectorEnv, then runs the commands sent on connection,
+              reading their actions from and writing their results to the shared memory. Replies True to each.
+    """
+    memory = SharedMemory(name=memory_name)
+    observations, rewards, actions, dones = env_buffers(memory.buf, count)
+    envs = [GameEnv(seed=seed + index, **options) for index in range(first, first + size)]
+    connection.send(True)
+    while True:
+        command = connection.recv()
+        if command == "close":
+            break
+        for index, env in enumerate(envs, first):
+            out = observations[index * ENV_OBSERVATION:(index + 1) * ENV_OBSERVATION]
+            if command == "reset":
+                env.reset(out=out)
+                rewards[index], dones[index] = 0.0, False
+            else:
+                observation, rewards[index], dones[index] = env.step(actions[index], out)
+                if dones[index]:
+                    env.reset(out=out)
+            out.release()
+        connection.send(True)
+    for view in (observations, rewards, actions, dones):
+        view.release()
+    memory.close()
+
+class VectorEnv():
+    def __init__(self, count, workers=None, seed=0, **options):
+        """
+        Vector  : count GameEnvs sharded over workers processes, one per core by default, stepped together.
+        Memory  : Observations, rewards, actions and dones of all of them live in one SharedMemory, written in place
+                  by the workers: only the command and a reply go through their pipes.
+        Batches : observations is count x ENV_OBSERVATION floats and rewards, dones count values, as numpy arrays when
+                  numpy is installed, otherwise flat memoryviews. They are overwritten by the next step() or reset().
+        Episode : An environment done is reset at once, its observation is the first of its next episode.
+        Options : GameEnv arguments, environment index i is seeded with seed + i.
+        """
+        self.count          = count
+        self.memory         = SharedMemory(create=True, size=env_memory_size(count))
+        self.views          = env_buffers(self.memory.buf, count)
+        observations, rewards, self.actions, dones = self.views
+        if numpy is not None:
+            self.observations   = numpy.asarray(observations).reshape(count, ENV_OBSERVATION)
+            self.rewards        = numpy.asarray(rewards)
+            self.dones          = numpy.asarray(dones).view(bool)
+        else:
+            self.observations, self.rewards, self.dones = observations, rewards, dones
+
+        workers = min(count, workers or os.cpu_count() or 1)
+        context = multiprocessing.get_context(ENV_START_METHOD)
+        self.connections    = []
+        self.processes      = []
+        for worker in range(workers):
+            first, last = count * worker // workers, count * (worker + 1) // workers
+            connection, child = context.Pipe()
+            process = context.Process(target=env_worker, args=(child, self.memory.name, count, first, last - first, seed, options), daemon=True)
+            process.start()
+            child.close()   # A worker that fails makes recv() raise instead of waiting forever
+            self.connections.append(connection)
+            self.processes.append(process)
+        for connection in self.connections:
+            connection.recv()
+
+    def command(self, command):
+        for connection in self.connections:
+            connection.send(command)
+        for connection in self.connections:
+            connection.recv()
+
+    def reset(self):
+        self.command("reset")
+        return self.observations
+
+    def step(self, actions):
+        """
+        Step    : Every environment with its action, the bits of the INPUT_KEYS held.
+        Return  : Observations, rewards and dones.
+        """
+        for index, action in enumerate(actions):
+            self.actions[index] = action
+        self.command("step")
+        return self.observations, self.rewards, self.dones
+
+    def close(self):
+        # Batches still held by the caller keep the shared memory mapped until they are dropped
+        for connection in self.connections:
+            connection.send("close")
+        for process in self.processes:
+            process.join()
+        self.memory.unlink()
+        self.observations = self.rewards = self.dones = self.actions = None
+        try:
+            for view in self.views:
+                view.release()
+            self.memory.close()
+        except BufferError:
+            pass
+
+
+
+if __name__ == "__main__":
+    # --headless, --record FILE to save the first game's input, --replay FILE to play a saved game back and exit
+    arguments = sys.argv[1:]
+    g = Game(headless="--headless" in arguments)
+    if "--replay" in arguments:
+        g.start_replay(arguments[arguments.index("--replay") + 1])
+        start = time.perf_counter()
+        g.run()
+        print("Replayed %d ticks in %.2f s" % (g.replay.tick, time.perf_counter() - start))
+        g.quit_game()
+    if "--record" in arguments:
+        g.start_recording(arguments[arguments.index("--record") + 1])
+        g.run()
+        g.stop_recording()
+    while True:
+        g.restart()
+        g.run()